@@ -0,0 +1,174 @@
+import argparse
+import os
+import pickle
+import tempfile
+import timeit
+
+from utils import *
+from server import RoomRegistry
+from state import RoomState, StateStore, gc_paused
+
+
+def client_list_payload(count):
+    """ A CLIENT_LIST the way send_connected_clients builds it """
+    return ["user" + str(i) + " (" + str(i % 60) + " min ago)" for i in range(count)]
+
+
+def rooms_list_payload(count):
+    """ An UPDATE_ROOMS_LIST the way CREATE_ROOM builds it """
+    return ["Room" + str(i) + " by user" + str(i % 97) for i in range(count)]
+
+
+def history_payload(count):
+    """ A HISTORY page the way handle_history builds it """
+    lines = ["user" + str(i % 13) + " (12:" + str(10 + i % 50) + "): see you at the meeting about item " + str(i)
+             for i in range(count)]
+    return ["Room1 by user1", 0, list(range(1, count + 1)), lines, 0]
+
+
+def measure(function, number):
+    """ Returns the best time of a single call in seconds """
+    return min(timeit.repeat(function, number=number, repeat=5)) / number
+
+
+def benchmark_codecs(sizes):
+    """
+    Compares the version 1 pickle path (pack_list and pickle.loads)
+    with every registered codec for the list payloads.
+    """
+    print(f'{"payload":<26}{"codec":<10}{"bytes":>10}{"encode MB/s":>14}{"decode MB/s":>14}')
+    for size in sizes:
+        for label, payload in (("CLIENT_LIST", client_list_payload(size)),
+                               ("UPDATE_ROOMS_LIST", rooms_list_payload(size))):
+            name = f'{label} x{size}'
+            number = max(1, 20000 // size)
+
+            frame = pack_list(payload)
+            body = frame[FrameDecoder.LEGACY_HEADER_SIZE:]
+            encode = measure(lambda: pack_list(payload), number)
+            decode = measure(lambda: pickle.loads(body), number)
+            print(f'{name:<26}{"v1 pickle":<10}{len(frame):>10}'
+                  f'{len(frame) / encode / 1e6:>14.1f}{len(frame) / decode / 1e6:>14.1f}')
+
+            for codec in CODECS.values():
+                frame = pack_command(label, payload, codec=codec)
+                body = frame[FRAME_HEADER.size:]
+                encode = measure(lambda: pack_command(label, payload, codec=codec), number)
+                decode = measure(lambda: unpack_command(body), number)
+                print(f'{name:<26}{codec.name:<10}{len(frame):>10}'
+                      f'{len(frame) / encode / 1e6:>14.1f}{len(frame) / decode / 1e6:>14.1f}')
+
+
+def benchmark_fan_out(sizes):
+    """
+    Compares encoding a GROUP_MESSAGE for every member of a room with
+    encoding it once and queueing the same bytes for every member.
+    """
+    line = "user1 (12:30): " + "hello everyone " * 5
+    print(f'{"members":<10}{"each us":>12}{"once us":>12}{"speedup":>10}')
+    for size in sizes:
+        outbox = []
+        number = max(1, 20000 // size)
+
+        def encode_each():
+            for i in range(size):
+                outbox.append(pack_command("GROUP_MESSAGE", "Room1 by user1", line, 1))
+            outbox.clear()
+
+        def encode_once():
+            frame = pack_command("GROUP_MESSAGE", "Room1 by user1", line, 1)
+            for i in range(size):
+                outbox.append(frame)
+            outbox.clear()
+
+        each = measure(encode_each, number)
+        once = measure(encode_once, number)
+        print(f'{size:<10}{each * 1e6:>12.1f}{once * 1e6:>12.1f}{each / once:>9.1f}x')
+
+
+def benchmark_compression(sizes):
+    """
+    Compares the bytes on the wire and the time spent compressing and
+    decompressing every class of payload with each compression.
+    """
+    compressions = [None] + list(COMPRESSIONS.values())
+    header = FRAME_HEADER.size + ENVELOPE_HEADER.size
+    print(f'{"payload":<26}{"compression":<13}{"bytes":>10}{"ratio":>8}{"compress us":>13}{"decompress us":>15}')
+    for size in sizes:
+        payloads = (("CLIENT_LIST", (client_list_payload(size), [1.7e9 + i for i in range(size)], 1.7e9)),
+                    ("UPDATE_ROOMS_LIST", (rooms_list_payload(size), list(range(size)))),
+                    # The server sends at most 200 messages a page.
+                    ("HISTORY", history_payload(min(size, 200))))
+        if size == sizes[0]:
+            payloads += (("GROUP_MESSAGE", ("Room1 by user1", "user1 (12:30): " + "hello everyone " * 5, 1)),)
+        for label, args in payloads:
+            name = f'{label} x{size}'
+            body = BINARY_CODEC.encode(args)
+            number = max(1, 2000000 // (len(body) * 10))
+            for compression in compressions:
+                if compression is None:
+                    print(f'{name:<26}{"none":<13}{len(body) + header:>10}{1:>8.2f}{"":>13}{"":>15}')
+                    continue
+                compressed = compression.compress(body)
+                compress = measure(lambda: compression.compress(body), number)
+                decompress = measure(lambda: compression.decompress(compressed, MAX_DECOMPRESSED_SIZE), number)
+                # Frames that do not get smaller, or are below the threshold, are sent as they are.
+                sent = len(compressed) if len(body) >= COMPRESS_THRESHOLD and len(compressed) < len(body) else len(body)
+                print(f'{name:<26}{compression.name:<13}{sent + header:>10}{len(body) / sent:>8.2f}'
+                      f'{compress * 1e6:>13.1f}{decompress * 1e6:>15.1f}')
+
+
+def benchmark_state(sizes, members=5, users=10000, changes=10000):
+    """
+    Times saving a snapshot of every room, and what a restarted server
+    does with it: loading it and adding the rooms to a RoomRegistry, from
+    the snapshot alone and with a log of changes since the snapshot.
+    """
+    def start(directory):
+        store = StateStore(directory)
+        registry = RoomRegistry()
+        with gc_paused():
+            for saved in store.load().values():
+                registry.restore(saved)
+        store.close()
+        return registry
+
+    print(f'{"rooms":<10}{"bytes":>12}{"snapshot ms":>13}{"load ms":>10}{"+log ms":>10}')
+    for size in sizes:
+        rooms = [RoomState(i, "Room" + str(i) + " by user" + str(i % users), i % 1000,
+                           ["user" + str((i + j * 7919) % users) for j in range(members)])
+                 for i in range(1, size + 1)]
+        with tempfile.TemporaryDirectory(prefix="chat-state-") as directory:
+            store = StateStore(directory)
+            store.load()
+            snapshot = measure(lambda: store.snapshot(rooms), 1)
+            store.close()
+            size_on_disk = os.path.getsize(store.snapshot_path)
+            load = measure(lambda: start(directory), 1)
+
+            # Rooms made since the snapshot, each with a member, are replayed from the log.
+            store = StateStore(directory)
+            store.load()
+            for i in range(size + 1, size + changes + 1):
+                room = RoomState(i, "Room" + str(i) + " by user1")
+                store.room_added(room)
+                store.member_added(room, "user1")
+            store.close()
+            with_log = measure(lambda: start(directory), 1)
+            print(f'{size:<10}{size_on_disk:>12}{snapshot * 1000:>13.1f}{load * 1000:>10.1f}{with_log * 1000:>10.1f}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro benchmarks for the chat protocol")
+    parser.add_argument("benchmark", choices=["codec", "fanout", "compression", "state"])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 5000])
+    options = parser.parse_args()
+
+    if options.benchmark == "codec":
+        benchmark_codecs(options.sizes)
+    elif options.benchmark == "fanout":
+        benchmark_fan_out(options.sizes)
+    elif options.benchmark == "compression":
+        benchmark_compression(options.sizes)
+    elif options.benchmark == "state":
+        benchmark_state(options.sizes)
@@ -0,0 +1,79 @@
+import os
+import sqlite3
+import urllib.parse
+
+# Where the client keeps the messages of its chats between runs.
+CACHE_DIRECTORY = os.path.join(os.path.expanduser("~"), ".cache", "chatting-program")
+
+
+def cache_path(host, port, name):
+    """
+    Gets the file of the cache of a client name on a server.
+    """
+    return os.path.join(CACHE_DIRECTORY, urllib.parse.quote(f'{host}_{port}_{name}', safe='') + ".sqlite3")
+
+
+class MessageCache(object):
+    """
+    The lines of every conversation of a client, kept in SQLite so the
+    chats are back as soon as it logs in again. The lines of a room are in
+    the order of their message ids, so it knows the last one it has and
+    pages of older ones can be added, those of a one to one chat, which
+    have no ids, in the order they arrived. Each conversation keeps up to
+    limit lines.
+
+    Nothing is written to the disk until commit(), which the client calls
+    after every batch of commands from the server.
+    """
+
+    def __init__(self, path, limit=1000):
+        self.limit = limit
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS lines (
+                seq INTEGER PRIMARY KEY,
+                kind TEXT NOT NULL,
+                name TEXT NOT NULL,
+                message_id INTEGER NOT NULL,
+                line TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS lines_by_conversation ON lines (kind, name, message_id, seq);
+            CREATE UNIQUE INDEX IF NOT EXISTS lines_by_message ON lines (kind, name, message_id) WHERE message_id > 0;
+        """)
+
+    def conversations(self):
+        """ Gets the kind and name of every conversation with lines """
+        return self.db.execute("SELECT DISTINCT kind, name FROM lines").fetchall()
+
+    def load(self, kind, name):
+        """ Drops all but the latest limit lines of a conversation and returns their ids and lines, oldest first """
+        self.db.execute("""
+            DELETE FROM lines WHERE kind = ? AND name = ? AND seq NOT IN (
+                SELECT seq FROM lines WHERE kind = ? AND name = ? ORDER BY message_id DESC, seq DESC LIMIT ?)
+        """, (kind, name, kind, name, self.limit))
+        rows = self.db.execute("SELECT message_id, line FROM lines WHERE kind = ? AND name = ? "
+                               "ORDER BY message_id, seq", (kind, name)).fetchall()
+        return [row[0] for row in rows], [row[1] for row in rows]
+
+    def add(self, kind, name, message_ids, lines):
+        """ Adds lines to a conversation, those of a message it has already are left out """
+        self.db.executemany("INSERT OR IGNORE INTO lines (kind, name, message_id, line) VALUES (?, ?, ?, ?)",
+                            [(kind, name, message_id, line) for message_id, line in zip(message_ids, lines)])
+
+    def replace(self, kind, name, message_ids, lines):
+        self.db.execute("DELETE FROM lines WHERE kind = ? AND name = ?", (kind, name))
+        self.add(kind, name, message_ids, lines)
+
+    def remove(self, kind, name):
+        """ Deletes every line of a conversation """
+        self.db.execute("DELETE FROM lines WHERE kind = ? AND name = ?", (kind, name))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
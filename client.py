@@ -1,11 +1,28 @@
+import sqlite3
 import sys
-import socket
-import select
+import time
 from PyQt5.QtWidgets import *
-from PyQt5.QtCore import QObject, QThread, pyqtSignal
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
 from utils import *
+from transport import ClientTransport
+from models import StringListModel
+from conversations import PEER, ROOM, ConversationManager
+from cache import MessageCache, cache_path
 import ssl
 
+# Milliseconds the frames sent by the windows are gathered for before they are written.
+SEND_DELAY = 10
+# Commands from the server handled before the GUI gets to redraw.
+EVENTS_PER_BATCH = 200
+# Lines each conversation keeps as new messages arrive, older ones are paged back in from the server.
+SCROLLBACK_LINES = 1000
+HISTORY_PAGE = 50
+# Messages asked for at once when catching up with a room, the most the server sends.
+SYNC_PAGE = 200
+# The server writes to this client as soon as it can: it is interactive, so latency matters most.
+# Large lists of clients and rooms are sent compressed, and a dropped connection is resumed.
+LOGIN_OPTIONS = {"flush_delay": 0, "nodelay": True, "compression": PREFERRED_COMPRESSIONS, "resumable": True}
+
 
 def close_program():
     """
@@ -14,6 +31,83 @@ def close_program():
     quit()
 
 
+def format_connected_time(seconds):
+    """
+    Gets how long ago a client connected, e.g. "5 min ago".
+    """
+    if seconds < 1:
+        return "now"
+    elif seconds < 60:
+        return str(round(seconds)) + " sec ago"
+    elif seconds < 60*60:
+        return str(round(seconds/60)) + " min ago"
+    else:
+        return str(round(seconds/(60*60))) + " hour ago"
+
+
+def create_list_view(model):
+    """
+    Gets a list view of a model that only lays out the rows it shows.
+    """
+    view = QListView()
+    view.setModel(model)
+    view.setUniformItemSizes(True)
+    view.setEditTriggers(QAbstractItemView.NoEditTriggers)
+    return view
+
+
+def create_chat_view(model):
+    """
+    Gets a list view of the lines of a chat, laid out a batch at a time
+    since wrapped lines differ in height.
+    """
+    view = QListView()
+    view.setModel(model)
+    view.setWordWrap(True)
+    view.setLayoutMode(QListView.Batched)
+    view.setBatchSize(100)
+    view.setEditTriggers(QAbstractItemView.NoEditTriggers)
+    return view
+
+
+def selected_text(view):
+    """
+    Gets the text of the row selected in a list view, or None unless exactly one is.
+    """
+    rows = view.selectionModel().selectedRows()
+    if len(rows) != 1:
+        return None
+    return rows[0].data()
+
+
+def selected_row(view):
+    """
+    Gets the number of the row selected in a list view, or None unless exactly one is.
+    """
+    rows = view.selectionModel().selectedRows()
+    if len(rows) != 1:
+        return None
+    return rows[0].row()
+
+
+def format_unread(count):
+    """
+    Gets what is added to a list entry for its unread messages, e.g. " [3 unread]".
+    """
+    return " [" + str(count) + " unread]" if count else ""
+
+
+class ConnectionSignals(QObject):
+    """
+    Hands what the I/O thread of the connection sees over to the GUI thread,
+    the slots connected to these run in the GUI thread.
+    """
+    events_ready = pyqtSignal()
+    failed = pyqtSignal(str)
+    closed = pyqtSignal()
+    reconnecting = pyqtSignal(float)
+
+
 class ChatApp(QWidget):
     """
     The first window that is shown at the start of the application.
@@ -44,10 +138,14 @@ class ChatApp(QWidget):
         self.host = ''
         self.port = None
         self.name = ''
-        self.sock = None
+        self.connection = None
+        self.signals = None
         self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
         self.context.load_verify_locations('cert.pem')
         self.context.check_hostname = False
+        # The TLS session of the last server, so reconnecting skips the full handshake.
+        self.session = None
+        self.session_address = None
         self.menu_window = None
 
     def setup_connection_window(self):
@@ -81,24 +179,49 @@ class ChatApp(QWidget):
         self.show()
 
     def connect_to_server(self):
-        # Connect to server at port
+        """
+        Starts connecting and logging in on the I/O thread, the window stays
+        responsive until the server answers.
+        """
         try:
             self.host = self.ip_address_textbox.text()
             self.port = int(self.port_textbox.text())
             self.name = self.nickname_textbox.text()
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock = self.context.wrap_socket(self.sock, server_hostname=self.host)
-            self.sock.connect((self.host, self.port))
-            self.menu_window = MenuWindow(self.width, self.height, self.title, self)
-            self.show_menu_window()
-
-        except socket.error as e:
-            self.show_error_dialog(f'Failed to connect to chat server @ port {self.port}')
-        except NameError:
-            self.show_error_dialog("There was a name error.")
-        except Exception as e:
-            print(e)
-            self.show_error_dialog("There was a connection error.")
+        except ValueError:
+            self.show_error_dialog("Please enter a port number.")
+            return
+        session = self.session if self.session_address == (self.host, self.port) else None
+        self.signals = ConnectionSignals()
+        self.connection = ClientTransport(self.host, self.port, self.context, session, SEND_DELAY / 1000,
+                                          on_events=self.signals.events_ready.emit,
+                                          on_failed=self.signals.failed.emit,
+                                          on_closed=self.signals.closed.emit,
+                                          on_reconnecting=self.signals.reconnecting.emit)
+        self.signals.events_ready.connect(self.logged_in)
+        self.signals.failed.connect(self.login_failed)
+        self.signals.closed.connect(self.login_closed)
+        self.connection.log_in(self.name, LOGIN_OPTIONS)
+        self.connection.start()
+        self.connect_button.setEnabled(False)
+
+    def logged_in(self):
+        """
+        The server sent the clients list, so the login worked.
+        """
+        self.signals.events_ready.disconnect(self.logged_in)
+        self.signals.failed.disconnect(self.login_failed)
+        self.signals.closed.disconnect(self.login_closed)
+        self.connect_button.setEnabled(True)
+        self.remember_session()
+        self.menu_window = MenuWindow(self.width, self.height, self.title, self)
+        self.show_menu_window()
+
+    def login_failed(self, message):
+        self.connect_button.setEnabled(True)
+        self.show_error_dialog(message)
+
+    def login_closed(self):
+        self.login_failed("There was a connection error.")
 
     def show_error_dialog(self, message):
         """
@@ -107,6 +230,11 @@ class ChatApp(QWidget):
         error_dialog = QErrorMessage(self)
         error_dialog.showMessage(message)
 
+    # Keeps the TLS session, the server only sends the tickets after the handshake.
+    def remember_session(self):
+        self.session = self.connection.session
+        self.session_address = (self.host, self.port)
+
     def show_menu_window(self):
         """
         Used to show the menu window after connecting successfully.
@@ -115,84 +243,6 @@ class ChatApp(QWidget):
         self.hide()
 
 
-class ConnectedClientsWorker(QObject):
-    """
-    The worker used to handle server output.
-    """
-    finished = pyqtSignal()
-    show_error_message = pyqtSignal()
-
-    def __init__(self, sock, invite_window, chat_window, group_chat_window, menu_window, parent=None):
-        super().__init__(parent=parent)
-        self.sock = sock
-        self.invite_window = invite_window
-        self.chat_window = chat_window
-        self.group_chat_window = group_chat_window
-        self.menu_window = menu_window
-        self.connected = True
-
-    def run(self):
-        """Long-running task."""
-        while self.connected:
-            readable, writeable, exceptional = select.select([self.sock], [], [])
-            for sock in readable:
-                if sock == self.sock:
-                    data = receive(self.sock)
-                    # If the server shuts down
-                    if not data:
-                        print('Client shutting down.')
-                        self.connected = False
-                        break
-                    elif data == "CLIENT_LIST":
-                        clients_list = receive_clients(self.sock)
-                        self.menu_window.update_connected_clients(clients_list)
-                    elif data == "MESSAGE":
-                        message = receive(self.sock)
-                        self.chat_window.add_message(message)
-                    elif data == "CREATE_ROOM":
-                        self.group_chat_window.room_title = receive(self.sock)
-                        self.group_chat_window.load_group_chat([self.menu_window.client_name + " (Host)"])
-                    elif data == "UPDATE_ROOMS_LIST":
-                        room_list = receive_list(self.sock)
-                        self.menu_window.update_chat_rooms_list(room_list)
-                    elif data == "JOIN_ROOM":
-                        # get all the members of the chat room.
-                        members_list = list(receive_list(self.sock))
-
-                        invited = False
-                        for member_name in members_list:
-                            if member_name == self.menu_window.client_name:
-                                invited = True
-
-                        if invited:
-                            self.group_chat_window.load_group_chat(members_list)
-                            self.menu_window.show_group_chat_window()
-                        else:
-                            self.show_error_message.emit()
-                    elif data == "UPDATE_INVITE_WINDOW":
-                        invitable_clients_list = receive_list(self.sock)
-                        self.invite_window.update_clients_list(invitable_clients_list)
-                    elif data == "INVITED":
-                        room_name = receive(self.sock)
-                        chat_room_members = receive_list(self.sock)
-                        if self.group_chat_window.room_title == room_name:
-                            self.group_chat_window.update_members(chat_room_members)
-                    elif data == "GROUP_MESSAGE":
-                        room_name = receive(self.sock)
-                        message = receive(self.sock)
-                        if self.group_chat_window.room_title == room_name:
-                            self.group_chat_window.add_group_message(message)
-                    elif data == "END":
-                        print("terminating connection.")
-                        break
-        self.sock.close()
-        self.finished.emit()
-
-    def stop(self):
-        self.connected = False
-        send(self.sock, "END")
-
-
 class MenuWindow(QWidget):
     """
     The window that is shown after successfully connecting.
@@ -204,17 +254,28 @@ class MenuWindow(QWidget):
         self.height = height
         self.title = title
         self.prev_window = prev_window
-        self.sock = prev_window.sock
+        self.connection = prev_window.connection
         self.client_name = prev_window.name
 
-        self.room_title = ""
-        self.members_list = []
+        # client name -> local time it connected, in the order they are listed
+        self.connected_clients = {}
+        self.connected_clients_model = StringListModel()
+        # room names, in the order they are listed
+        self.chat_rooms = []
+        self.chat_rooms_model = StringListModel()
+        # The messages of every chat, whether or not a window shows it, kept on disk between runs.
+        self.conversations = ConversationManager(SCROLLBACK_LINES, on_unread=self.unread_changed,
+                                                 cache=self.open_cache(prev_window))
+        # peer name -> its ChatRoomWindow and room name -> its GroupChatRoomWindow, made when first opened.
+        self.chat_windows = {}
+        self.group_chat_windows = {}
+        self.clock_offset = 0
 
         # Create components
         self.connected_clients_label = QLabel('Connected Clients', self)
         self.chat_rooms_label = QLabel('Chat rooms (Group chat)', self)
-        self.connected_clients_list_widget = QListWidget()
-        self.chat_rooms_list_widget = QListWidget()
+        self.connected_clients_list_widget = create_list_view(self.connected_clients_model)
+        self.chat_rooms_list_widget = create_list_view(self.chat_rooms_model)
         self.one_to_one_chat_button = QPushButton('1:1 chat')
         self.create_button = QPushButton('Create')
         self.join_button = QPushButton('Join')
@@ -228,28 +289,18 @@ class MenuWindow(QWidget):
 
         self.setup_menu_window()
 
-        # Get initial clients list.
-        send(self.sock, 'NAME: ' + self.prev_window.name)
-        receive(self.sock)
-        clients_list = receive_clients(self.sock)
-
-        self.update_connected_clients(clients_list)
-
-        self.chat_room_window = ChatRoomWindow(self.width, self.height, self.title, self)
-        self.group_chat_room_window = GroupChatRoomWindow(self.width, self.height, self.title, self)
-
-        self.update_thread = QThread()
-        self.update_worker = ConnectedClientsWorker(self.sock, self.group_chat_room_window.invite_window,
-                                                    self.chat_room_window, self.group_chat_room_window, self)
-        self.update_worker.moveToThread(self.update_thread)
-        self.update_thread.started.connect(self.update_worker.run)
-        self.update_worker.finished.connect(self.update_thread.quit)
-        self.update_worker.finished.connect(self.update_worker.deleteLater)
-        self.update_thread.finished.connect(self.update_worker.stop)
-        self.update_thread.finished.connect(self.update_thread.deleteLater)
-        self.update_worker.show_error_message.connect(lambda: self.show_error_dialog("You need to be invited "
-                                                                                     "to join the room."))
-        self.update_thread.start()
+        # Keeps the "x min ago" labels current.
+        self.presence_timer = QTimer(self)
+        self.presence_timer.timeout.connect(self.refresh_connected_clients)
+        self.presence_timer.start(30 * 1000)
+
+        # Commands from the server arrive through the signals, starting with the clients list.
+        prev_window.signals.events_ready.connect(self.handle_events)
+        prev_window.signals.closed.connect(self.connection_closed)
+        prev_window.signals.reconnecting.connect(self.connection_lost)
+        # The rooms catch up once the server has listed the ones that are still there.
+        self.conversations.restore()
+        self.handle_events()
 
     def setup_menu_window(self):
         """
@@ -280,34 +331,88 @@ class MenuWindow(QWidget):
 
     def show_chat_window(self):
         """
-        Goes to the one to one chat window.
+        Opens the one to one chat window of the selected client.
         """
-        selected_users = self.connected_clients_list_widget.selectedItems()
-        if len(selected_users) != 1:
+        selected_user = selected_text(self.connected_clients_list_widget)
+        if selected_user is None:
             self.show_error_dialog("Please selected a user from the list.")
-        elif selected_users[0].text().split("(")[1] == "me) ":
+        elif selected_user.split("(")[1] == "me) ":
             self.show_error_dialog("Please select a user other than yourself from the list.")
         else:
-            target_user = selected_users[0].text().split(" (")[0]
-            self.chat_room_window.load_data(target_user)
-            self.chat_room_window.show()
-            self.hide()
+            target_user = selected_user.split(" (")[0]
+            self.open_chat_window(target_user)
 
     def create_button_clicked(self):
-        self.group_chat_room_window.clear_chat()
-        send(self.sock, "CREATE_ROOM")
-        self.show_group_chat_window()
+        self.connection.send_command("CREATE_ROOM")
 
     def join_button_clicked(self):
-        selected_chatroom = self.chat_rooms_list_widget.selectedItems()
-        if len(selected_chatroom) != 1:
+        row = selected_row(self.chat_rooms_list_widget)
+        if row is None:
             self.show_error_dialog("Please select a chat room from the list.")
+            return
+        room_name = self.chat_rooms[row]
+        conversation = self.conversations.find(ROOM, room_name)
+        if conversation is not None and conversation.loaded and conversation.members:
+            # Joined already, its messages have been kept since.
+            self.open_group_chat_window(room_name)
         else:
             # If the user is invited, then they can join the room.
-            send(self.sock, "JOIN_ROOM")
-            # Sends the room name.
-            send(self.sock, str(selected_chatroom[0].text()))
-            self.group_chat_room_window.room_title = str(selected_chatroom[0].text())
+            # Sends the room name, and the last message kept so only the ones after it are sent.
+            last_id = conversation.model.newest_id() if conversation is not None else 0
+            self.connection.send_command("JOIN_ROOM", room_name, last_id)
+
+    def open_cache(self, prev_window):
+        """
+        Opens the messages kept from the last time, the chats start empty when that fails.
+        """
+        try:
+            return MessageCache(cache_path(prev_window.host, prev_window.port, self.client_name), SCROLLBACK_LINES)
+        except (OSError, sqlite3.Error) as e:
+            print(e)
+            return None
+
+    def sync_rooms(self):
+        """
+        Asks for the messages the rooms kept from the last time have missed,
+        and forgets the rooms the server no longer has. The server sends an
+        empty page for the rooms the client is not in.
+        """
+        for conversation in list(self.conversations.conversations.values()):
+            if conversation.kind != ROOM:
+                continue
+            if conversation.name not in self.chat_rooms:
+                self.forget_chat_room(conversation.name)
+            else:
+                self.connection.send_command("HISTORY", conversation.name, 0, SYNC_PAGE,
+                                             conversation.model.newest_id())
+
+    def open_chat_window(self, name):
+        """
+        Shows the one to one chat with a client, several can be open at once.
+        """
+        window = self.chat_windows.get(name)
+        if window is None:
+            window = ChatRoomWindow(self.width, self.height, self.title, self, self.conversations.get(PEER, name))
+            self.chat_windows[name] = window
+        self.show_chat_room_window(window)
+        return window
+
+    def open_group_chat_window(self, room_name):
+        """
+        Shows the chat of a room, several can be open at once.
+        """
+        window = self.group_chat_windows.get(room_name)
+        if window is None:
+            window = GroupChatRoomWindow(self.width, self.height, self.title, self,
+                                         self.conversations.get(ROOM, room_name))
+            self.group_chat_windows[room_name] = window
+        self.show_chat_room_window(window)
+        return window
+
+    def show_chat_room_window(self, window):
+        window.show()
+        window.raise_()
+        window.activateWindow()
 
     def show_error_dialog(self, message):
         """
@@ -316,55 +421,241 @@ class MenuWindow(QWidget):
         error_dialog = QErrorMessage(self)
         error_dialog.showMessage(message)
 
-    def show_group_chat_window(self):
-        """
-        Goes to group chat window.
-        """
-        self.group_chat_room_window.show()
-        self.hide()
-
     def show_connection_window(self):
         """
         Goes to the previous window.
         """
-        self.update_worker.stop()
+        self.connection.close()
+        for window in self.chat_room_windows():
+            window.hide()
+        self.conversations.close()
         self.prev_window.show()
         self.hide()
 
-    def update_connected_clients(self, clients_list):
+    def handle_events(self):
         """
-        Updates the connected clients list widget.
+        Handles the commands received from the server. A burst is handled
+        in batches with the windows not redrawn until a batch is done.
         """
-        self.connected_clients_list_widget.clear()
-        for i in range(len(clients_list)):
-            self.connected_clients_list_widget.insertItem(i, clients_list[i])
+        events, more = self.connection.take_events(EVENTS_PER_BATCH)
+        windows = [self, *self.chat_room_windows()]
+        windows.extend(window.invite_window for window in self.group_chat_windows.values())
+        for window in windows:
+            window.setUpdatesEnabled(False)
+        try:
+            for command, args in events:
+                self.handle_event(command, args)
+        finally:
+            self.conversations.commit()
+            for window in windows:
+                window.setUpdatesEnabled(True)
+        if more:
+            # Let the windows redraw before the next batch.
+            QTimer.singleShot(0, self.handle_events)
+
+    def chat_room_windows(self):
+        return [*self.chat_windows.values(), *self.group_chat_windows.values()]
+
+    def handle_event(self, data, args):
+        """
+        Handles one command from the server.
+        """
+        if data == "SESSION":
+            # When the session could not be resumed, the rooms list that follows catches the rooms up.
+            self.setWindowTitle(self.title)
+        elif data == "CLIENT_LIST":
+            self.update_connected_clients(*args)
+        elif data == "CLIENT_JOINED":
+            self.add_connected_client(*args)
+        elif data == "CLIENT_LEFT":
+            self.remove_connected_client(args[0])
+        elif data == "MESSAGE":
+            # The other client of the chat, whoever sent the message.
+            message, peer = args
+            self.conversations.add_line(PEER, peer, message, unread=not message.startswith("Me ("))
+        elif data == "CREATE_ROOM":
+            room_name = args[0]
+            self.conversations.get(ROOM, room_name).loaded = True
+            self.open_group_chat_window(room_name).update_members([self.client_name + " (Host)"])
+        elif data == "UPDATE_ROOMS_LIST":
+            room_list = args[0]
+            self.update_chat_rooms_list(room_list)
+            self.sync_rooms()
+        elif data == "ROOM_ADDED":
+            self.add_chat_room(*args)
+        elif data == "ROOM_REMOVED":
+            self.remove_chat_room(*args)
+        elif data == "JOIN_ROOM":
+            # get all the members of the chat room.
+            members_list, room_name = args
+            members_list = list(members_list)
+
+            if self.client_name in members_list:
+                # The latest messages of the room follow.
+                self.open_group_chat_window(room_name).update_members(members_list)
+            else:
+                self.show_error_dialog("You need to be invited to join the room.")
+        elif data == "UPDATE_INVITE_WINDOW":
+            invitable_clients_list, room_name = args
+            window = self.group_chat_windows.get(room_name)
+            if window is not None:
+                window.invite_window.update_clients_list(invitable_clients_list)
+        elif data == "INVITED":
+            room_name, chat_room_members = args
+            window = self.group_chat_windows.get(room_name)
+            if window is not None:
+                window.update_members(chat_room_members)
+            else:
+                self.conversations.get(ROOM, room_name).members = chat_room_members
+        elif data == "GROUP_MESSAGE":
+            room_name, message, message_id = args
+            own = message.startswith(self.client_name + " (")
+            self.conversations.add_line(ROOM, room_name, message, message_id, unread=not own)
+        elif data == "HISTORY":
+            room_name, before_id, message_ids, messages, after_id = args
+            self.conversations.add_history(room_name, before_id, message_ids, messages, after_id)
+            window = self.group_chat_windows.get(room_name)
+            if after_id > 0 and len(message_ids) >= SYNC_PAGE:
+                # More was missed than one page holds.
+                self.connection.send_command("HISTORY", room_name, 0, SYNC_PAGE, message_ids[-1])
+            elif window is not None and after_id == 0:
+                window.history_added(before_id, len(messages))
+        elif data == "THROTTLED":
+            command, limit, action, retry_after = args
+            if action == "disconnected":
+                # Do not come straight back.
+                self.connection.abort()
+                self.show_error_dialog("You were disconnected for sending too fast.")
+            else:
+                self.show_error_dialog(f'You are sending too fast, wait {retry_after:.1f} seconds.')
+
+    def connection_closed(self):
+        print("terminating connection.")
+
+    def connection_lost(self, delay):
+        """
+        The connection dropped, it is made again in delay seconds and what was missed is sent then.
+        """
+        self.setWindowTitle(self.title + " (reconnecting...)")
+
+    def update_connected_clients(self, names, times, server_time):
+        """
+        Replaces the connected clients list, only done on login.
+        """
+        self.clock_offset = time.time() - server_time
+        self.connected_clients = {name: connected_time + self.clock_offset
+                                  for name, connected_time in zip(names, times)}
+        self.refresh_connected_clients()
+
+    def add_connected_client(self, name, connected_time):
+        """
+        Adds a client that has just connected.
+        """
+        self.remove_connected_client(name)
+        self.connected_clients[name] = connected_time + self.clock_offset
+        self.connected_clients_model.append(self.format_connected_client(name))
+
+    def remove_connected_client(self, name):
+        """
+        Removes a client that has disconnected.
+        """
+        if name in self.connected_clients:
+            self.connected_clients_model.remove_row(list(self.connected_clients).index(name))
+            del self.connected_clients[name]
+
+    def refresh_connected_clients(self):
+        """
+        Updates the "x min ago" of every client, only the rows whose text changed are redrawn.
+        """
+        self.connected_clients_model.set_items(map(self.format_connected_client, self.connected_clients))
+
+    def format_connected_client(self, name):
+        """
+        Gets the text shown for a client, e.g. "name (me) (5 min ago) [3 unread]".
+        """
+        connected_time = self.connected_clients[name]
+        unread = format_unread(self.conversations.unread(PEER, name))
+        if name == self.client_name:
+            name = name + " (me)"
+        return name + " (" + format_connected_time(time.time() - connected_time) + ")" + unread
 
     def update_chat_rooms_list(self, chat_rooms_list):
         """
-        Updates the chat rooms list widget.
+        Replaces the chat rooms list, only done on login.
+        """
+        self.chat_rooms = list(chat_rooms_list)
+        self.chat_rooms_model.set_items(map(self.format_chat_room, self.chat_rooms))
+
+    def add_chat_room(self, room_id, room_name):
+        """
+        Adds a room that has just been created.
+        """
+        if room_name not in self.chat_rooms:
+            self.chat_rooms.append(room_name)
+            self.chat_rooms_model.append(self.format_chat_room(room_name))
+
+    def remove_chat_room(self, room_id, room_name):
+        """
+        Removes a room that nobody is using anymore.
+        """
+        if room_name in self.chat_rooms:
+            row = self.chat_rooms.index(room_name)
+            del self.chat_rooms[row]
+            self.chat_rooms_model.remove_row(row)
+        self.forget_chat_room(room_name)
+
+    def forget_chat_room(self, room_name):
+        """
+        Closes the window of a room that is gone and drops its messages, here and in the cache.
+        """
+        window = self.group_chat_windows.pop(room_name, None)
+        if window is not None:
+            window.invite_window.hide()
+            window.hide()
+        self.conversations.remove(ROOM, room_name)
+
+    def format_chat_room(self, room_name):
+        """
+        Gets the text shown for a room, e.g. "Room1 by name [3 unread]".
+        """
+        return room_name + format_unread(self.conversations.unread(ROOM, room_name))
+
+    def unread_changed(self, conversation):
+        """
+        Shows the unread count of a chat in the clients or rooms list.
         """
-        self.chat_rooms_list_widget.clear()
-        for i in range(len(chat_rooms_list)):
-            self.chat_rooms_list_widget.insertItem(i, chat_rooms_list[i])
+        if conversation.kind == PEER and conversation.name in self.connected_clients:
+            row = list(self.connected_clients).index(conversation.name)
+            self.connected_clients_model.set_item(row, self.format_connected_client(conversation.name))
+        elif conversation.kind == ROOM and conversation.name in self.chat_rooms:
+            row = self.chat_rooms.index(conversation.name)
+            self.chat_rooms_model.set_item(row, self.format_chat_room(conversation.name))
 
 
 class ChatRoomWindow(QWidget):
     """
-    The window that is shown after pressing 1:1 chat button.
+    The window of a one to one chat, opened with the 1:1 chat button.
+    It shows the lines its conversation keeps, so it can be closed and
+    opened again without asking the server for them.
     """
 
-    def __init__(self, width, height, title, prev_window):
+    def __init__(self, width, height, title, prev_window, conversation):
         super().__init__()
         self.width = width
         self.height = height
         self.title = title
-        self.sock = prev_window.sock
-        self.target_username = None
+        self.connection = prev_window.connection
+        self.conversations = prev_window.conversations
+        self.conversation = conversation
+        self.target_username = conversation.name
         self.prev_window = prev_window
+        # Whether the chat was scrolled to the end before the lines being added.
+        self.at_end = True
 
         # Create components.
-        self.title_label = QLabel('Chat Title')
-        self.chat_text_browser = QTextBrowser()
+        self.title_label = QLabel("Chat with " + conversation.name)
+        self.chat_model = conversation.model
+        self.chat_view = create_chat_view(self.chat_model)
         self.chat_input = QLineEdit()
         self.send_button = QPushButton('Send')
         self.close_button = QPushButton('Close')
@@ -374,6 +665,12 @@ class ChatRoomWindow(QWidget):
         self.chat_layout = QVBoxLayout()
 
         self.setup_chat_room_window()
+        self.setWindowTitle(self.title + " - " + conversation.name)
+
+        # Follow the end of the chat as lines arrive, if it was scrolled there.
+        self.chat_model.rowsAboutToBeInserted.connect(self.lines_arriving)
+        self.chat_model.rowsInserted.connect(self.lines_arrived)
+        self.chat_view.scrollToBottom()
 
     def setup_chat_room_window(self):
         """
@@ -396,7 +693,7 @@ class ChatRoomWindow(QWidget):
 
         # Add components to layouts
         self.chat_layout.addWidget(self.title_label)
-        self.chat_layout.addWidget(self.chat_text_browser)
+        self.chat_layout.addWidget(self.chat_view)
         self.chat_input_layout.addWidget(self.chat_input)
         self.chat_input_layout.addWidget(self.send_button)
         self.chat_layout.addLayout(self.chat_input_layout)
@@ -404,63 +701,51 @@ class ChatRoomWindow(QWidget):
 
     def show_menu_window(self):
         """
-        Goes to the previous window.
+        Closes the chat, its messages are still kept.
         """
-        self.chat_text_browser.clear()
         self.prev_window.show()
+        self.prev_window.raise_()
         self.hide()
 
+    # While the window is shown, the messages of its chat are read as they arrive.
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.conversations.set_shown(self.conversation, True)
+
+    def hideEvent(self, event):
+        super().hideEvent(event)
+        self.conversations.set_shown(self.conversation, False)
+
     def send_message(self):
         """
         Sends the one to one message to the server
         and clears the input field.
         """
-        send(self.sock, "MESSAGE")
-        send(self.sock, self.target_username)
-        send(self.sock, self.chat_input.text())
+        self.connection.send_command("MESSAGE", self.target_username, self.chat_input.text())
         self.chat_input.clear()
 
-    def load_data(self, username):
-        """
-        Loads the data for the chat room.
-        """
-        self.title_label.setText("Chat with " + username)
-        self.target_username = username
-        self.chat_text_browser.clear()
-        """
-        Currently does nothing but can call saved data
-        from the server later.
-        """
-        message_list = []
-        for message in message_list:
-            self.chat_text_browser.append(message)
+    def lines_arriving(self, parent, first, last):
+        scroll_bar = self.chat_view.verticalScrollBar()
+        self.at_end = scroll_bar.value() == scroll_bar.maximum()
 
-    def add_message(self, message):
-        """
-        Adds a new message the text browser.
-        """
-        message_origin = message.split(" (")[0]
-        if message_origin == "Me":
-            self.chat_text_browser.append(message)
-        try:
-            if message_origin == self.target_username:
-                self.chat_text_browser.append(message)
-        except AttributeError as e:
-            print("hasn't joined the chat room yet.")
+    def lines_arrived(self, parent, first, last):
+        if self.at_end and last == self.chat_model.rowCount() - 1:
+            self.chat_view.scrollToBottom()
 
 
 class GroupChatRoomWindow(ChatRoomWindow):
     """
-    The window that is shown after creating or joining a group chat.
+    The window of a chat room, opened after creating or joining it.
     """
 
-    def __init__(self, width, height, title, prev_window):
-        super().__init__(width, height, title, prev_window)
+    def __init__(self, width, height, title, prev_window, conversation):
+        super().__init__(width, height, title, prev_window, conversation)
         # Create components
         self.members_label = QLabel('Members', self)
-        self.members_list_widget = QListWidget()
+        self.members_model = StringListModel(conversation.members)
+        self.members_list_widget = create_list_view(self.members_model)
         self.invite_button = QPushButton('Invite')
-        self.chat_text_browser = QTextBrowser()
+        self.history_button = QPushButton('Older messages')
 
         # Setup new layouts
         self.members_layout = QVBoxLayout()
@@ -469,7 +754,8 @@ class GroupChatRoomWindow(ChatRoomWindow):
         self.setup_group_chat_room_layout()
         self.setLayout(self.group_chat_layout)
 
-        self.room_title = "No Title"
+        self.room_title = conversation.name
+        self.title_label.setText(self.room_title)
         self.client_name = prev_window.client_name
         self.invite_window = InviteWindow(self.width, self.height, self.title, self)
 
@@ -487,8 +773,12 @@ class GroupChatRoomWindow(ChatRoomWindow):
         # Button functionality
         self.send_button.clicked.connect(self.send_button_clicked)
         self.invite_button.clicked.connect(self.show_invite_window)
+        self.history_button.clicked.connect(self.history_button_clicked)
+        # Scrolling to the top pages in older messages.
+        self.chat_view.verticalScrollBar().valueChanged.connect(self.chat_scrolled)
 
         # Add components to layout
+        self.chat_layout.insertWidget(1, self.history_button)
         self.members_layout.addWidget(self.members_label)
         self.members_layout.addWidget(self.members_list_widget)
         self.members_layout.addWidget(self.invite_button)
@@ -499,45 +789,41 @@ class GroupChatRoomWindow(ChatRoomWindow):
         """
         Used to show the invite window.
         """
-        send(self.sock, "UPDATE_INVITE_WINDOW")
-        send(self.sock, self.room_title)
+        self.connection.send_command("UPDATE_INVITE_WINDOW", self.room_title)
         self.invite_window.show()
         self.hide()
 
-    def load_group_chat(self, members_list):
-        """
-        Loads the data for the chat room.
-        """
-        self.title_label.setText(self.room_title)
-        self.members_list_widget.clear()
-        for i in range(len(members_list)):
-            self.members_list_widget.insertItem(i, members_list[i])
-
-    def update_messages(self, message_list):
-        self.chat_text_browser.clear()
-        for message in message_list:
-            self.chat_text_browser.append(message)
-
     def update_members(self, members_list):
-        self.members_list_widget.clear()
-        for i in range(len(members_list)):
-            self.members_list_widget.insertItem(i, members_list[i])
+        self.conversation.members = members_list
+        self.members_model.set_items(members_list)
 
     def send_button_clicked(self):
-        send(self.sock, "GROUP_MESSAGE")
-        send(self.sock, self.room_title)
-        send(self.sock, str(self.chat_input.text()))
+        self.connection.send_command("GROUP_MESSAGE", self.room_title, str(self.chat_input.text()))
         self.chat_input.clear()
 
-    def add_group_message(self, message):
+    def history_button_clicked(self):
         """
-        Adds a new message the text browser.
+        Asks the server for the messages before the oldest one shown.
         """
-        self.chat_text_browser.append(message)
+        # Nothing is older than the first message, and an empty room has nothing to page back from.
+        if self.chat_model.oldest_id() > 1 and not self.conversation.history_pending:
+            self.conversation.history_pending = True
+            self.connection.send_command("HISTORY", self.room_title, self.chat_model.oldest_id(), HISTORY_PAGE)
+
+    def chat_scrolled(self, value):
+        scroll_bar = self.chat_view.verticalScrollBar()
+        if value == scroll_bar.minimum() and scroll_bar.maximum() > scroll_bar.minimum():
+            self.history_button_clicked()
 
-    def clear_chat(self):
-        print("trying to clear")
-        self.chat_text_browser.clear()
+    def history_added(self, before_id, count):
+        """
+        Scrolls to the latest messages after joining, or keeps the line that
+        was at the top in view when a page of older messages came in.
+        """
+        if before_id == 0:
+            self.chat_view.scrollToBottom()
+        else:
+            self.chat_view.scrollTo(self.chat_model.index(count), QAbstractItemView.PositionAtTop)
 
 
 class InviteWindow(QWidget):
@@ -552,11 +838,12 @@ class InviteWindow(QWidget):
         self.title = title
         self.prev_window = prev_window
 
-        self.sock = prev_window.sock
+        self.connection = prev_window.connection
 
         # Create components
         self.connected_clients_label = QLabel("Connected Clients", self)
-        self.clients_list_widget = QListWidget()
+        self.clients_model = StringListModel()
+        self.clients_list_widget = create_list_view(self.clients_model)
         self.invite_button = QPushButton("Invite")
         self.cancel_button = QPushButton("Cancel")
 
@@ -600,18 +887,14 @@ class InviteWindow(QWidget):
         self.hide()
 
     def invite_button_pressed(self):
-        selected_client = self.clients_list_widget.selectedItems()
-        if len(selected_client) != 1:
+        selected_client = selected_text(self.clients_list_widget)
+        if selected_client is None:
             self.show_error_dialog("Please select a client from the list.")
         else:
-            send(self.sock, "INVITE")
-            send(self.sock, self.prev_window.room_title)
-            send(self.sock, str(selected_client[0].text()))
+            self.connection.send_command("INVITE", self.prev_window.room_title, selected_client)
 
     def update_clients_list(self, clients_list):
-        self.clients_list_widget.clear()
-        for i in range(len(clients_list)):
-            self.clients_list_widget.insertItem(i, clients_list[i])
+        self.clients_model.set_items(clients_list)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,308 @@
+import asyncio
+import bisect
+import hashlib
+import os
+
+from utils import *
+
+
+def pack_event(event, *args):
+    """ Build a bus frame, the name of the event followed by its arguments """
+    buffer = BINARY_CODEC.encode((event,) + args)
+    return FRAME_HEADER.pack(len(buffer)) + buffer
+
+
+class Peer(object):
+    """ Another worker or node and the bus connection to it """
+    __slots__ = ("index", "stream", "address", "outbound")
+
+    def __init__(self, index, stream, address=None, outbound=False):
+        self.index = index
+        self.stream = stream
+        self.address = address
+        self.outbound = outbound
+
+    def __repr__(self):
+        return f'Peer({self.index})'
+
+    def send(self, event, *args):
+        self.stream.write(pack_event(event, *args))
+
+
+class WorkerBus(object):
+    """
+    Connects the worker processes of one server through Unix domain sockets
+    in directory, every worker to every other one. A worker connects to the
+    workers with a lower index and is connected to by the ones above it.
+
+    Events from a peer are passed to handlers[event](peer, *args),
+    on_joined(peer) is called when a peer connects and on_lost(peer) when
+    it goes away. With a single worker there are no peers and nothing is
+    opened.
+
+    Room ids are handed out with a stride of id_step, and home(room_id)
+    is the index of the worker that is the home of a room.
+    """
+
+    def __init__(self, index=0, workers=1, directory=None):
+        self.index = index
+        self.workers = workers
+        self.directory = directory
+        self.id_step = workers
+        self.peers = {}  # worker index -> Peer
+        self.handlers = {}
+        self.on_joined = None
+        self.on_lost = None
+        self.server = None
+        self.ready = None
+        self.closing = False
+
+    def path(self, index):
+        return os.path.join(self.directory, f'worker-{index}.sock')
+
+    def home(self, room_id):
+        return room_id % self.workers
+
+    async def start(self, handlers, on_joined, on_lost, timeout=30):
+        """ Waits until every other worker is connected """
+        self.handlers = handlers
+        self.on_joined = on_joined
+        self.on_lost = on_lost
+        if self.workers == 1:
+            return
+        loop = asyncio.get_running_loop()
+        self.ready = asyncio.Event()
+        self.server = await loop.create_unix_server(lambda: FrameStream(self.accept), self.path(self.index))
+        for index in range(self.index):
+            loop.create_task(self.connect(index))
+        await asyncio.wait_for(self.ready.wait(), timeout)
+
+    async def connect(self, index):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                transport, stream = await loop.create_unix_connection(FrameStream, self.path(index))
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                # The other worker is still starting.
+                await asyncio.sleep(0.05)
+        stream.write(pack_event("HELLO", self.index))
+        await self.serve_peer(Peer(index, stream))
+
+    async def accept(self, stream):
+        try:
+            buf = await stream.receive_frame()
+            event, index = BINARY_CODEC.decode(buf)
+        except (IndexError, TypeError, ValueError, ProtocolError) as e:
+            print(f'Bus: bad hello {e}')
+            stream.close()
+            return
+        await self.serve_peer(Peer(index, stream))
+
+    async def serve_peer(self, peer):
+        self.add_peer(peer)
+        try:
+            while True:
+                buf = await peer.stream.receive_frame()
+                if not buf:
+                    break
+                event, *args = BINARY_CODEC.decode(buf)
+                self.handlers[event](peer, *args)
+        except (KeyError, IndexError, TypeError, ValueError, ProtocolError) as e:
+            print(f'Bus: dropping {peer} {e!r}')
+        finally:
+            peer.stream.close()
+            if self.peers.get(peer.index) is peer:
+                self.remove_peer(peer)
+                if not self.closing:
+                    self.on_lost(peer)
+
+    def add_peer(self, peer):
+        self.on_joined(peer)
+        self.peers[peer.index] = peer
+        if len(self.peers) == self.workers - 1:
+            self.ready.set()
+
+    def remove_peer(self, peer):
+        del self.peers[peer.index]
+
+    def send(self, index, event, *args):
+        peer = self.peers.get(index)
+        if peer is not None:
+            peer.send(event, *args)
+
+    def broadcast(self, event, *args):
+        self.multicast(self.peers.values(), event, *args)
+
+    # Sends an event to some of the peers, encoding it once.
+    def multicast(self, peers, event, *args):
+        if not peers:
+            return
+        frame = pack_event(event, *args)
+        for peer in peers:
+            peer.stream.write(frame)
+
+    def close(self):
+        self.closing = True
+        if self.server is not None:
+            self.server.close()
+        for peer in list(self.peers.values()):
+            peer.stream.close()
+
+
+class HashRing(object):
+    """
+    Consistent hashing of keys onto nodes. Every node is put on the ring
+    at replicas points, a key belongs to the first node point after its
+    hash, so adding or removing a node only moves the keys next to it.
+    """
+
+    def __init__(self, replicas=64):
+        self.replicas = replicas
+        self.points = []  # sorted hashes
+        self.owners = []  # the node at each point
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.blake2b(str(key).encode(), digest_size=8).digest(), 'big')
+
+    def __contains__(self, node):
+        return node in self.owners
+
+    def add(self, node):
+        if node in self:
+            return
+        for i in range(self.replicas):
+            point = self.hash(f'{node}#{i}')
+            index = bisect.bisect(self.points, point)
+            self.points.insert(index, point)
+            self.owners.insert(index, node)
+
+    def remove(self, node):
+        kept = [(point, owner) for point, owner in zip(self.points, self.owners) if owner != node]
+        self.points = [point for point, owner in kept]
+        self.owners = [owner for point, owner in kept]
+
+    def node_for(self, key):
+        index = bisect.bisect(self.points, self.hash(key))
+        return self.owners[index % len(self.owners)]
+
+
+class ClusterBus(WorkerBus):
+    """
+    Connects server nodes, on one host or many, over TCP. A node is started
+    with the addresses of a few others (seeds). Every gossip_interval seconds
+    each node tells its peers about the nodes it is connected to, and they
+    connect to the ones they did not know, so every node ends up connected
+    to every other one. When two nodes connect to each other at once, the
+    connection made by the node with the lower id is kept.
+
+    The home of a room is found on a consistent hash ring of the nodes that
+    are up, so a node joining or leaving only moves the rooms next to it.
+    Node ids go from 0 to MAX_NODES - 1.
+    """
+    MAX_NODES = 1024
+
+    def __init__(self, index, host, port, seeds=(), gossip_interval=1.0):
+        super().__init__(index, self.MAX_NODES)
+        self.host = host
+        self.port = port
+        self.seeds = list(seeds)
+        self.gossip_interval = gossip_interval
+        self.connecting = set()  # addresses being connected to
+        self.ring = HashRing()
+        self.ring.add(index)
+        self.gossip_task = None
+
+    def home(self, room_id):
+        return self.ring.node_for(room_id)
+
+    async def start(self, handlers, on_joined, on_lost, timeout=30):
+        """ Listens for other nodes and starts connecting to the seeds """
+        self.handlers = dict(handlers, NODES=self.receive_nodes)
+        self.on_joined = on_joined
+        self.on_lost = on_lost
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(lambda: FrameStream(self.accept), self.host, self.port,
+                                               reuse_address=True)
+        for host, port in self.seeds:
+            loop.create_task(self.connect_node(host, port))
+        self.gossip_task = loop.create_task(self.gossip())
+
+    async def connect_node(self, host, port, attempts=None):
+        """ Connects to a node, retrying seeds until they are up """
+        loop = asyncio.get_running_loop()
+        if (host, port) in self.connecting:
+            return
+        self.connecting.add((host, port))
+        try:
+            while not self.closing:
+                try:
+                    transport, stream = await loop.create_connection(FrameStream, host, port)
+                    break
+                except OSError:
+                    if attempts is not None:
+                        attempts -= 1
+                        if attempts <= 0:
+                            return
+                    await asyncio.sleep(self.gossip_interval)
+            else:
+                return
+        finally:
+            self.connecting.discard((host, port))
+        await self.handshake(stream, True)
+
+    async def accept(self, stream):
+        await self.handshake(stream, False)
+
+    async def handshake(self, stream, outbound):
+        stream.write(pack_event("HELLO", self.index, self.host, self.port))
+        try:
+            buf = await stream.receive_frame()
+            event, index, host, port = BINARY_CODEC.decode(buf)
+        except (IndexError, TypeError, ValueError, ProtocolError) as e:
+            print(f'Bus: bad hello {e}')
+            stream.close()
+            return
+        if index == self.index:
+            stream.close()
+            return
+        await self.serve_peer(Peer(index, stream, (host, port), outbound))
+
+    def add_peer(self, peer):
+        existing = self.peers.get(peer.index)
+        if existing is not None:
+            # Keep the connection made by the node with the lower id.
+            if existing.outbound == (self.index < peer.index):
+                peer.stream.close()
+                return
+            self.peers.pop(peer.index)
+            existing.stream.close()
+        else:
+            # The joining node hears about the rooms that are about to move to it.
+            self.on_joined(peer)
+        self.peers[peer.index] = peer
+        self.ring.add(peer.index)
+
+    def remove_peer(self, peer):
+        del self.peers[peer.index]
+        self.ring.remove(peer.index)
+
+    async def gossip(self):
+        while True:
+            await asyncio.sleep(self.gossip_interval)
+            nodes = [[self.index, self.host, self.port]]
+            nodes.extend([peer.index, *peer.address] for peer in self.peers.values())
+            self.broadcast("NODES", nodes)
+
+    # A peer told us about the nodes it is connected to.
+    def receive_nodes(self, peer, nodes):
+        loop = asyncio.get_running_loop()
+        for index, host, port in nodes:
+            if index != self.index and index not in self.peers:
+                loop.create_task(self.connect_node(host, port, attempts=1))
+
+    def close(self):
+        super().close()
+        if self.gossip_task is not None:
+            self.gossip_task.cancel()
@@ -0,0 +1,137 @@
+from models import ScrollbackModel
+
+# The kinds of conversation, a one to one chat with another client and a chat room.
+PEER = "peer"
+ROOM = "room"
+
+
+class Conversation(object):
+    """
+    A one to one chat or a chat room. Its lines are kept whether or not a
+    window shows them, so opening it again shows them straight away, and
+    unread counts the lines that arrived while no window showed it.
+    """
+
+    def __init__(self, kind, name, limit):
+        self.kind = kind
+        self.name = name
+        self.model = ScrollbackModel(limit)
+        self.unread = 0
+        self.shown = False
+        # Members of a room, the latest list the server sent.
+        self.members = []
+        # Whether the latest messages of a room have been loaded since joining it.
+        self.loaded = False
+        # Whether a page of older messages has been asked for and not arrived yet.
+        self.history_pending = False
+
+
+class ConversationManager(object):
+    """
+    Every conversation of the client, keyed by kind and name, so the
+    commands from the server find theirs with one dict lookup. Each keeps
+    up to limit lines as new ones arrive. on_unread(conversation) is called
+    when the unread count of a conversation changes.
+
+    With a MessageCache every line is also written to it, and restore()
+    brings back the conversations it holds.
+    """
+
+    def __init__(self, limit=1000, on_unread=None, cache=None):
+        self.limit = limit
+        self.on_unread = on_unread
+        self.cache = cache
+        self.conversations = {}
+
+    def restore(self):
+        """ Loads the conversations kept in the cache, returns them """
+        restored = []
+        if self.cache is not None:
+            for kind, name in self.cache.conversations():
+                conversation = self.get(kind, name)
+                message_ids, lines = self.cache.load(kind, name)
+                conversation.model.replace(lines, message_ids)
+                restored.append(conversation)
+        return restored
+
+    def get(self, kind, name):
+        """ Gets a conversation, starting it if there is none yet """
+        conversation = self.conversations.get((kind, name))
+        if conversation is None:
+            conversation = Conversation(kind, name, self.limit)
+            self.conversations[(kind, name)] = conversation
+        return conversation
+
+    def find(self, kind, name):
+        """ Gets a conversation, or None when there is none """
+        return self.conversations.get((kind, name))
+
+    def unread(self, kind, name):
+        conversation = self.conversations.get((kind, name))
+        return conversation.unread if conversation is not None else 0
+
+    def add_line(self, kind, name, line, line_id=0, unread=True):
+        """ Adds a new line to the end of a conversation, counting it as unread unless it is shown """
+        conversation = self.get(kind, name)
+        conversation.model.append(line, line_id)
+        if self.cache is not None:
+            self.cache.add(kind, name, [line_id], [line])
+        if unread and not conversation.shown:
+            conversation.unread += 1
+            self.unread_changed(conversation)
+        return conversation
+
+    def add_history(self, room_name, before_id, message_ids, messages, after_id=0):
+        """
+        Adds a page of a room's messages from the server: the ones after
+        after_id that were missed, a page of older ones, or the latest ones
+        when both are 0, which replace what the room had.
+        """
+        conversation = self.get(ROOM, room_name)
+        # Every request is answered, with an empty page when the room can not be read.
+        conversation.history_pending = False
+        if after_id > 0:
+            for message_id, message in zip(message_ids, messages):
+                if message_id > conversation.model.newest_id():
+                    self.add_line(ROOM, room_name, message, message_id)
+            conversation.loaded = True
+        elif before_id == 0:
+            conversation.model.replace(messages, message_ids)
+            if self.cache is not None:
+                self.cache.replace(ROOM, room_name, message_ids, messages)
+            conversation.loaded = True
+        else:
+            conversation.model.prepend(messages, message_ids)
+            if self.cache is not None:
+                self.cache.add(ROOM, room_name, message_ids, messages)
+        return conversation
+
+    def commit(self):
+        """ Writes the lines added since the last commit to the cache """
+        if self.cache is not None:
+            self.cache.commit()
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
+    def set_shown(self, conversation, shown):
+        """ Marks whether a window shows a conversation, showing it reads every line """
+        conversation.shown = shown
+        if shown and conversation.unread:
+            conversation.unread = 0
+            self.unread_changed(conversation)
+
+    def remove(self, kind, name):
+        """ Forgets a conversation and its lines, for a room the server no longer has """
+        if self.cache is not None:
+            self.cache.remove(kind, name)
+        conversation = self.conversations.pop((kind, name), None)
+        if conversation is not None and conversation.unread:
+            conversation.unread = 0
+            self.unread_changed(conversation)
+
+    def unread_changed(self, conversation):
+        if self.on_unread is not None:
+            self.on_unread(conversation)
@@ -0,0 +1,253 @@
+import bisect
+import collections
+import os
+import struct
+
+from records import read_records, truncate_torn
+
+
+class Message(object):
+    """ A message that was sent to a conversation """
+    __slots__ = ("id", "sender", "time", "text")
+
+    def __init__(self, message_id, sender, time, text):
+        self.id = message_id
+        self.sender = sender
+        self.time = time
+        self.text = text
+
+    def __repr__(self):
+        return repr((self.id, self.sender, self.time, self.text))
+
+
+class SegmentIndex(object):
+    """
+    Where every stride-th message of a segment file starts, so a page is
+    read from close to where it is instead of from the start of the file.
+    A stride of the file is the messages from one entry to the next.
+    """
+    __slots__ = ("stride", "ids", "offsets", "count", "end")
+
+    def __init__(self, stride):
+        self.stride = stride
+        self.ids = []
+        self.offsets = []
+        # Messages indexed and where the last one ends.
+        self.count = 0
+        self.end = 0
+
+    def add(self, message_id, offset, size):
+        if self.count % self.stride == 0:
+            self.ids.append(message_id)
+            self.offsets.append(offset)
+        self.count += 1
+        self.end = offset + size
+
+    # Gets where a stride starts and ends in the file.
+    def bounds(self, entry):
+        return self.offsets[entry], self.offsets[entry + 1] if entry + 1 < len(self.offsets) else self.end
+
+
+class Conversation(object):
+    """ The latest messages and the segment files of one conversation """
+    __slots__ = ("directory", "recent", "segments", "indexes", "last_id", "file", "file_size")
+
+    def __init__(self, directory, memory_limit):
+        self.directory = directory
+        self.recent = collections.deque(maxlen=memory_limit)
+        self.segments = []  # id of the first message in each segment file, ascending
+        self.indexes = {}  # id of the first message in a segment file -> SegmentIndex
+        self.last_id = 0
+        self.file = None
+        self.file_size = 0
+
+    def segment_path(self, first_id):
+        return os.path.join(self.directory, f'{first_id:020d}.seg')
+
+
+class MessageStore(object):
+    """
+    Bounded message history for every conversation.
+
+    The latest memory_limit messages of an open conversation are kept in a
+    ring buffer, so the page sent when someone joins never touches the disk.
+    Every message is also appended to a log of segment files, a new one
+    being started every segment_size bytes. Older pages are read from the
+    segments through mmap, starting from the nearest of every index_stride-th
+    message, whose offsets are kept for every segment once it is read.
+
+    A record is (length, id, time, sender length) followed by the UTF-8
+    sender and text. Message ids start at 1 and grow by one in every
+    conversation.
+    """
+    RECORD = struct.Struct("!IQdH")
+
+    def __init__(self, directory, memory_limit=200, segment_size=4 * 1024 * 1024, index_stride=64):
+        self.directory = directory
+        self.memory_limit = memory_limit
+        self.segment_size = segment_size
+        self.index_stride = index_stride
+        self.conversations = {}
+        os.makedirs(directory, exist_ok=True)
+
+    # Gets the keys of every conversation that has a log on disk.
+    def keys(self):
+        return [key for key in os.listdir(self.directory)
+                if os.path.isdir(os.path.join(self.directory, key))]
+
+    def open(self, key):
+        """ Returns the conversation, loading its latest messages from disk the first time """
+        conversation = self.conversations.get(key)
+        if conversation is not None:
+            return conversation
+
+        conversation = Conversation(os.path.join(self.directory, key), self.memory_limit)
+        os.makedirs(conversation.directory, exist_ok=True)
+        conversation.segments = sorted(int(name.split('.')[0]) for name in os.listdir(conversation.directory)
+                                       if name.endswith('.seg'))
+        if conversation.segments:
+            first_id = conversation.segments[-1]
+            truncate_torn(conversation.segment_path(first_id), self.segment_index(conversation, first_id).end)
+        messages = self.read_before(conversation, None, self.memory_limit)
+        conversation.recent.extend(messages)
+        if messages:
+            conversation.last_id = messages[-1].id
+        self.conversations[key] = conversation
+        return conversation
+
+    # Releases the memory and the file of a conversation nobody is using.
+    def close(self, key):
+        conversation = self.conversations.pop(key, None)
+        if conversation is not None and conversation.file is not None:
+            conversation.file.close()
+
+    def close_all(self):
+        for key in list(self.conversations):
+            self.close(key)
+
+    def append(self, key, sender, time, text, after_id=0):
+        """
+        Stores a message and returns its id, which is above after_id when
+        the conversation was continued from somewhere else.
+        """
+        # Encoded first, so text that is not valid UTF-8 raises before anything is stored.
+        sender_data = sender.encode()
+        text_data = text.encode()
+        size = self.RECORD.size + len(sender_data) + len(text_data)
+
+        conversation = self.open(key)
+        message = Message(max(conversation.last_id, after_id) + 1, sender, time, text)
+        conversation.last_id = message.id
+        conversation.recent.append(message)
+
+        if conversation.file is None or conversation.file_size + size > self.segment_size:
+            self.start_segment(conversation, message.id)
+        conversation.file.write(self.RECORD.pack(size, message.id, time, len(sender_data)))
+        conversation.file.write(sender_data)
+        conversation.file.write(text_data)
+        conversation.file.flush()
+        self.segment_index(conversation, conversation.segments[-1]).add(message.id, conversation.file_size, size)
+        conversation.file_size += size
+        return message.id
+
+    def start_segment(self, conversation, first_id):
+        if conversation.file is not None:
+            conversation.file.close()
+        # Keep appending to the last segment after a restart while it has room.
+        if conversation.file is None and conversation.segments:
+            path = conversation.segment_path(conversation.segments[-1])
+            if os.path.getsize(path) < self.segment_size:
+                conversation.file = open(path, 'ab')
+                conversation.file_size = os.path.getsize(path)
+                return
+        conversation.segments.append(first_id)
+        conversation.indexes[first_id] = SegmentIndex(self.index_stride)
+        conversation.file = open(conversation.segment_path(first_id), 'ab')
+        conversation.file_size = 0
+
+    def page(self, key, before_id=0, limit=50):
+        """
+        Returns up to limit messages older than before_id, oldest first.
+        A before_id of 0 gets the latest messages.
+        """
+        conversation = self.open(key)
+        recent = conversation.recent
+        if before_id <= 0:
+            before_id = conversation.last_id + 1
+        if recent and recent[0].id < before_id:
+            # The ring buffer holds every message from recent[0].id onwards,
+            # and all of them until it first fills up.
+            count = bisect.bisect_left(recent, before_id, key=lambda message: message.id)
+            if count >= limit or len(recent) < recent.maxlen:
+                start = max(0, count - limit)
+                return [recent[i] for i in range(start, count)]
+        return self.read_before(conversation, before_id, limit)
+
+    def since(self, key, after_id, limit=50):
+        """ Returns up to limit messages newer than after_id, oldest first """
+        conversation = self.open(key)
+        recent = conversation.recent
+        if after_id >= conversation.last_id:
+            return []
+        if recent and recent[0].id <= after_id + 1:
+            start = bisect.bisect_right(recent, after_id, key=lambda message: message.id)
+            return [recent[i] for i in range(start, min(len(recent), start + limit))]
+        return self.read_after(conversation, after_id, limit)
+
+    def last_id(self, key):
+        return self.open(key).last_id
+
+    def read_before(self, conversation, before_id, limit):
+        """ Reads up to limit messages older than before_id from the segments, a stride at a time """
+        messages = []
+        end = len(conversation.segments)
+        if before_id is not None:
+            end = bisect.bisect_left(conversation.segments, before_id)
+        for first_id in reversed(conversation.segments[:end]):
+            path = conversation.segment_path(first_id)
+            segment = self.segment_index(conversation, first_id)
+            # The stride before_id is in, then the ones before it.
+            entry = len(segment.ids) if before_id is None else bisect.bisect_left(segment.ids, before_id)
+            for entry in range(entry - 1, -1, -1):
+                found = [message for message in self.read_stride(path, segment, entry)
+                         if before_id is None or message.id < before_id]
+                messages[:0] = found[-(limit - len(messages)):]
+                if len(messages) >= limit:
+                    return messages
+        return messages
+
+    def read_after(self, conversation, after_id, limit):
+        """ Reads up to limit messages newer than after_id from the segments, a stride at a time """
+        messages = []
+        start = max(0, bisect.bisect_right(conversation.segments, after_id) - 1)
+        for first_id in conversation.segments[start:]:
+            path = conversation.segment_path(first_id)
+            segment = self.segment_index(conversation, first_id)
+            # The stride after_id is in, then the ones after it.
+            entry = max(0, bisect.bisect_right(segment.ids, after_id) - 1)
+            for entry in range(entry, len(segment.ids)):
+                messages.extend(message for message in self.read_stride(path, segment, entry)
+                                if message.id > after_id)
+                if len(messages) >= limit:
+                    return messages[:limit]
+        return messages
+
+    def segment_index(self, conversation, first_id):
+        """ Gets the index of a segment, reading the headers of its records the first time """
+        segment = conversation.indexes.get(first_id)
+        if segment is None:
+            segment = conversation.indexes[first_id] = SegmentIndex(self.index_stride)
+            path = conversation.segment_path(first_id)
+            for (size, message_id, time, sender_size), body, end in read_records(path, self.RECORD):
+                segment.add(message_id, end - size, size)
+        return segment
+
+    def read_stride(self, path, segment, entry):
+        """ Reads the messages of one stride of a segment """
+        start, stop = segment.bounds(entry)
+        messages = []
+        for (size, message_id, time, sender_size), body, end in read_records(path, self.RECORD, start, stop):
+            sender = str(body[:sender_size], 'utf-8')
+            text = str(body[sender_size:], 'utf-8')
+            messages.append(Message(message_id, sender, time, text))
+        return messages
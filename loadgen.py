@@ -0,0 +1,291 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import ssl
+import subprocess
+import sys
+import time
+
+from utils import *
+
+
+class HeadlessClient(object):
+    """
+    A chat client without a GUI, speaking the same protocol as client.py.
+    Every command from the server is passed to on_command(client, command, args).
+    """
+
+    def __init__(self, name, on_command=None, login_options=None):
+        self.name = name
+        self.on_command = on_command
+        self.login_options = login_options or {}
+        self.stream = None
+        self.reader = None
+        self.clients = []
+        self.rooms = []
+        self.connected = asyncio.Event()
+
+    async def connect(self, host, port, context):
+        loop = asyncio.get_running_loop()
+        transport, self.stream = await loop.create_connection(FrameStream, host, port, ssl=context,
+                                                              server_hostname=host)
+        self.send("LOGIN", self.name, self.login_options)
+        self.reader = loop.create_task(self.read())
+        await self.connected.wait()
+
+    async def read(self):
+        while True:
+            command, args = await self.stream.receive_command()
+            if not command:
+                break
+            if command == "PING":
+                self.send("PONG")
+            elif command == "CLIENT_LIST":
+                self.clients = list(args[0])
+                self.connected.set()
+            elif command == "UPDATE_ROOMS_LIST":
+                self.rooms = list(args[0])
+            if self.on_command is not None:
+                self.on_command(self, command, args)
+        self.connected.set()
+
+    def send(self, command, *args):
+        self.stream.write(pack_command(command, *args))
+
+    def send_message(self, username, message):
+        self.send("MESSAGE", username, message)
+
+    def create_room(self):
+        self.send("CREATE_ROOM")
+
+    def invite(self, room_name, username):
+        self.send("INVITE", room_name, username)
+
+    def join_room(self, room_name):
+        self.send("JOIN_ROOM", room_name)
+
+    def send_group_message(self, room_name, message):
+        self.send("GROUP_MESSAGE", room_name, message)
+
+    async def close(self):
+        if self.stream is not None:
+            self.stream.close()
+        if self.reader is not None:
+            await self.reader
+
+
+class LoadGenerator(object):
+    """
+    Simulates users that create rooms, invite each other and send one to one
+    and group messages at a fixed rate, and measures how long every message
+    takes to reach each of its recipients.
+
+    Each message carries the monotonic time it was sent at, so the latency
+    is only meaningful while the users all run in this process.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.context.load_verify_locations('cert.pem')
+        self.context.check_hostname = False
+
+        self.users = []
+        self.rooms = {}  # room name -> member names
+        self.created_rooms = asyncio.Queue()
+        self.latencies = []
+        self.sent = {"MESSAGE": 0, "GROUP_MESSAGE": 0}
+        self.delivered = {"MESSAGE": 0, "GROUP_MESSAGE": 0}
+        self.errors = 0
+        self.throttled = 0
+        self.measuring = False
+
+    def on_command(self, client, command, args):
+        if command == "CREATE_ROOM":
+            self.created_rooms.put_nowait((client, args[0]))
+        elif command == "THROTTLED":
+            self.throttled += 1
+        elif command == "MESSAGE" or command == "GROUP_MESSAGE":
+            line = args[1] if command == "GROUP_MESSAGE" else args[0]
+            if line.startswith("Me ("):
+                return
+            text = line.split("): ", 1)[1]
+            if not text.startswith("LG "):
+                return
+            marker, sender, sent_at = text.split(" ", 3)[:3]
+            if sender == client.name or not self.measuring:
+                return
+            self.latencies.append(time.monotonic_ns() - int(sent_at))
+            self.delivered[command] += 1
+
+    async def connect_users(self):
+        semaphore = asyncio.Semaphore(self.options.connect_concurrency)
+
+        async def connect(client):
+            async with semaphore:
+                try:
+                    await client.connect(self.options.host, self.options.port, self.context)
+                except (OSError, ssl.SSLError):
+                    self.errors += 1
+
+        login_options = {"flush_delay": self.options.flush_delay, "nodelay": not self.options.nagle,
+                         "compression": self.options.compression}
+        self.users = [HeadlessClient(f'{self.options.prefix}{i}', self.on_command, login_options)
+                      for i in range(self.options.users)]
+        started = time.monotonic()
+        await asyncio.gather(*(connect(client) for client in self.users))
+        self.users = [client for client in self.users if client.stream is not None]
+        return time.monotonic() - started
+
+    async def create_rooms(self):
+        names = [client.name for client in self.users]
+        for i in range(min(self.options.rooms, len(self.users))):
+            self.users[i].create_room()
+        for i in range(min(self.options.rooms, len(self.users))):
+            owner, room_name = await asyncio.wait_for(self.created_rooms.get(), 30)
+            others = [name for name in names if name != owner.name]
+            members = random.sample(others, min(self.options.room_size - 1, len(others)))
+            for name in members:
+                owner.invite(room_name, name)
+            self.rooms[room_name] = [owner.name] + members
+
+    def user_rooms(self):
+        rooms = {}
+        for room_name, members in self.rooms.items():
+            for name in members:
+                rooms.setdefault(name, []).append(room_name)
+        return rooms
+
+    async def run_user(self, client, rooms, deadline):
+        names = [user.name for user in self.users if user is not client]
+        interval = 1 / self.options.rate
+        # Spread the users out so they do not all send at once.
+        await asyncio.sleep(random.random() * interval)
+        while time.monotonic() < deadline:
+            text = f'LG {client.name} {time.monotonic_ns()}'
+            if rooms and random.random() < self.options.group_ratio:
+                client.send_group_message(random.choice(rooms), text)
+                self.sent["GROUP_MESSAGE"] += 1
+            elif names:
+                client.send_message(random.choice(names), text)
+                self.sent["MESSAGE"] += 1
+            await asyncio.sleep(random.expovariate(1 / interval))
+
+    async def run(self):
+        connect_time = await self.connect_users()
+        await self.create_rooms()
+        # Let the invites settle before measuring.
+        await asyncio.sleep(1)
+
+        rooms = self.user_rooms()
+        self.measuring = True
+        started = time.monotonic()
+        deadline = started + self.options.duration
+        await asyncio.gather(*(self.run_user(client, rooms.get(client.name, []), deadline)
+                               for client in self.users))
+        await asyncio.sleep(self.options.drain)
+        elapsed = time.monotonic() - started
+        self.measuring = False
+
+        for client in self.users:
+            await client.close()
+        return self.report(connect_time, elapsed)
+
+    def report(self, connect_time, elapsed):
+        latencies = sorted(self.latencies)
+
+        def percentile(fraction):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] / 1e6
+
+        delivered = sum(self.delivered.values())
+        return {
+            "config": {key: value for key, value in vars(self.options).items()
+                       if key not in ("output", "baseline", "spawn_server")},
+            "connected_users": len(self.users),
+            "connect_errors": self.errors,
+            "connect_seconds": connect_time,
+            "sent": self.sent,
+            "delivered": self.delivered,
+            "throttled": self.throttled,
+            "deliveries_per_second": delivered / elapsed if elapsed else 0,
+            "latency_ms": {
+                "p50": percentile(0.50),
+                "p99": percentile(0.99),
+                "p999": percentile(0.999),
+                "max": latencies[-1] / 1e6 if latencies else None,
+            },
+        }
+
+
+def compare(result, baseline, tolerance):
+    """ Prints the change from a previous run, returns False when it got worse """
+    ok = True
+    checks = (("deliveries_per_second", result["deliveries_per_second"], baseline["deliveries_per_second"], True),
+              ("p99 latency ms", result["latency_ms"]["p99"], baseline["latency_ms"]["p99"], False))
+    for label, new, old, higher_is_better in checks:
+        if new is None or not old:
+            continue
+        change = (new - old) / old
+        worse = change < -tolerance if higher_is_better else change > tolerance
+        print(f'{label}: {old:.2f} -> {new:.2f} ({change:+.1%}){"  REGRESSION" if worse else ""}')
+        ok = ok and not worse
+    return ok
+
+
+async def main(options):
+    server = None
+    if options.spawn_server:
+        server = subprocess.Popen([sys.executable, "server.py", "--port", str(options.port),
+                                   "--history-directory", options.spawn_server,
+                                   "--state-directory", os.path.join(options.spawn_server, "state"),
+                                   "--workers", str(options.workers)],
+                                  stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+        await asyncio.sleep(1)
+    try:
+        return await LoadGenerator(options).run()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load generator for the chat server")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=9988)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--rooms", type=int, default=50)
+    parser.add_argument("--room-size", type=int, default=20)
+    parser.add_argument("--rate", type=float, default=0.5, help="messages per second sent by each user")
+    parser.add_argument("--group-ratio", type=float, default=0.5, help="share of messages sent to a room")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--drain", type=float, default=2, help="seconds to wait for the last deliveries")
+    parser.add_argument("--connect-concurrency", type=int, default=100)
+    parser.add_argument("--prefix", default="user", help="prefix of the simulated user names")
+    parser.add_argument("--flush-delay", type=float, default=0,
+                        help="seconds the server gathers frames for each user before writing them")
+    parser.add_argument("--nagle", action="store_true", help="ask the server to leave Nagle's algorithm on")
+    parser.add_argument("--compression", nargs="*", default=PREFERRED_COMPRESSIONS, metavar="NAME",
+                        help="compressions the users accept, in order, none when given without names")
+    parser.add_argument("--spawn-server", metavar="HISTORY_DIRECTORY",
+                        help="start a local server.py on --port, keeping its history in this directory")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes of the spawned server")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    options = parser.parse_args()
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    result = asyncio.run(main(options))
+    print(json.dumps(result, indent=2))
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(result, output, indent=2)
+    if options.baseline:
+        with open(options.baseline) as baseline:
+            if not compare(result, json.load(baseline), options.tolerance):
+                sys.exit(1)
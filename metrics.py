@@ -0,0 +1,162 @@
+import bisect
+
+
+def format_labels(labels, extra=None):
+    items = list(labels.items())
+    if extra is not None:
+        items.append(extra)
+    if not items:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in items) + '}'
+
+
+class Counter(object):
+    """ A count of events that only goes up """
+    kind = "counter"
+
+    def __init__(self, name, description="", labels=None):
+        self.name = name
+        self.description = description
+        self.labels = labels or {}
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name + format_labels(self.labels), self.value
+
+    def summary(self):
+        return f'{self.name}{format_labels(self.labels)} {self.value}'
+
+
+class Gauge(Counter):
+    """ A value that goes up and down, read from function when it is given """
+    kind = "gauge"
+
+    def __init__(self, name, description="", labels=None, function=None):
+        super().__init__(name, description, labels)
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        if self.function is not None:
+            self.value = self.function()
+        return super().samples()
+
+    def summary(self):
+        if self.function is not None:
+            self.value = self.function()
+        return super().summary()
+
+
+class Histogram(object):
+    """
+    Counts observations in buckets with the given upper bounds, the way a
+    Prometheus histogram does. Quantiles are estimated from the buckets, so
+    recording a value costs a bisect and nothing is kept per observation.
+    Observations are in seconds unless unit says otherwise.
+    """
+    kind = "histogram"
+    DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                       0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, description="", labels=None, buckets=DEFAULT_BUCKETS, unit="seconds"):
+        self.name = name
+        self.description = description
+        self.labels = labels or {}
+        self.buckets = tuple(buckets)
+        self.unit = unit
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is above every bucket
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """ Estimates the value below which a fraction q of the observations fall """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                if index == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def samples(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield self.name + '_bucket' + format_labels(self.labels, ('le', bound)), total
+        yield self.name + '_bucket' + format_labels(self.labels, ('le', '+Inf')), self.count
+        yield self.name + '_sum' + format_labels(self.labels), self.sum
+        yield self.name + '_count' + format_labels(self.labels), self.count
+
+    def summary(self):
+        name = self.name + format_labels(self.labels)
+        if self.count == 0:
+            return f'{name} count=0'
+        if self.unit == "seconds":
+            return (f'{name} count={self.count} mean={self.sum / self.count * 1000:.2f}ms '
+                    f'p50={self.quantile(0.5) * 1000:.2f}ms p99={self.quantile(0.99) * 1000:.2f}ms')
+        return (f'{name} count={self.count} mean={self.sum / self.count:.1f} '
+                f'p50={self.quantile(0.5):.1f} p99={self.quantile(0.99):.1f}')
+
+
+class Registry(object):
+    """
+    Every metric of the process. Metrics are made once up front and kept
+    by whoever records them, so recording never looks anything up.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, description="", **labels):
+        return self.add(Counter(name, description, labels))
+
+    def gauge(self, name, description="", function=None, **labels):
+        return self.add(Gauge(name, description, labels, function))
+
+    def histogram(self, name, description="", buckets=Histogram.DEFAULT_BUCKETS, unit="seconds", **labels):
+        return self.add(Histogram(name, description, labels, buckets, unit))
+
+    def render(self):
+        """ Gets every metric in the Prometheus text format """
+        lines = []
+        described = set()
+        for metric in sorted(self.metrics, key=lambda metric: metric.name):
+            if metric.name not in described:
+                described.add(metric.name)
+                lines.append(f'# HELP {metric.name} {metric.description}')
+                lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, value in metric.samples():
+                lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """ Gets a line for every metric that has recorded something """
+        lines = []
+        for metric in self.metrics:
+            recorded = metric.count if metric.kind == "histogram" else metric.value
+            if recorded or metric.kind == "gauge":
+                lines.append(metric.summary())
+        return lines
+
+
+# The metrics of this process.
+REGISTRY = Registry()
@@ -0,0 +1,126 @@
+import difflib
+
+from PyQt5.QtCore import QAbstractListModel, QModelIndex, Qt
+
+
+class StringListModel(QAbstractListModel):
+    """
+    A list of strings for a QListView. set_items() works out which rows were
+    inserted, removed or changed and only tells the view about those, so an
+    update of a long list redraws little and keeps the selection and the
+    scroll position.
+    """
+
+    def __init__(self, items=(), parent=None):
+        super().__init__(parent)
+        self.items = list(items)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.items)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and index.isValid():
+            return self.items[index.row()]
+        return None
+
+    def set_items(self, items):
+        items = list(items)
+        matcher = difflib.SequenceMatcher(None, self.items, items, autojunk=False)
+        # Applied from the end, so the rows of the earlier changes stay where they were.
+        for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+            if tag == 'equal':
+                continue
+            if tag == 'replace' and i2 - i1 == j2 - j1:
+                self.items[i1:i2] = items[j1:j2]
+                self.dataChanged.emit(self.index(i1), self.index(i2 - 1))
+                continue
+            if i2 > i1:
+                self.beginRemoveRows(QModelIndex(), i1, i2 - 1)
+                del self.items[i1:i2]
+                self.endRemoveRows()
+            if j2 > j1:
+                self.beginInsertRows(QModelIndex(), i1, i1 + j2 - j1 - 1)
+                self.items[i1:i1] = items[j1:j2]
+                self.endInsertRows()
+
+    def set_item(self, row, item):
+        self.items[row] = item
+        self.dataChanged.emit(self.index(row), self.index(row))
+
+    def append(self, item):
+        row = len(self.items)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.items.append(item)
+        self.endInsertRows()
+
+    def remove(self, item):
+        if item in self.items:
+            self.remove_row(self.items.index(item))
+
+    def remove_row(self, row):
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self.items[row]
+        self.endRemoveRows()
+
+
+class ScrollbackModel(QAbstractListModel):
+    """
+    The lines of a chat, oldest first, with the id of each line (0 when it
+    has none). New lines go at the end and once there are more than limit
+    the oldest are dropped. Paging older lines back in with prepend() raises
+    the limit to the lines held then, until the chat is cleared, so the page
+    the user asked for is not dropped straight away.
+    """
+
+    def __init__(self, limit=1000, parent=None):
+        super().__init__(parent)
+        self.limit = limit
+        self.kept = limit
+        self.lines = []
+        self.ids = []
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.lines)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and index.isValid():
+            return self.lines[index.row()]
+        return None
+
+    def oldest_id(self):
+        return self.ids[0] if self.ids else 0
+
+    def newest_id(self):
+        return self.ids[-1] if self.ids else 0
+
+    def append(self, line, line_id=0):
+        row = len(self.lines)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.lines.append(line)
+        self.ids.append(line_id)
+        self.endInsertRows()
+        if len(self.lines) > self.kept:
+            extra = len(self.lines) - self.kept
+            self.beginRemoveRows(QModelIndex(), 0, extra - 1)
+            del self.lines[:extra]
+            del self.ids[:extra]
+            self.endRemoveRows()
+
+    def prepend(self, lines, ids):
+        if not lines:
+            return
+        self.beginInsertRows(QModelIndex(), 0, len(lines) - 1)
+        self.lines[:0] = lines
+        self.ids[:0] = ids
+        self.endInsertRows()
+        self.kept = max(self.limit, len(self.lines))
+
+    def replace(self, lines, ids):
+        self.beginResetModel()
+        self.lines = list(lines[-self.limit:])
+        self.ids = list(ids[-self.limit:])
+        self.kept = self.limit
+        self.endResetModel()
+
+    def clear(self):
+        self.replace([], [])
@@ -0,0 +1,43 @@
+import time
+
+
+class RateLimit(object):
+    """
+    The rate and burst of a kind of token bucket. Buckets keep a reference
+    to their limit, so changing it applies to every bucket at once.
+    A rate of 0 turns the limit off.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+
+    def __repr__(self):
+        return f'{self.rate:g}/s burst {self.burst:g}' if self.rate > 0 else 'off'
+
+
+class TokenBucket(object):
+    """
+    Holds up to limit.burst tokens and gains limit.rate of them every second.
+    Every command takes a token, so a client can send a burst at once and
+    then keeps to the rate.
+    """
+    __slots__ = ("limit", "tokens", "updated")
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.tokens = limit.burst
+        self.updated = time.monotonic()
+
+    def wait(self):
+        """ Seconds until a token is free, 0 when one is free now """
+        if self.limit.rate <= 0:
+            return 0
+        now = time.monotonic()
+        self.tokens = min(self.limit.burst, self.tokens + (now - self.updated) * self.limit.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.limit.rate
+
+    def take(self):
+        if self.limit.rate > 0:
+            self.tokens -= 1
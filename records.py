@@ -0,0 +1,36 @@
+import mmap
+import os
+
+
+def read_records(path, header, start=0, stop=None):
+    """
+    Yields (fields, body, end) for every record of a file of length prefixed
+    records. header is the Struct each record starts with, its first field
+    the size of the whole record, body is the rest of the record and end is
+    where it ends in the file. Reading starts at start, which must be where
+    a record starts, and ends before stop.
+
+    A record cut short by a crash ends the file, everything before it is
+    intact, so the end of the last record read is where to truncate to.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offset = start
+            limit = len(data) if stop is None else min(stop, len(data))
+            while offset + header.size <= limit:
+                fields = header.unpack_from(data, offset)
+                size = fields[0]
+                if size < header.size or offset + size > limit:
+                    break
+                yield fields, data[offset + header.size:offset + size], offset + size
+                offset += size
+
+
+def truncate_torn(path, end):
+    """ Drops what follows the last intact record, a record that a crash left half written """
+    if os.path.exists(path) and end < os.path.getsize(path):
+        os.truncate(path, end)
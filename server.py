@@ -1,68 +1,522 @@
-import select
+import argparse
+import asyncio
+import collections
+import multiprocessing
+import secrets
 import socket
 import sys
 import signal
 import ssl
+import tempfile
+import time
 
 from utils import *
+from cluster import ClusterBus, WorkerBus
+from history import MessageStore
+from metrics import REGISTRY
+from ratelimit import RateLimit, TokenBucket
+from state import StateStore, gc_paused
 from datetime import datetime
 
 SERVER_HOST = 'localhost'
 
+# Number of extra frames that follow each command sent by a version 1 client.
+LEGACY_ARGUMENTS = {
+    "MESSAGE": 2,
+    "JOIN_ROOM": 1,
+    "UPDATE_INVITE_WINDOW": 1,
+    "INVITE": 2,
+    "GROUP_MESSAGE": 2,
+}
+
+# Number of arguments version 1 clients read for the commands that have grown more.
+LEGACY_REPLY_ARGUMENTS = {
+    "MESSAGE": 1,
+    "JOIN_ROOM": 1,
+    "UPDATE_INVITE_WINDOW": 1,
+    "UPDATE_ROOMS_LIST": 1,
+    "GROUP_MESSAGE": 2,
+}
+
+# Messages sent when joining a room, and the most a client can ask for at once.
+HISTORY_PAGE = 50
+HISTORY_PAGE_LIMIT = 200
+# The longest a client may ask for its frames to be held back, in seconds.
+MAX_FLUSH_DELAY = 0.05
+
+
+# Metrics recorded on the hot paths. They are made up front, one per command
+# where it matters, so recording is an addition and nothing is looked up.
+FRAMES_RECEIVED = {command: REGISTRY.counter("chat_frames_received_total", "Commands received from clients",
+                                             command=command) for command in COMMANDS}
+FRAMES_SENT = {command: REGISTRY.counter("chat_frames_sent_total", "Commands sent to clients", command=command)
+               for command in COMMANDS}
+BYTES_RECEIVED = REGISTRY.counter("chat_received_bytes_total", "Bytes of frames received from clients")
+BYTES_SENT = REGISTRY.counter("chat_sent_bytes_total", "Bytes of frames sent to clients")
+DECODE_SECONDS = REGISTRY.counter("chat_decode_seconds_total", "Time spent decoding frames")
+ENCODE_SECONDS = REGISTRY.counter("chat_encode_seconds_total", "Time spent encoding frames")
+FAN_OUT = REGISTRY.histogram("chat_fan_out_clients", "Clients a group message or presence change went to",
+                             buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000), unit="clients")
+CONNECTIONS = REGISTRY.counter("chat_connections_total", "Connections accepted")
+LOOP_LAG = REGISTRY.histogram("chat_loop_lag_seconds", "How late the event loop woke up a timer")
+HANDSHAKE_SECONDS = REGISTRY.histogram("chat_tls_handshake_seconds", "Time taken by TLS handshakes")
+HANDSHAKE_WAIT_SECONDS = REGISTRY.histogram("chat_tls_handshake_wait_seconds",
+                                            "Time connections waited for a handshake slot")
+HANDSHAKES_RESUMED = REGISTRY.counter("chat_tls_handshakes_resumed_total", "Handshakes that resumed a session")
+HANDSHAKES_FAILED = REGISTRY.counter("chat_tls_handshakes_failed_total", "Handshakes that failed or timed out")
+RATE_LIMITED = {(limit, action): REGISTRY.counter("chat_rate_limited_total", "Commands that went over a rate limit",
+                                                  limit=limit, action=action)
+                for limit in ("client", "room") for action in ("delayed", "dropped", "disconnected")}
+CLIENTS_REAPED = REGISTRY.counter("chat_clients_reaped_total", "Clients disconnected for not answering pings")
+SESSIONS_RESUMED = REGISTRY.counter("chat_sessions_resumed_total", "Clients that reconnected and resumed their session")
+OUTBOUND_OVERFLOWS = {action: REGISTRY.counter("chat_outbound_overflows_total",
+                                               "Frames that did not fit in the outbound queue of a client",
+                                               action=action)
+                      for action in ("drop", "disconnect")}
+
+
+def create_server_context():
+    """
+    The TLS context of the server. OpenSSL sends session tickets by default,
+    and workers forked after the context is created share its ticket keys,
+    so a client can resume its TLS session on any of them.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile="cert.pem", keyfile="cert.pem")
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class Session(object):
+    """ A logged in client and the connection it is using """
+    __slots__ = ("stream", "address", "name", "full_name", "time", "legacy", "codec", "compression", "bucket",
+                 "last_seen", "idle_timer", "token", "replay", "replay_bytes", "replay_limit", "sent", "expiry")
+
+    def __init__(self, stream, address, name, time, legacy=False, codec=DEFAULT_CODEC, compression=None):
+        self.stream = stream
+        self.address = address
+        self.name = name
+        self.full_name = '@'.join((name, address[0]))
+        self.time = time
+        self.legacy = legacy
+        self.codec = codec
+        # How large frames for the client are compressed, None to send them as they are.
+        self.compression = compression
+        # Rate limits the commands of the client.
+        self.bucket = None
+        # Loop time the client last sent something, and the timer that checks it is still there.
+        self.last_seen = 0
+        self.idle_timer = None
+        # What the client resumes the session with after losing its connection, the latest
+        # frames sent to it, how many were sent and the timer that ends the session meanwhile.
+        self.token = None
+        self.replay = None
+        self.replay_bytes = 0
+        self.replay_limit = 0
+        self.sent = 0
+        self.expiry = None
+
+    def __repr__(self):
+        return repr((self.address, self.name, self.time))
+
+    # Keeps up to limit bytes of the latest frames sent from now on, so they can be sent again.
+    def keep_replay(self, limit):
+        self.replay = collections.deque()
+        self.replay_bytes = 0
+        self.replay_limit = limit
+        self.sent = 0
+
+    def replay_since(self, received):
+        """ Gets the frames sent after the first received ones, None when they are not all kept """
+        if self.replay is None:
+            return None
+        first = self.sent - len(self.replay)
+        if not first <= received <= self.sent:
+            return None
+        return list(self.replay)[received - first:]
+
+    # Gets what a frame sent to this client depends on besides the command.
+    def frame_format(self):
+        return None if self.legacy else (self.codec, self.compression)
+
+    # Encodes a command and its arguments in the format the client understands.
+    def encode(self, command, *args):
+        started = time.perf_counter()
+        if self.legacy:
+            args = args[:LEGACY_REPLY_ARGUMENTS.get(command, len(args))]
+            frame = pack_legacy(command, *args)
+        else:
+            frame = pack_command(command, *args, codec=self.codec, compression=self.compression)
+        ENCODE_SECONDS.inc(time.perf_counter() - started)
+        return frame
+
+    def send(self, command, *args):
+        frame = self.encode(command, *args)
+        FRAMES_SENT[command].inc()
+        BYTES_SENT.inc(len(frame))
+        self.write(frame)
+
+    def write(self, frame):
+        """
+        Queues an encoded frame for the client, keeping it while it may be
+        needed for a resume. A frame the stream dropped because too much was
+        queued is not counted, the client never gets it.
+        """
+        dropped = self.stream.dropped
+        self.stream.write(frame)
+        if self.replay is not None and self.stream.dropped == dropped:
+            self.sent += 1
+            self.replay.append(frame)
+            self.replay_bytes += len(frame)
+            while self.replay_bytes > self.replay_limit:
+                self.replay_bytes -= len(self.replay.popleft())
+
+
+class RemoteSession(object):
+    """ A client logged in on another worker, commands for it go through the bus """
+    __slots__ = ("peer", "name", "time")
+    stream = None
+    legacy = False
+
+    def __init__(self, peer, name, time):
+        self.peer = peer
+        self.name = name
+        self.time = time
+
+    def __repr__(self):
+        return repr((self.peer, self.name, self.time))
+
+    def send(self, command, *args):
+        self.peer.send("DELIVER", self.name, command, list(args))
+
+
+class Room(object):
+    """
+    A chat room. members maps the name of every member to their Session,
+    or to None while they are offline, in the order they joined.
+    """
+    __slots__ = ("id", "name", "members", "online", "last_message_id", "bucket")
+
+    def __init__(self, room_id, name):
+        self.id = room_id
+        self.name = name
+        self.members = {}
+        self.online = 0
+        # So a new home of the room carries on numbering its messages.
+        self.last_message_id = 0
+        # Rate limits the messages sent to the room from this worker, made on the first one.
+        self.bucket = None
+
+    # Gets the sessions of the members that are online.
+    def sessions(self):
+        return [session for session in self.members.values() if session is not None]
+
+    # Gets the key of the room in the message store.
+    def history_key(self):
+        return "room-" + str(self.id)
+
+
+class RoomRegistry(object):
+    """
+    Every chat room by name and by id, and the rooms each client is a member of.
+    A room is removed once none of its members are online.
+
+    With several workers every worker keeps a copy of every room, but each
+    room has a home worker that decides who joins it and stores its
+    messages, home(room_id) gives its index. A worker creates rooms with
+    the ids that leave its index when divided by step, so they are unique.
+
+    Every room that is added or removed and every member that joins is
+    passed on to log, a StateStore, once one is set.
+    """
+
+    def __init__(self, first_id=1, worker=0, step=1, home=None):
+        self.rooms = {}  # room name -> Room
+        self.by_id = {}  # room id -> Room
+        self.memberships = {}  # client name -> set of Rooms
+        self.worker = worker
+        self.step = step
+        self.home_of = home if home is not None else lambda room_id: worker
+        self.next_id = first_id + (worker - first_id) % step
+        self.log = None
+
+    def __iter__(self):
+        return iter(self.rooms.values())
+
+    def get(self, room_name):
+        return self.rooms.get(room_name)
+
+    # Gets the index of the worker that is the home of the room.
+    def home(self, room):
+        return self.home_of(room.id)
+
+    def is_home(self, room):
+        return self.home(room) == self.worker
+
+    def create(self, owner):
+        room = self.add(self.next_id, "Room" + str(self.next_id) + " by " + owner.name)
+        self.next_id += self.step
+        self.add_member(room, owner.name, owner)
+        return room
+
+    # Adds a room that was created by this or another worker.
+    def add(self, room_id, name):
+        room = Room(room_id, name)
+        self.rooms[room.name] = room
+        self.by_id[room.id] = room
+        if self.log is not None:
+            self.log.room_added(room)
+        return room
+
+    # Adds a saved room with all its members offline.
+    def restore(self, saved):
+        room = Room(saved.id, saved.name)
+        room.members = dict.fromkeys(saved.members)
+        room.last_message_id = saved.last_message_id
+        self.rooms[room.name] = room
+        self.by_id[room.id] = room
+        for name in room.members:
+            self.memberships.setdefault(name, set()).add(room)
+        return room
+
+    def add_member(self, room, name, session):
+        """ Returns False if the client was already a member """
+        if name in room.members:
+            return False
+        room.members[name] = session
+        if session is not None:
+            room.online += 1
+        self.memberships.setdefault(name, set()).add(room)
+        if self.log is not None:
+            self.log.member_added(room, name)
+        return True
+
+    # Points the rooms of a client that logged in at its new session.
+    def set_online(self, session):
+        for room in self.memberships.get(session.name, ()):
+            if room.members[session.name] is None:
+                room.online += 1
+            room.members[session.name] = session
+
+    def set_offline(self, name):
+        """
+        Returns the rooms that were removed because nobody in them is online.
+        Only the home worker of a room removes it.
+        """
+        removed = []
+        for room in self.memberships.get(name, ()):
+            if room.members[name] is not None:
+                room.members[name] = None
+                room.online -= 1
+            if room.online == 0 and self.is_home(room):
+                removed.append(room)
+        for room in removed:
+            self.remove(room)
+        return removed
+
+    def remove(self, room):
+        del self.rooms[room.name]
+        del self.by_id[room.id]
+        if self.log is not None:
+            self.log.room_removed(room)
+        for name in room.members:
+            rooms = self.memberships[name]
+            rooms.discard(room)
+            if not rooms:
+                del self.memberships[name]
+
 
 class ChatServer(object):
-    """ An example chat server using select """
+    """ An example chat server using asyncio, one coroutine per connection """
 
-    def __init__(self, port_number, backlog=5):
+    def __init__(self, port_number, backlog=socket.SOMAXCONN, high_water=4 * 1024 * 1024, overflow="disconnect",
+                 history_directory="history", bus=None, context=None, max_handshakes=64, handshake_timeout=10,
+                 metrics_port=None, stats_interval=60, flush_delay=0, nodelay=True, client_rate=20, client_burst=50,
+                 room_rate=100, room_burst=200, rate_policy="delay", max_delay=1, read_limit=256 * 1024,
+                 ping_interval=30, idle_timeout=90, compress=True, resume_timeout=60, resume_buffer=256 * 1024,
+                 state_directory="state", snapshot_interval=60):
+        self.port = port_number
+        # Connections the kernel holds until they are accepted, enough for a crowd logging in at once.
+        self.backlog = backlog
+        # Bytes that may be queued for a client before overflow applies,
+        # "drop" skips new frames and "disconnect" closes the client.
+        self.high_water = high_water
+        self.overflow = overflow
+        # Seconds frames for a client are gathered before they are written, and
+        # whether Nagle's algorithm is off. A client can ask for its own at login.
+        self.flush_delay = flush_delay
+        self.nodelay = nodelay
+        # Commands a second each client may send and group messages a second each room
+        # may get, past the burst. Over a limit a command is dropped, or delayed by up to
+        # max_delay seconds before it is dropped, or the client is disconnected.
+        self.client_limit = RateLimit(client_rate, client_burst)
+        self.room_limit = RateLimit(room_rate, room_burst)
+        self.rate_policy = rate_policy
+        self.max_delay = max_delay
+        # Bytes received from a client and not handled yet before reading from it stops.
+        self.read_limit = read_limit
+        # A client that sent nothing for ping_interval seconds is pinged, and one that
+        # sent nothing for idle_timeout seconds is disconnected. 0 turns it off.
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        # Whether large frames are compressed for the clients that accept it.
+        self.compress = compress
+        # Seconds a client that lost its connection stays online and can resume its
+        # session, with up to resume_buffer bytes of the frames it missed. 0 turns it off.
+        self.resume_timeout = resume_timeout
+        self.resume_buffer = resume_buffer
         self.clients = 0
-        self.client_map = {}
-        self.chat_rooms = {}
-        self.chat_rooms_count = 0
-        self.outputs = []  # list output sockets
+        self.client_map = {}  # FrameStream -> Session
+        self.sessions = {}  # client name -> Session or RemoteSession
+        self.tokens = {}  # session token -> Session
+        # The other workers sharing the port, there are none by default.
+        self.bus = bus if bus is not None else WorkerBus()
+        # Room ids are never reused, so a new room can not pick up an old history.
+        self.history = MessageStore(history_directory)
+        room_ids = [int(key.split('-')[1]) for key in self.history.keys() if key.startswith("room-")]
+        # The rooms and their members are saved as they change, and come back after a restart.
+        self.state = StateStore(state_directory, self.bus.index)
+        self.snapshot_interval = snapshot_interval
+        saved_rooms = self.state.load()
+        room_ids.extend(saved_rooms)
+        self.chat_rooms = RoomRegistry(max(room_ids, default=0) + 1, self.bus.index, self.bus.id_step, self.bus.home)
+        self.restore_rooms(saved_rooms.values())
+        self.chat_rooms.log = self.state
 
-        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        self.context.load_cert_chain(certfile="cert.pem", keyfile="cert.pem")
-        self.context.verify_mode = ssl.CERT_NONE
+        self.context = context if context is not None else create_server_context()
+        # Handshakes done at once, the rest wait so the clients already connected are not held up.
+        self.handshake_slots = asyncio.Semaphore(max_handshakes)
+        self.handshake_timeout = handshake_timeout
 
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server.bind((SERVER_HOST, port))
-        self.server.listen(backlog)
-        self.server = self.context.wrap_socket(self.server, server_side=True)
+        # Metrics are served as Prometheus text on metrics_port, and logged every stats_interval seconds.
+        self.metrics_port = metrics_port
+        self.stats_interval = stats_interval
+        REGISTRY.gauge("chat_clients", "Clients connected", lambda: len(self.client_map))
+        REGISTRY.gauge("chat_rooms", "Chat rooms", lambda: len(self.chat_rooms.rooms))
+        REGISTRY.gauge("chat_outbound_queued_bytes", "Bytes waiting to be sent to all clients",
+                       lambda: sum(stream.backlog() for stream in self.client_map))
+        REGISTRY.gauge("chat_outbound_queued_bytes_max", "Most bytes waiting to be sent to one client",
+                       lambda: max((stream.backlog() for stream in self.client_map), default=0))
+        REGISTRY.gauge("chat_inbound_paused_clients", "Clients not read from because too much is waiting",
+                       lambda: sum(stream.reading_paused for stream in self.client_map))
 
-        # Catch keyboard interrupts
-        signal.signal(signal.SIGINT, self.sighandler)
+        self.server = None
+        self.stopped = None
+
+        # Commands sent by a logged in client.
+        self.handlers = {
+            "END": self.handle_end,
+            "MESSAGE": self.handle_message,
+            "CREATE_ROOM": self.handle_create_room,
+            "JOIN_ROOM": self.handle_join_room,
+            "UPDATE_INVITE_WINDOW": self.handle_update_invite_window,
+            "INVITE": self.handle_invite,
+            "GROUP_MESSAGE": self.handle_group_message,
+            "HISTORY": self.handle_history,
+            "PING": self.handle_ping,
+            "PONG": self.handle_pong,
+        }
 
-        print(f'Server listening to port: {port_number} ...')
+        # Events sent by the other workers.
+        self.bus_handlers = {
+            "ONLINE": self.peer_online,
+            "OFFLINE": self.peer_offline,
+            "ROOM_CREATED": self.peer_room_created,
+            "ROOM_REMOVED": self.peer_room_removed,
+            "MEMBER": self.peer_member,
+            "INVITE": self.peer_invite,
+            "POST": self.peer_post,
+            "GROUP": self.peer_group,
+            "HISTORY": self.peer_history,
+            "DELIVER": self.peer_deliver,
+        }
+
+    def restore_rooms(self, saved_rooms):
+        """
+        Adds the saved rooms this worker is the home of, with all their members
+        offline. The other workers send the rooms they are the home of when
+        they connect.
+        """
+        with gc_paused():
+            for saved in saved_rooms:
+                if self.chat_rooms.home_of(saved.id) == self.chat_rooms.worker:
+                    self.chat_rooms.restore(saved)
+        print(f'Chat server: restored {len(self.chat_rooms.rooms)} rooms')
+
+    # Saves the rooms every snapshot_interval seconds when they have changed, so the log stays short.
+    async def snapshot_state(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            if self.state.changes:
+                self.state.snapshot(self.chat_rooms)
 
     # Used to close the server.
-    def sighandler(self, signum, frame):
+    def sighandler(self, signum=None, frame=None):
         """ Clean up client outputs"""
         print('Shutting down server...')
+        self.bus.close()
+        # Save the rooms before the clients leave them.
+        self.state.close(self.chat_rooms)
 
-        # Close existing client sockets
-        for output in self.outputs:
-            output.close()
-
-        self.server.close()
+        # Close existing client streams
+        for stream in list(self.client_map):
+            stream.close()
 
-    # Gets the name of a specific client.
-    def get_client_name(self, client):
-        """ Return the name of the client """
-        info = self.client_map[client]
-        host, client_name = info[0][0], info[1]
-        return '@'.join((client_name, host))
+        if self.stopped is not None:
+            self.stopped.set()
 
-    # Sends connected clients to the specific client.
+    # Sends connected clients to the specific client, only needed on login.
     def send_connected_clients(self, client):
+        if client.legacy:
+            client.send("CLIENT_LIST", self.format_connected_clients(client))
+            return
+
+        # The client works out how long ago everyone connected itself.
+        names = []
+        times = []
+        for session in self.sessions.values():
+            names.append(session.name)
+            times.append(session.time.timestamp())
+        client.send("CLIENT_LIST", names, times, datetime.now().timestamp())
+
+    def local_sessions(self):
+        """
+        Gets the clients connected here, and the ones that lost their
+        connection and can still resume, so what is sent to them is kept
+        for when they do.
+        """
+        sessions = list(self.client_map.values())
+        sessions.extend(session for session in self.tokens.values() if session.stream not in self.client_map)
+        return sessions
+
+    # Tells every other client that a client connected or disconnected.
+    def send_presence(self, client, joined):
+        sessions = self.local_sessions()
+        FAN_OUT.observe(len(sessions))
+        others = []
+        for session in sessions:
+            if session is client:
+                continue
+            # Version 1 clients only understand the full list.
+            if session.legacy:
+                self.send_connected_clients(session)
+            else:
+                others.append(session)
+        if joined:
+            self.broadcast(others, "CLIENT_JOINED", client.name, client.time.timestamp())
+        else:
+            self.broadcast(others, "CLIENT_LEFT", client.name)
+
+    # Gets the connected clients list the way version 1 clients show it.
+    def format_connected_clients(self, client):
         connected_clients_list = []
-        for client_data in self.client_map.values():
-            connected_time = datetime.now() - client_data[2]
-            connected_client_name = client_data[1]
+        now = datetime.now()
+        for session in self.sessions.values():
+            connected_time = now - session.time
+            connected_client_name = session.name
             time_message = ""
 
-            current_client = '@'.join((client_data[1], client_data[0][0]))
-            if current_client == self.get_client_name(client):
+            if session is client:
                 connected_client_name = connected_client_name + " (me)"
 
             if connected_time.seconds < 1:
@@ -75,180 +529,838 @@ class ChatServer(object):
                 time_message = str(round(connected_time.seconds/(60*60))) + " hour ago"
 
             connected_clients_list.append(connected_client_name + " (" + time_message + ")")
-        send_clients(client, connected_clients_list)  
+        return connected_clients_list
 
     # Gets a string with the format hour:minute
     def get_current_time_stamp(self):
         current_time = datetime.now()
         return str(current_time.hour) + ":" + str(current_time.minute)
-    
-    # Gets the specific socket of a client with the matching name.
-    def get_client_socket(self, client_name):
-        for client_key in dict.keys(self.client_map):
-            if self.client_map[client_key][1] == client_name:
-                return client_key
+
+    # Gets a stored message the way it is shown in a chat room.
+    def format_message(self, message):
+        sent_time = datetime.fromtimestamp(message.time)
+        return message.sender + " (" + str(sent_time.hour) + ":" + str(sent_time.minute) + "): " + message.text
+
+    # Sends a page of the room's messages older than before_id, 0 for the latest,
+    # or the first ones newer than after_id for a client catching up.
+    def send_history(self, client, room, before_id, limit, after_id=0):
+        key = room.history_key()
+        if after_id > self.history.last_id(key):
+            # The client remembers messages this history does not have, it starts again from the latest.
+            after_id = 0
+        if after_id > 0:
+            messages = self.history.since(key, after_id, limit)
+        else:
+            messages = self.history.page(key, before_id, limit)
+        client.send("HISTORY", room.name, before_id, [message.id for message in messages],
+                    [self.format_message(message) for message in messages], after_id)
+
+    # Sends a page of history, asking the home worker of the room for it when that is another one.
+    def request_history(self, client, room, before_id, limit, after_id=0):
+        if self.chat_rooms.is_home(room):
+            self.send_history(client, room, before_id, limit, after_id)
+        else:
+            self.bus.send(self.chat_rooms.home(room), "HISTORY", room.id, client.name, before_id, limit, after_id)
+
+    # Sends a command to the members of a room that are connected to this worker.
+    def send_to_room(self, room, command, *args):
+        self.broadcast([session for session in room.sessions() if session.stream is not None], command, *args)
+
+    def broadcast(self, sessions, command, *args):
+        """
+        Sends the same command to many clients connected here. It is encoded
+        once for every frame format in use and the same bytes are queued for
+        every client, each stream then writes all it has queued in one call.
+        """
+        frames = {}
+        size = 0
+        for session in sessions:
+            frame_format = session.frame_format()
+            frame = frames.get(frame_format)
+            if frame is None:
+                frame = frames[frame_format] = session.encode(command, *args)
+            session.write(frame)
+            size += len(frame)
+        FRAMES_SENT[command].inc(len(sessions))
+        BYTES_SENT.inc(size)
+
+    # Gets the session of the client with the matching name.
+    def get_session(self, client_name):
+        return self.sessions.get(client_name)
+
+    # Gets the names of the clients that are not in the room.
+    def get_non_room_members(self, room):
+        return [client_name for client_name in self.sessions if client_name not in room.members]
+
+    # Sends the names of every room, only needed on login.
+    def send_rooms_list(self, client):
+        client.send("UPDATE_ROOMS_LIST", [room.name for room in self.chat_rooms],
+                    [room.id for room in self.chat_rooms])
+
+    # Tells every client that a room was created or removed.
+    def send_room_change(self, room, added):
+        others = []
+        for session in self.local_sessions():
+            # Version 1 clients only understand the full list.
+            if session.legacy:
+                self.send_rooms_list(session)
+            else:
+                others.append(session)
+        self.broadcast(others, "ROOM_ADDED" if added else "ROOM_REMOVED", room.id, room.name)
 
     def run(self):
-        inputs = [self.server, sys.stdin]
-        self.outputs = []
-        running = True
-        while running:
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+        self.history.close_all()
+        print("closing")
+
+    async def serve(self):
+        """
+        Accepts connections until the server is shut down. Connections are
+        accepted as plain TCP and upgraded by handle_connection, so the
+        TLS handshakes are timed and limited.
+        """
+        loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        # Every worker listens on the port itself, the kernel spreads the connections.
+        await self.bus.start(self.bus_handlers, self.peer_joined, self.peer_lost)
+        self.server = await loop.create_server(self.create_stream, SERVER_HOST, self.port,
+                                               backlog=self.backlog, reuse_address=True,
+                                               reuse_port=self.bus.workers > 1)
+
+        # Catch keyboard interrupts
+        loop.add_signal_handler(signal.SIGINT, self.sighandler)
+        loop.add_signal_handler(signal.SIGTERM, self.sighandler)
+
+        # handles standard input from terminal.
+        try:
+            loop.add_reader(sys.stdin, self.handle_stdin)
+        except (ValueError, OSError, PermissionError):
+            pass
+
+        print(f'Server listening to port: {self.port} ...')
+
+        tasks = [loop.create_task(self.measure_loop_lag())]
+        if self.stats_interval:
+            tasks.append(loop.create_task(self.log_stats()))
+        if self.snapshot_interval:
+            tasks.append(loop.create_task(self.snapshot_state()))
+        if self.metrics_port is not None:
+            metrics_server = await asyncio.start_server(self.handle_metrics_request, SERVER_HOST, self.metrics_port)
+            tasks.append(loop.create_task(metrics_server.serve_forever()))
+            print(f'Metrics on http://{SERVER_HOST}:{self.metrics_port}/metrics')
+
+        async with self.server:
+            await self.stopped.wait()
+            self.state.close(self.chat_rooms)
+        self.bus.close()
+        for task in tasks:
+            task.cancel()
+
+        try:
+            loop.remove_reader(sys.stdin)
+        except (ValueError, OSError):
+            pass
+
+    async def measure_loop_lag(self, interval=0.25):
+        """ Records how much later than asked for the loop wakes up, the time other work held it """
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + interval
+            await asyncio.sleep(interval)
+            LOOP_LAG.observe(max(0.0, loop.time() - expected))
+
+    async def log_stats(self):
+        """ Prints the traffic since the last time every stats_interval seconds """
+        last = (0, 0, 0, 0)
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            totals = (sum(counter.value for counter in FRAMES_RECEIVED.values()),
+                      sum(counter.value for counter in FRAMES_SENT.values()),
+                      BYTES_RECEIVED.value, BYTES_SENT.value)
+            rates = [(total - previous) / self.stats_interval for total, previous in zip(totals, last)]
+            last = totals
+            lag = LOOP_LAG.quantile(0.99) or 0
+            print(f'Stats: {len(self.client_map)} clients, {len(self.chat_rooms.rooms)} rooms, '
+                  f'in {rates[0]:.0f} frames/s {rates[2] / 1024:.0f} KiB/s, '
+                  f'out {rates[1]:.0f} frames/s {rates[3] / 1024:.0f} KiB/s, loop lag p99 {lag * 1000:.1f}ms')
+
+    async def handle_metrics_request(self, reader, writer):
+        """ Answers any HTTP request with every metric in the Prometheus text format """
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+        body = REGISTRY.render().encode()
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                     b'Content-Length: %d\r\nConnection: close\r\n\r\n' % len(body) + body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    def create_stream(self):
+        return FrameStream(self.handle_connection, high_water=self.high_water, overflow=self.overflow,
+                           start_paused=True, flush_delay=self.flush_delay, read_limit=self.read_limit,
+                           on_overflow=lambda stream: OUTBOUND_OVERFLOWS[stream.overflow].inc())
+
+    # Checks the name a client logged in with.
+    def login_name(self, name):
+        if not isinstance(name, str) or not name:
+            raise ProtocolError(f'bad login name {name!r}')
+        return self.checked_text(name)
+
+    # Checks text from a client can be stored and passed on, pickled strings need not be valid UTF-8.
+    def checked_text(self, text):
+        if not isinstance(text, str):
+            raise ProtocolError(f'expected text, got {type(text).__name__}')
+        try:
+            text.encode()
+        except UnicodeEncodeError:
+            raise ProtocolError(f'text is not valid UTF-8: {text!r}')
+        return text
+
+    # Picks the first of the compressions the client accepts that this server has.
+    def negotiate_compression(self, options):
+        names = options.get("compression", [])
+        if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+            raise ProtocolError(f'bad compression {names!r}')
+        return choose_compression(names) if self.compress else None
+
+    # Applies the batching a client asked for in its login options, within limits.
+    def set_batching(self, stream, options):
+        flush_delay = options.get("flush_delay", self.flush_delay)
+        if not isinstance(flush_delay, (int, float)):
+            raise ProtocolError(f'bad flush_delay {flush_delay!r}')
+        stream.set_batching(min(max(flush_delay, 0), MAX_FLUSH_DELAY), bool(options.get("nodelay", self.nodelay)))
+
+    def handle_stdin(self):
+        cmd = sys.stdin.readline().strip()
+        if cmd == 'list':
+            print(self.client_map.values())
+        elif cmd == 'stats':
+            print('\n'.join(REGISTRY.summary()))
+        elif cmd.startswith('limit'):
+            self.set_limit(cmd.split()[1:])
+        elif cmd == 'quit':
+            self.stopped.set()
+
+    def set_limit(self, words):
+        """
+        Changes a limit while the server runs, e.g. "limit client 10 20",
+        "limit room 0 0" to turn it off, "limit policy drop",
+        "limit overflow drop" or "limit queue 1048576".
+        """
+        try:
+            if words and words[0] in ('client', 'room'):
+                limit = self.client_limit if words[0] == 'client' else self.room_limit
+                limit.rate, limit.burst = float(words[1]), float(words[2])
+            elif words and words[0] == 'policy' and words[1] in ('delay', 'drop', 'disconnect'):
+                self.rate_policy = words[1]
+            elif words and words[0] == 'overflow' and words[1] in ('drop', 'disconnect'):
+                self.overflow = words[1]
+                for stream in self.client_map:
+                    stream.overflow = self.overflow
+            elif words and words[0] == 'queue':
+                self.high_water = int(words[1])
+                for stream in self.client_map:
+                    stream.high_water = self.high_water
+            elif words:
+                raise ValueError(words[0])
+        except (IndexError, ValueError) as e:
+            print(f'Chat server: bad limit {e}')
+        print(f'client {self.client_limit}, room {self.room_limit}, policy {self.rate_policy} '
+              f'(up to {self.max_delay:g}s), queue {self.high_water} bytes then {self.overflow}')
+
+    # Reads the next command, collecting the extra frames of version 1 clients.
+    async def receive_from(self, stream):
+        command, args = await self.receive_command(stream)
+        if args is not None:
+            return command, args
+        args = []
+        for i in range(LEGACY_ARGUMENTS.get(command, 0)):
+            arg, _ = await self.receive_command(stream)
+            args.append(arg)
+        return command, tuple(args)
+
+    # Reads and decodes one frame, counting its bytes and the time spent decoding it.
+    async def receive_command(self, stream):
+        buf = await stream.receive_frame()
+        if not buf:
+            return '', ()
+        started = time.perf_counter()
+        command, args = unpack_command(buf)
+        DECODE_SECONDS.inc(time.perf_counter() - started)
+        BYTES_RECEIVED.inc(len(buf) + (FRAME_HEADER.size if args is not None else FrameDecoder.LEGACY_HEADER_SIZE))
+        return command, args
+
+    async def handle_connection(self, stream):
+        """
+        Upgrades a new connection to TLS, then serves the client.
+        """
+        CONNECTIONS.inc()
+        accepted = time.perf_counter()
+        async with self.handshake_slots:
+            started = time.perf_counter()
+            HANDSHAKE_WAIT_SECONDS.observe(started - accepted)
             try:
-                readable, writeable, exceptional = select.select(inputs, self.outputs, [])
-            except select.error as e:
-                print(e)
-                break
+                await stream.start_tls(self.context, timeout=self.handshake_timeout)
+            except (ssl.SSLError, OSError, asyncio.TimeoutError) as e:
+                print(f'Chat server: handshake failed {e!r}')
+                HANDSHAKES_FAILED.inc()
+                stream.close()
+                return
+            HANDSHAKE_SECONDS.observe(time.perf_counter() - started)
+        if stream.get_extra_info('ssl_object').session_reused:
+            HANDSHAKES_RESUMED.inc()
+        await self.handle_client(stream)
 
-            for sock in readable:
-                """
-                When a new client connects to the server.
-                """
-                if sock == self.server:
-                    # handle the server socket
-                    client, address = self.server.accept()
-                    print(f'Chat server: got connection {client.fileno()} from {address}')
-
-                    # Read the login name
-                    cname = receive(client).split('NAME: ')[1]
-                    time = datetime.now()
-
-                    # Compute client name and send back
-                    self.clients += 1
-                    inputs.append(client)
-                    self.client_map[client] = (address, cname, time)
-                    self.outputs.append(client)
-
-                    # Send clients list to all the connected clients.
-                    for output in self.outputs:
-                        send(output, "CLIENT_LIST") 
-                        self.send_connected_clients(output)  
-                        send(output, "UPDATE_ROOMS_LIST")
-                        send_list(output, list(self.chat_rooms.keys()))
-
-                elif sock == sys.stdin:
-                    # handles standard input from terminal.
-                    cmd = sys.stdin.readline().strip()
-                    if cmd == 'list':
-                        print(self.client_map.values())
-                    elif cmd == 'quit':
-                        running = False
+    async def handle_client(self, stream):
+        """
+        When a new client connects to the server.
+        """
+        loop = asyncio.get_running_loop()
+        address = stream.get_extra_info('peername')
+        sock = stream.get_extra_info('socket')
+        print(f'Chat server: got connection {sock.fileno()} from {address}')
+
+        # Read the login name
+        options = {}
+        resumed = None
+        try:
+            buf = await stream.receive_frame()
+            command, args = unpack_command(buf)
+            if args is None:
+                if not isinstance(command, str) or not command.startswith('NAME: '):
+                    raise ProtocolError(f'bad login {command!r}')
+                client = Session(stream, address, self.login_name(command[len('NAME: '):]), datetime.now(),
+                                 legacy=True)
+                self.set_batching(stream, {})
+            elif command == "LOGIN":
+                # Reply with the codec the client logged in with, compressed the way it prefers.
+                name = self.login_name(args[0] if args else None)
+                options = args[1] if len(args) > 1 else {}
+                if not isinstance(options, dict):
+                    raise ProtocolError(f'bad login options {options!r}')
+                compression = self.negotiate_compression(options)
+                resumed = self.resumable_session(name, options)
+                if resumed is not None:
+                    client = resumed
+                    client.codec, client.compression = codec_of(buf), compression
                 else:
-                    try:
-                        # handle all other sockets
-                        data = receive(sock)
-                        # When a client wants to end their connection.
-                        if data == "END":
-                            send(sock, "END")
-                            print("trying to end the client.")
-                        # When a client wants to send a one to one message.
-                        elif data == "MESSAGE":
-                            username = receive(sock)
-                            message = receive(sock)
-
-                            target_sock = self.get_client_socket(username)
-                            current_time = self.get_current_time_stamp()
-
-                            # sends the message to the themselves
-                            send(sock, "MESSAGE")
-                            send(sock, "Me (" + current_time + "): " + message)
-                            
-                            # sends a message to the target
-                            send(target_sock, "MESSAGE")
-                            send(target_sock, self.client_map[sock][1] + " (" + current_time + "): " + message)
-                        # Creates a new chat room.
-                        elif data == "CREATE_ROOM":
-                            self.chat_rooms_count = self.chat_rooms_count + 1
-                            room_name = "Room" + str(self.chat_rooms_count) + " by " + self.client_map[sock][1]
-                            self.chat_rooms[room_name] = {
-                                "members": [self.client_map[sock][1]],
-                                "message_history": []
-                            }
-
-                            # Tell the client that we have created the room.
-                            send(sock, "CREATE_ROOM")
-                            send(sock, room_name)
-
-                            # Tell everyone to update their rooms lists.
-                            for output in self.outputs:
-                                send(output, "UPDATE_ROOMS_LIST")
-                                send_list(output, list(self.chat_rooms.keys()))
-                        # Used to join a specific room.
-                        elif data == "JOIN_ROOM":
-                            # gets the room name.
-                            room_name = receive(sock)
-                            send(sock, "JOIN_ROOM")
-                            send_list(sock, self.chat_rooms[room_name]["members"])
-                        # Used to update the members list in the invite window.
-                        elif data == "UPDATE_INVITE_WINDOW":
-                            room_name = receive(sock)
-                            room_members = self.chat_rooms[room_name]["members"]
-                            non_room_members = []
-                            for client in self.client_map:
-                                client_name = self.get_client_name(client).split('@')[0]
-                                if client_name not in room_members:
-                                    non_room_members.append(client_name)
-                            send(sock, "UPDATE_INVITE_WINDOW")
-                            send_list(sock, non_room_members)
-                        # Used to invite a new user to a chat room.
-                        elif data == "INVITE":
-                            room_name = receive(sock)
-                            client_name = receive(sock)
-                            self.chat_rooms[room_name]["members"].append(client_name)
-
-                            # send to all members in the chat room.
-                            for member_name in self.chat_rooms[room_name]["members"]:
-                                destination_sock = self.get_client_socket(member_name)
-                                send(destination_sock, "INVITED")
-                                send(destination_sock, room_name)
-                                send_list(destination_sock, self.chat_rooms[room_name]["members"])
-
-                            # update the invite window
-                            room_members = self.chat_rooms[room_name]["members"]
-                            non_room_members = []
-                            for client in self.client_map:
-                                client_name = self.get_client_name(client).split('@')[0]
-                                if client_name not in room_members:
-                                    non_room_members.append(client_name)
-                            send(sock, "UPDATE_INVITE_WINDOW")
-                            send_list(sock, non_room_members)
-                        elif data == "GROUP_MESSAGE":
-                            room_name = receive(sock)
-                            message = receive(sock)
-
-                            current_time = self.get_current_time_stamp()
-
-                            # notify all the clients in the room.
-                            for member_name in self.chat_rooms[room_name]["members"]:
-                                destination_sock = self.get_client_socket(member_name)
-                                send(destination_sock, "GROUP_MESSAGE")
-                                send(destination_sock, room_name)
-                                send(destination_sock, self.client_map[sock][1] + " (" + current_time + "): " + message)
-                        # When a user goes offline.
-                        else:
-                            print(f'Chat server: {sock.fileno()} hung up')
-                            self.clients -= 1
-                            sock.close()
-                            inputs.remove(sock)
-                            self.outputs.remove(sock)
-                            self.client_map.pop(sock)
-                            # Update client list for other clients.
-                            for output in self.outputs:
-                                if output != sock:
-                                    send(output, "CLIENT_LIST") 
-                                    self.send_connected_clients(output)
-                    except socket.error as e:
-                        # Remove
-                        self.client_map.pop(sock)
-                        inputs.remove(sock)
-                        self.outputs.remove(sock)
+                    client = Session(stream, address, name, datetime.now(), codec=codec_of(buf),
+                                     compression=compression)
+                self.set_batching(stream, options)
+            else:
+                raise ProtocolError(command)
+        except (ProtocolError, ConnectionError, ssl.SSLError, OSError) as e:
+            print(f'Chat server: login failed {e!r}')
+            stream.close()
+            return
 
-        print("closing")
-        self.server.close()
+        if resumed is not None:
+            self.resume_session(client, stream, address, options["received"])
+        else:
+            # Compute client name and send back
+            client.bucket = TokenBucket(self.client_limit)
+            self.watch_idle(client)
+            self.add_client(client)
+            if options.get("resumable") and self.resume_timeout > 0:
+                self.start_session(client)
 
+            # Send the new client everything, the others only hear about the new client.
+            self.send_connected_clients(client)
+            self.send_rooms_list(client)
+            self.send_presence(client, True)
 
-if __name__ == "__main__":
-    port = 9988
-    name = "server"
+        try:
+            while True:
+                command, args = await self.receive_from(stream)
+                handler = self.handlers.get(command)
+                # When a user goes offline.
+                if handler is None:
+                    print(f'Chat server: {sock.fileno()} hung up')
+                    break
+                FRAMES_RECEIVED[command].inc()
+                client.last_seen = loop.time()
+                if await self.admit(client, command, args):
+                    handler(client, *args)
+                elif stream.closed or stream.transport.is_closing():
+                    break
+        except (ProtocolError, TypeError, ConnectionError, ssl.SSLError) as e:
+            print(e)
+        finally:
+            self.remove_client(client, stream)
+
+    async def admit(self, client, command, args):
+        """
+        Applies the rate limits of the client, and of the room for a group
+        message, waiting while the command is delayed. Returns whether the
+        command should be handled.
+        """
+        room = self.chat_rooms.get(args[0]) if command == "GROUP_MESSAGE" and args else None
+        if room is not None and room.bucket is None:
+            room.bucket = TokenBucket(self.room_limit)
+        waited = 0
+        while True:
+            limit, wait = "client", client.bucket.wait()
+            room_wait = room.bucket.wait() if room is not None else 0
+            if room_wait > wait:
+                limit, wait = "room", room_wait
+            if wait == 0:
+                break
+            if self.rate_policy == "delay" and waited + wait <= self.max_delay:
+                if waited == 0:
+                    RATE_LIMITED[limit, "delayed"].inc()
+                waited += wait
+                await asyncio.sleep(wait)
+                # The room may have been removed while waiting.
+                if room is not None and self.chat_rooms.get(room.name) is not room:
+                    room = None
+                continue
+            action = "disconnected" if self.rate_policy == "disconnect" else "dropped"
+            RATE_LIMITED[limit, action].inc()
+            if not client.legacy:
+                client.send("THROTTLED", command, limit, action, wait)
+            if action == "disconnected":
+                # Coming back by resuming the session would get around the limit.
+                self.forget_token(client)
+                client.stream.close()
+            return False
+        client.bucket.take()
+        if room is not None:
+            room.bucket.take()
+        return True
+
+    def watch_idle(self, client):
+        """
+        Starts the idle timer of a client. Rather than being moved on by every
+        frame, the timer only fires once per ping_interval and looks at when
+        the client last sent something, so an active client costs a store of
+        the time per frame. Version 1 clients can not answer pings, so TCP
+        keepalive looks after them instead.
+        """
+        if self.idle_timeout <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        client.last_seen = loop.time()
+        if client.legacy:
+            sock = client.stream.get_extra_info('socket')
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(self.ping_interval)))
+            return
+        client.idle_timer = loop.call_later(self.ping_interval, self.check_idle, client)
+
+    # Pings a client that has gone quiet, or disconnects it when it has not answered.
+    def check_idle(self, client):
+        loop = asyncio.get_running_loop()
+        idle = loop.time() - client.last_seen
+        if idle >= self.idle_timeout:
+            print(f'Chat server: {client.name} timed out')
+            CLIENTS_REAPED.inc()
+            client.idle_timer = None
+            # Nothing queued for a dead peer would ever be sent, so do not wait for it.
+            client.stream.transport.abort()
+            return
+        if idle >= self.ping_interval:
+            client.send("PING")
+            delay = min(self.ping_interval, self.idle_timeout - idle)
+        else:
+            delay = self.ping_interval - idle
+        client.idle_timer = loop.call_later(delay, self.check_idle, client)
+
+    def add_client(self, client):
+        self.clients += 1
+        self.client_map[client.stream] = client
+        self.sessions[client.name] = client
+        self.chat_rooms.set_online(client)
+        self.bus.broadcast("ONLINE", client.name, client.time.timestamp())
+
+    def remove_client(self, client, stream):
+        self.client_map.pop(stream, None)
+        stream.close()
+        if client.stream is not stream:
+            # The client has resumed its session on a new connection.
+            return
+        if client.idle_timer is not None:
+            client.idle_timer.cancel()
+            client.idle_timer = None
+        if client.token is not None:
+            # Stays online, and in its rooms, for a while so the client can resume without anyone noticing.
+            client.expiry = asyncio.get_running_loop().call_later(self.resume_timeout, self.end_session, client)
+            return
+        self.end_session(client)
+
+    def end_session(self, client):
+        self.clients -= 1
+        client.expiry = None
+        self.forget_token(client)
+        # A newer login with the same name keeps its entry.
+        if self.sessions.get(client.name) is client:
+            del self.sessions[client.name]
+
+        # Update client list for other clients.
+        if client.name not in self.sessions:
+            self.bus.broadcast("OFFLINE", client.name)
+            self.client_gone(client)
+
+    # Gives a client a token to resume its session with when it loses the connection.
+    def start_session(self, client):
+        client.token = secrets.token_hex(16)
+        self.tokens[client.token] = client
+        client.stream.write(client.encode("SESSION", client.token, False))
+        client.keep_replay(self.resume_buffer)
+
+    def forget_token(self, client):
+        self.tokens.pop(client.token, None)
+        client.token = None
+        client.replay = None
+
+    def resumable_session(self, name, options):
+        """
+        Gets the session a client that reconnected is resuming, or None when
+        it has ended, a newer login took the name or the frames the client
+        missed are no longer kept.
+        """
+        token = options.get("token")
+        received = options.get("received")
+        if not isinstance(token, str) or not isinstance(received, int):
+            return None
+        client = self.tokens.get(token)
+        if client is None or client.name != name or self.sessions.get(name) is not client:
+            return None
+        return client if client.replay_since(received) is not None else None
+
+    def resume_session(self, client, stream, address, received):
+        """
+        Moves a session over to the new connection of its client and sends
+        what it missed. Nobody else hears about it, to them the client never left.
+        """
+        previous = client.stream
+        if client.expiry is not None:
+            client.expiry.cancel()
+            client.expiry = None
+        elif previous.transport is not None:
+            # The server had not noticed the old connection was gone yet.
+            previous.transport.abort()
+        if client.idle_timer is not None:
+            client.idle_timer.cancel()
+            client.idle_timer = None
+        client.stream = stream
+        client.address = address
+        self.client_map.pop(previous, None)
+        self.client_map[stream] = client
+        SESSIONS_RESUMED.inc()
+        stream.write(client.encode("SESSION", client.token, True))
+        for frame in client.replay_since(received):
+            stream.write(frame)
+        self.watch_idle(client)
+
+    # Tells the clients here that a client is not online anymore and removes the rooms left empty.
+    def client_gone(self, client):
+        self.send_presence(client, False)
+        for room in self.chat_rooms.set_offline(client.name):
+            self.history.close(room.history_key())
+            self.bus.broadcast("ROOM_REMOVED", room.id)
+            self.send_room_change(room, False)
+
+    # When a client wants to end their connection, it will not resume the session.
+    def handle_end(self, client):
+        self.forget_token(client)
+        client.send("END")
+        print("trying to end the client.")
+
+    # Answers a client checking the server is still there.
+    def handle_ping(self, client):
+        client.send("PONG")
+
+    # Receiving the answer was enough, it moved last_seen on.
+    def handle_pong(self, client):
+        pass
+
+    # When a client wants to send a one to one message.
+    def handle_message(self, client, username, message):
+        message = self.checked_text(message)
+        target = self.get_session(username)
+        current_time = self.get_current_time_stamp()
+
+        # sends the message to the themselves, with who it went to
+        client.send("MESSAGE", "Me (" + current_time + "): " + message, username)
 
-    server = ChatServer(port)
+        # sends a message to the target, with who it is from
+        if target is not None:
+            target.send("MESSAGE", client.name + " (" + current_time + "): " + message, client.name)
+
+    # Creates a new chat room.
+    def handle_create_room(self, client):
+        room = self.chat_rooms.create(client)
+
+        # Tell the client that we have created the room.
+        client.send("CREATE_ROOM", room.name)
+
+        # Tell everyone to update their rooms lists.
+        self.bus.broadcast("ROOM_CREATED", room.id, room.name, [client.name], 0)
+        self.send_room_change(room, True)
+
+    # Used to join a specific room, a client that kept its messages sends the id of the last one.
+    def handle_join_room(self, client, room_name, after_id=0):
+        room = self.chat_rooms.get(room_name)
+        client.send("JOIN_ROOM", list(room.members) if room is not None else [], room_name)
+        if room is not None and client.name in room.members and not client.legacy:
+            self.request_history(client, room, 0, HISTORY_PAGE_LIMIT if after_id else HISTORY_PAGE, after_id)
+
+    # Used to update the members list in the invite window.
+    def handle_update_invite_window(self, client, room_name):
+        room = self.chat_rooms.get(room_name)
+        if room is not None:
+            client.send("UPDATE_INVITE_WINDOW", self.get_non_room_members(room), room.name)
+
+    # Used to invite a new user to a chat room.
+    def handle_invite(self, client, room_name, client_name):
+        client_name = self.checked_text(client_name)
+        room = self.chat_rooms.get(room_name)
+        if room is None:
+            return
+
+        if self.chat_rooms.is_home(room):
+            self.add_room_member(room, client_name)
+        else:
+            self.bus.send(self.chat_rooms.home(room), "INVITE", room.id, client_name)
+
+        # update the invite window
+        client.send("UPDATE_INVITE_WINDOW", self.get_non_room_members(room), room.name)
+
+    # Adds a member to a room this worker is the home of.
+    def add_room_member(self, room, client_name):
+        if self.chat_rooms.add_member(room, client_name, self.get_session(client_name)):
+            self.bus.broadcast("MEMBER", room.id, client_name)
+            # send to all members in the chat room.
+            self.send_to_room(room, "INVITED", room.name, list(room.members))
+
+    def handle_group_message(self, client, room_name, message):
+        message = self.checked_text(message)
+        room = self.chat_rooms.get(room_name)
+        if room is None:
+            return
+        # The home of the room checks the sender is a member, it hears about new members first.
+        if not self.chat_rooms.is_home(room):
+            self.bus.send(self.chat_rooms.home(room), "POST", room.id, client.name, message)
+        elif client.name in room.members:
+            self.post_group_message(room, client.name, message)
+
+    # Stores a message sent to a room this worker is the home of and sends it to the members.
+    def post_group_message(self, room, sender, message):
+        current_time = self.get_current_time_stamp()
+        message_id = self.history.append(room.history_key(), sender, datetime.now().timestamp(), message,
+                                         room.last_message_id)
+        room.last_message_id = message_id
+        line = sender + " (" + current_time + "): " + message
+        FAN_OUT.observe(room.online)
+
+        # notify all the clients in the room, the other workers notify their own.
+        self.send_to_room(room, "GROUP_MESSAGE", room.name, line, message_id)
+        self.bus.multicast({session.peer for session in room.sessions() if session.stream is None},
+                           "GROUP", room.id, line, message_id)
+
+    # Sends older messages of a room the client is in, or the ones after after_id that it missed.
+    # A client that is not a member, or asks for a room that is gone, gets an empty page so it is not left waiting.
+    def handle_history(self, client, room_name, before_id, limit, after_id=0):
+        room = self.chat_rooms.get(room_name)
+        if room is not None and client.name in room.members:
+            self.request_history(client, room, before_id, max(1, min(limit, HISTORY_PAGE_LIMIT)), after_id)
+        else:
+            client.send("HISTORY", room_name, before_id, [], [], after_id)
+
+    # A client logged in on another worker, the latest login of a name wins.
+    def peer_online(self, peer, name, time):
+        current = self.sessions.get(name)
+        if current is not None and current.time.timestamp() > time:
+            return
+        session = RemoteSession(peer, name, datetime.fromtimestamp(time))
+        self.sessions[name] = session
+        self.chat_rooms.set_online(session)
+        self.send_presence(session, True)
+
+    def peer_offline(self, peer, name):
+        session = self.sessions.get(name)
+        if session is not None and session.stream is None and session.peer is peer:
+            del self.sessions[name]
+            self.client_gone(session)
+
+    # A room was created on another node, or a node that joined hears about the rooms.
+    def peer_room_created(self, peer, room_id, name, members, last_message_id):
+        room = self.chat_rooms.by_id.get(room_id)
+        added = room is None
+        if added:
+            room = self.chat_rooms.add(room_id, name)
+        for client_name in members:
+            self.chat_rooms.add_member(room, client_name, self.get_session(client_name))
+        room.last_message_id = max(room.last_message_id, last_message_id)
+        if added:
+            self.send_room_change(room, True)
+
+    def peer_room_removed(self, peer, room_id):
+        room = self.chat_rooms.by_id.get(room_id)
+        if room is not None:
+            self.chat_rooms.remove(room)
+            self.send_room_change(room, False)
+
+    # The home worker of a room added a member to it.
+    def peer_member(self, peer, room_id, client_name):
+        room = self.chat_rooms.by_id.get(room_id)
+        if room is not None and self.chat_rooms.add_member(room, client_name, self.get_session(client_name)):
+            self.send_to_room(room, "INVITED", room.name, list(room.members))
+
+    # A client on another worker invited someone to a room this worker is the home of.
+    def peer_invite(self, peer, room_id, client_name):
+        room = self.chat_rooms.by_id.get(room_id)
+        if room is not None and self.chat_rooms.is_home(room):
+            self.add_room_member(room, client_name)
+
+    # A client on another worker sent a message to a room this worker is the home of.
+    def peer_post(self, peer, room_id, sender, message):
+        room = self.chat_rooms.by_id.get(room_id)
+        if room is not None and self.chat_rooms.is_home(room) and sender in room.members:
+            self.post_group_message(room, sender, message)
+
+    # The home worker of a room sent a message to its members here.
+    def peer_group(self, peer, room_id, line, message_id):
+        room = self.chat_rooms.by_id.get(room_id)
+        if room is not None:
+            room.last_message_id = message_id
+            self.send_to_room(room, "GROUP_MESSAGE", room.name, line, message_id)
+
+    # A client on another worker wants history from a room this worker is the home of.
+    def peer_history(self, peer, room_id, client_name, before_id, limit, after_id=0):
+        room = self.chat_rooms.by_id.get(room_id)
+        client = self.get_session(client_name)
+        if room is not None and client is not None and client_name in room.members:
+            self.send_history(client, room, before_id, limit, after_id)
+
+    # Another worker has a command for a client connected here.
+    def peer_deliver(self, peer, client_name, command, args):
+        session = self.get_session(client_name)
+        if session is not None and session.stream is not None:
+            session.send(command, *args)
+
+    # Tells a worker or node that connected about the clients here and the rooms this is the home of.
+    def peer_joined(self, peer):
+        for session in self.local_sessions():
+            if self.sessions.get(session.name) is session:
+                peer.send("ONLINE", session.name, session.time.timestamp())
+        for room in self.chat_rooms:
+            if self.chat_rooms.is_home(room):
+                peer.send("ROOM_CREATED", room.id, room.name, list(room.members), room.last_message_id)
+
+    # A worker went away with its clients. Rooms move to another node on a
+    # cluster, but the rooms of a worker can not, so they go with it.
+    def peer_lost(self, peer):
+        print(f'Chat server: lost {peer}')
+        for session in list(self.sessions.values()):
+            if session.stream is None and session.peer is peer:
+                del self.sessions[session.name]
+                self.client_gone(session)
+        for room in list(self.chat_rooms):
+            if self.chat_rooms.home(room) == peer.index:
+                self.chat_rooms.remove(room)
+                self.send_room_change(room, False)
+
+
+def server_arguments(options):
+    """ Gets the ChatServer arguments given on the command line that every worker shares """
+    return dict(backlog=options.backlog, history_directory=options.history_directory,
+                stats_interval=options.stats_interval,
+                flush_delay=options.flush_delay, nodelay=not options.nagle,
+                client_rate=options.client_rate, client_burst=options.client_burst,
+                room_rate=options.room_rate, room_burst=options.room_burst,
+                rate_policy=options.rate_policy, max_delay=options.max_delay,
+                ping_interval=options.ping_interval, idle_timeout=options.idle_timeout,
+                compress=not options.no_compression, resume_timeout=options.resume_timeout,
+                state_directory=options.state_directory, snapshot_interval=options.snapshot_interval)
+
+
+def run_worker(options, index, directory, context):
+    # Each worker serves its own metrics, on the ports after metrics_port.
+    metrics_port = options.metrics_port + index if options.metrics_port is not None else None
+    server = ChatServer(options.port, bus=WorkerBus(index, options.workers, directory), context=context,
+                        metrics_port=metrics_port, **server_arguments(options))
     server.run()
+
+
+def run_workers(options):
+    """
+    Runs options.workers server processes on the same port, connected
+    through a bus in a temporary directory, until they all stop.
+    """
+    # The workers are forked so they all get the same TLS context.
+    context = create_server_context()
+    fork = multiprocessing.get_context("fork")
+    with tempfile.TemporaryDirectory(prefix="chat-bus-") as directory:
+        processes = [fork.Process(target=run_worker, args=(options, index, directory, context))
+                     for index in range(options.workers)]
+        for process in processes:
+            process.start()
+        # Pass a terminate on to the workers.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            for process in processes:
+                process.join()
+        except (KeyboardInterrupt, SystemExit):
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat server")
+    parser.add_argument("--port", type=int, default=9988)
+    parser.add_argument("--backlog", type=int, default=socket.SOMAXCONN,
+                        help="connections waiting to be accepted before new ones are refused")
+    parser.add_argument("--history-directory", default="history")
+    parser.add_argument("--state-directory", default="state", help="where the rooms are saved between runs")
+    parser.add_argument("--snapshot-interval", type=float, default=60,
+                        help="seconds between snapshots of the rooms, 0 to only take one on shutdown")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes sharing the port with SO_REUSEPORT")
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics on this port")
+    parser.add_argument("--stats-interval", type=float, default=60, help="seconds between stats lines, 0 for none")
+    parser.add_argument("--flush-delay", type=float, default=0,
+                        help="seconds to gather frames for a client before writing them, 0 to write every iteration")
+    parser.add_argument("--nagle", action="store_true", help="leave Nagle's algorithm on for client connections")
+    parser.add_argument("--client-rate", type=float, default=20, help="commands a second per client, 0 for no limit")
+    parser.add_argument("--client-burst", type=float, default=50)
+    parser.add_argument("--room-rate", type=float, default=100, help="group messages a second per room, 0 for no limit")
+    parser.add_argument("--room-burst", type=float, default=200)
+    parser.add_argument("--rate-policy", choices=("delay", "drop", "disconnect"), default="delay",
+                        help="what happens to a command over a rate limit")
+    parser.add_argument("--max-delay", type=float, default=1, help="longest a command is delayed before it is dropped")
+    parser.add_argument("--ping-interval", type=float, default=30, help="seconds a client is quiet before it is pinged")
+    parser.add_argument("--idle-timeout", type=float, default=90,
+                        help="seconds a client is quiet before it is disconnected, 0 to never")
+    parser.add_argument("--no-compression", action="store_true", help="never compress frames for clients")
+    parser.add_argument("--resume-timeout", type=float, default=60,
+                        help="seconds a client that lost its connection can resume its session, 0 for never")
+    parser.add_argument("--node-id", type=int, help="join a cluster as this node, from 0 to 1023")
+    parser.add_argument("--cluster-host", default=SERVER_HOST, help="address the other nodes reach this one on")
+    parser.add_argument("--cluster-port", type=int, default=9989)
+    parser.add_argument("--seeds", nargs="*", default=[], metavar="HOST:PORT", help="nodes to join the cluster through")
+    options = parser.parse_args()
+
+    if options.node_id is not None:
+        if options.workers > 1:
+            parser.error("--workers can not be used with --node-id")
+        seeds = [(seed.rsplit(':', 1)[0], int(seed.rsplit(':', 1)[1])) for seed in options.seeds]
+        bus = ClusterBus(options.node_id, options.cluster_host, options.cluster_port, seeds)
+        server = ChatServer(options.port, bus=bus, metrics_port=options.metrics_port, **server_arguments(options))
+        server.run()
+    elif options.workers > 1:
+        run_workers(options)
+    else:
+        server = ChatServer(options.port, metrics_port=options.metrics_port, **server_arguments(options))
+        server.run()
@@ -0,0 +1,220 @@
+import contextlib
+import gc
+import mmap
+import os
+import struct
+
+from records import read_records, truncate_torn
+
+
+@contextlib.contextmanager
+def gc_paused():
+    """
+    Turns the cyclic garbage collector off for a while. Loading makes a lot
+    of objects that are all kept, and the collector would look at them
+    again and again as they are made.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def split(text, lengths):
+    """ Cuts text into pieces of the given lengths """
+    pieces = []
+    start = 0
+    for length in lengths:
+        pieces.append(text[start:start + length])
+        start += length
+    return pieces
+
+
+class RoomState(object):
+    """ A room as it was saved, with the names of its members in the order they joined """
+    __slots__ = ("id", "name", "last_message_id", "members")
+
+    def __init__(self, room_id, name, last_message_id=0, members=None):
+        self.id = room_id
+        self.name = name
+        self.last_message_id = last_message_id
+        self.members = members if members is not None else []
+
+    def __repr__(self):
+        return repr((self.id, self.name, self.last_message_id, self.members))
+
+
+class StateStore(object):
+    """
+    The rooms of a worker and their members, kept on disk so a restart
+    does not lose them.
+
+    Every room and membership change is appended to a write-ahead log.
+    Every so often the whole state is written to a snapshot, a new file
+    that replaces the old one, and the log starts again. Loading maps the
+    snapshot and replays the log on top of it.
+
+    The snapshot is laid out in columns so each one is read in a single
+    call: a header, the length of every member name and the names, then
+    the id, last message id, name length and member count of every room,
+    the room names, and the index in the member names of every member of
+    every room. A name shared by many rooms is stored once. Lengths are in
+    characters and each block of names is UTF-8 decoded in one go.
+
+    A log record is (length, kind, room id) followed by the UTF-8 room or
+    member name.
+    """
+    SNAPSHOT_MAGIC = b"CHST"
+    SNAPSHOT_VERSION = 1
+    # Magic, version, member names, rooms, memberships and the bytes of both blocks of names.
+    HEADER = struct.Struct("!4sBIIIII")
+    RECORD = struct.Struct("!IBQ")
+
+    # Kinds of log record.
+    ROOM_ADDED = 1
+    ROOM_REMOVED = 2
+    MEMBER_ADDED = 3
+
+    def __init__(self, directory, index=0):
+        self.directory = directory
+        self.snapshot_path = os.path.join(directory, f'worker-{index}.snap')
+        self.log_path = os.path.join(directory, f'worker-{index}.wal')
+        self.log = None
+        # Records written to the log since the last snapshot.
+        self.changes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def load(self):
+        """ Returns the saved rooms by id, and opens the log for the changes from now on """
+        with gc_paused():
+            rooms = self.read_snapshot()
+            size = self.replay_log(rooms)
+        truncate_torn(self.log_path, size)
+        self.log = open(self.log_path, 'ab')
+        return rooms
+
+    def read_snapshot(self):
+        rooms = {}
+        if not os.path.exists(self.snapshot_path):
+            return rooms
+        with open(self.snapshot_path, 'rb') as snapshot:
+            if os.fstat(snapshot.fileno()).st_size == 0:
+                return rooms
+            with mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                (magic, version, name_count, room_count, member_count,
+                 names_size, room_names_size) = self.HEADER.unpack_from(data, 0)
+                if magic != self.SNAPSHOT_MAGIC or version != self.SNAPSHOT_VERSION:
+                    raise ValueError(f'{self.snapshot_path} is not a version {self.SNAPSHOT_VERSION} snapshot')
+                offset = self.HEADER.size
+                name_lengths = struct.unpack_from(f'!{name_count}I', data, offset)
+                offset += 4 * name_count
+                names = split(str(data[offset:offset + names_size], 'utf-8'), name_lengths)
+                offset += names_size
+                ids = struct.unpack_from(f'!{room_count}Q', data, offset)
+                offset += 8 * room_count
+                last_message_ids = struct.unpack_from(f'!{room_count}Q', data, offset)
+                offset += 8 * room_count
+                room_name_lengths = struct.unpack_from(f'!{room_count}I', data, offset)
+                offset += 4 * room_count
+                member_counts = struct.unpack_from(f'!{room_count}I', data, offset)
+                offset += 4 * room_count
+                room_names = split(str(data[offset:offset + room_names_size], 'utf-8'), room_name_lengths)
+                offset += room_names_size
+                members = [names[member] for member in struct.unpack_from(f'!{member_count}I', data, offset)]
+        start = 0
+        for room_id, name, last_message_id, count in zip(ids, room_names, last_message_ids, member_counts):
+            rooms[room_id] = RoomState(room_id, name, last_message_id, members[start:start + count])
+            start += count
+        return rooms
+
+    def replay_log(self, rooms):
+        """ Applies the logged changes to rooms and returns where the intact records end """
+        offset = 0
+        for (size, kind, room_id), body, end in read_records(self.log_path, self.RECORD):
+            text = str(body, 'utf-8')
+            # A log left behind by a crash during a snapshot may repeat what
+            # the snapshot has, so every change is applied only once.
+            if kind == self.ROOM_ADDED:
+                rooms.setdefault(room_id, RoomState(room_id, text))
+            elif kind == self.ROOM_REMOVED:
+                rooms.pop(room_id, None)
+            elif kind == self.MEMBER_ADDED:
+                room = rooms.get(room_id)
+                if room is not None and text not in room.members:
+                    room.members.append(text)
+            offset = end
+            self.changes += 1
+        return offset
+
+    def append(self, kind, room_id, text=""):
+        if self.log is None:
+            return
+        data = text.encode()
+        self.log.write(self.RECORD.pack(self.RECORD.size + len(data), kind, room_id))
+        self.log.write(data)
+        self.log.flush()
+        self.changes += 1
+
+    def room_added(self, room):
+        self.append(self.ROOM_ADDED, room.id, room.name)
+
+    def room_removed(self, room):
+        self.append(self.ROOM_REMOVED, room.id)
+
+    def member_added(self, room, name):
+        self.append(self.MEMBER_ADDED, room.id, name)
+
+    def snapshot(self, rooms):
+        """
+        Writes rooms, anything with id, name, last_message_id and members,
+        to a new snapshot and empties the log.
+        """
+        if self.log is None:
+            return
+        names = {}
+        ids = []
+        last_message_ids = []
+        room_names = []
+        member_counts = []
+        members = []
+        for room in rooms:
+            ids.append(room.id)
+            last_message_ids.append(room.last_message_id)
+            room_names.append(room.name)
+            member_counts.append(len(room.members))
+            members.extend(names.setdefault(name, len(names)) for name in room.members)
+        names_data = ''.join(names).encode()
+        room_names_data = ''.join(room_names).encode()
+        header = self.HEADER.pack(self.SNAPSHOT_MAGIC, self.SNAPSHOT_VERSION, len(names), len(ids), len(members),
+                                  len(names_data), len(room_names_data))
+
+        temporary = self.snapshot_path + '.tmp'
+        with open(temporary, 'wb') as snapshot:
+            snapshot.write(header)
+            snapshot.write(struct.pack(f'!{len(names)}I', *map(len, names)))
+            snapshot.write(names_data)
+            snapshot.write(struct.pack(f'!{len(ids)}Q', *ids))
+            snapshot.write(struct.pack(f'!{len(ids)}Q', *last_message_ids))
+            snapshot.write(struct.pack(f'!{len(ids)}I', *map(len, room_names)))
+            snapshot.write(struct.pack(f'!{len(ids)}I', *member_counts))
+            snapshot.write(room_names_data)
+            snapshot.write(struct.pack(f'!{len(members)}I', *members))
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temporary, self.snapshot_path)
+        # The snapshot is in place before the log is emptied, so a crash in between loses nothing.
+        self.log.close()
+        self.log = open(self.log_path, 'wb')
+        self.changes = 0
+
+    def close(self, rooms=None):
+        """ Takes a last snapshot of rooms when given, nothing is logged after """
+        if self.log is None:
+            return
+        if rooms is not None:
+            self.snapshot(rooms)
+        self.log.close()
+        self.log = None
@@ -0,0 +1,110 @@
+import asyncio
+import os
+import ssl
+
+import pytest
+
+from server import ChatServer
+from utils import *
+
+CERTIFICATE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cert.pem")
+
+
+async def wait_until(condition):
+    """ Waits until condition() is true """
+    while not condition():
+        await asyncio.sleep(0.01)
+
+
+class ChatClient(object):
+    """ A client speaking the version 2 protocol, reading one command at a time """
+
+    def __init__(self, server, name, stream):
+        self.server = server
+        self.name = name
+        self.stream = stream
+        # Frames received since the session started, the way ClientTransport counts them.
+        self.received = 0
+        self.token = None
+
+    def send(self, command, *args):
+        self.stream.write(pack_command(command, *args))
+
+    async def receive(self):
+        command, args = await self.stream.receive_command()
+        if command == "SESSION":
+            self.token = args[0]
+        elif command:
+            self.received += 1
+        return command, args
+
+    async def receive_until(self, command):
+        """ Returns the commands received up to and including the first command """
+        received = []
+        while not received or received[-1][0] != command:
+            received.append(await self.receive())
+            assert received[-1][0], "connection closed"
+        return received
+
+    async def sync(self):
+        """ Returns every command the server sent before it answered a ping """
+        self.send("PING")
+        return (await self.receive_until("PONG"))[:-1]
+
+    async def drop(self):
+        """ Loses the connection without saying goodbye, and waits for the server to notice """
+        self.stream.transport.abort()
+        await wait_until(lambda: all(session.name != self.name for session in self.server.client_map.values()))
+
+    async def close(self):
+        """ Ends the session, and waits for the server to let everyone know """
+        self.send("END")
+        await self.receive_until("END")
+        self.stream.close()
+        await wait_until(lambda: self.name not in self.server.sessions)
+
+
+@pytest.fixture
+def chat_server(tmp_path):
+    """
+    Runs test(server, connect) next to a ChatServer listening on a free
+    port. connect(name, **options) logs in and returns a ChatClient once the
+    server has sent it the client and rooms lists, or SESSION when the options
+    resume one.
+    """
+    server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_context.load_cert_chain(certfile=CERTIFICATE, keyfile=CERTIFICATE)
+    client_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    client_context.check_hostname = False
+    client_context.verify_mode = ssl.CERT_NONE
+
+    def run(test, **options):
+        options = dict(history_directory=str(tmp_path / "history"), state_directory=str(tmp_path / "state"),
+                       stats_interval=0, snapshot_interval=0, **options)
+
+        async def main():
+            loop = asyncio.get_running_loop()
+            server = ChatServer(0, context=server_context, **options)
+            serving = loop.create_task(server.serve())
+            while server.server is None or not server.server.sockets:
+                await asyncio.sleep(0.01)
+            host, port = server.server.sockets[0].getsockname()[:2]
+
+            async def connect(name, **login_options):
+                transport, stream = await loop.create_connection(FrameStream, host, port, ssl=client_context,
+                                                                 server_hostname="localhost")
+                client = ChatClient(server, name, stream)
+                client.send("LOGIN", name, login_options)
+                await client.receive_until("SESSION" if "token" in login_options else "UPDATE_ROOMS_LIST")
+                return client
+
+            try:
+                await asyncio.wait_for(test(server, connect), 10)
+            finally:
+                server.sighandler()
+                await serving
+                server.history.close_all()
+
+        asyncio.run(main())
+
+    return run
@@ -0,0 +1,69 @@
+import pytest
+
+from history import MessageStore
+from utils import *
+
+
+def fill(store, key, count, after_id=0):
+    return [store.append(key, "user" + str(i % 3), float(i), "message " + str(i), after_id) for i in range(count)]
+
+
+def ids(messages):
+    return [message.id for message in messages]
+
+
+def test_pages_of_older_messages_cross_segments(tmp_path):
+    # Small segments, strides and memory, so pages come from several segments and strides.
+    store = MessageStore(str(tmp_path), memory_limit=10, segment_size=1024, index_stride=4)
+    fill(store, "room-1", 200)
+    conversation = store.open("room-1")
+    assert len(conversation.segments) > 5
+    boundary = conversation.segments[3]
+    assert ids(store.page("room-1", boundary + 2, 7)) == list(range(boundary - 5, boundary + 2))
+    assert ids(store.page("room-1", 0, 30)) == list(range(171, 201))
+    assert ids(store.page("room-1", 5, 50)) == [1, 2, 3, 4]
+    assert ids(store.since("room-1", boundary - 3, 6)) == list(range(boundary - 2, boundary + 4))
+    assert [message.text for message in store.page("room-1", 3, 2)] == ["message 0", "message 1"]
+
+    # After a restart the indexes are made again from the segments.
+    store.close_all()
+    store = MessageStore(str(tmp_path), memory_limit=10, segment_size=1024, index_stride=4)
+    assert ids(store.page("room-1", boundary + 2, 7)) == list(range(boundary - 5, boundary + 2))
+    assert ids(store.since("room-1", 0, 200)) == list(range(1, 201))
+    assert store.append("room-1", "alice", 1.0, "back") == 201
+    assert ids(store.page("room-1", 0, 12)) == list(range(190, 202))
+
+
+def test_pages_skip_the_ids_a_continued_conversation_jumped(tmp_path):
+    store = MessageStore(str(tmp_path), memory_limit=5, segment_size=512, index_stride=4)
+    fill(store, "room-1", 10)
+    fill(store, "room-1", 10, after_id=1000)
+    assert ids(store.page("room-1", 1003, 6)) == [7, 8, 9, 10, 1001, 1002]
+    assert ids(store.since("room-1", 8, 4)) == [9, 10, 1001, 1002]
+
+
+def test_text_that_is_not_utf8_is_not_stored(tmp_path):
+    store = MessageStore(str(tmp_path))
+    store.append("room-1", "alice", 1.0, "hello")
+    with pytest.raises(UnicodeEncodeError):
+        store.append("room-1", "alice", 2.0, "\ud800")
+    assert store.append("room-1", "alice", 3.0, "again") == 2
+    store.close_all()
+    assert [message.text for message in MessageStore(str(tmp_path)).page("room-1")] == ["hello", "again"]
+
+
+async def message_that_is_not_utf8(server, connect):
+    alice = await connect("alice")
+    alice.send("CREATE_ROOM")
+    await alice.receive_until("CREATE_ROOM")
+    alice.send("GROUP_MESSAGE", "Room1 by alice", "stored")
+    await alice.receive_until("GROUP_MESSAGE")
+    # Pickle can carry a lone surrogate, which the binary codec would not encode.
+    alice.stream.write(pack_command("GROUP_MESSAGE", "Room1 by alice", "\ud800", codec=PICKLE_CODEC))
+    while (await alice.receive())[0]:
+        pass
+    assert [message.text for message in server.history.page("room-1")] == ["stored"]
+
+
+def test_server_rejects_messages_that_are_not_utf8(chat_server):
+    chat_server(message_that_is_not_utf8)
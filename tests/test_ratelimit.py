@@ -0,0 +1,92 @@
+import ratelimit
+from ratelimit import RateLimit, TokenBucket
+from server import RATE_LIMITED
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket_allows_a_burst_then_keeps_to_the_rate(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, "monotonic", clock)
+    bucket = TokenBucket(RateLimit(2, 3))
+    for i in range(3):
+        assert bucket.wait() == 0
+        bucket.take()
+    assert bucket.wait() == 0.5
+    clock.now += 0.25
+    assert bucket.wait() == 0.25
+    clock.now += 0.25
+    assert bucket.wait() == 0
+    # Tokens never pile up past the burst.
+    clock.now += 60
+    bucket.wait()
+    assert bucket.tokens == 3
+
+
+def test_changing_a_limit_changes_every_bucket(monkeypatch):
+    monkeypatch.setattr(ratelimit.time, "monotonic", Clock())
+    limit = RateLimit(1, 1)
+    buckets = [TokenBucket(limit) for i in range(2)]
+    for bucket in buckets:
+        bucket.take()
+        assert bucket.wait() == 1
+    limit.rate = 0
+    assert [bucket.wait() for bucket in buckets] == [0, 0]
+    assert repr(limit) == 'off'
+
+
+async def ping(client, count):
+    """ Sends count pings at once, and returns the commands that came back """
+    for i in range(count):
+        client.send("PING")
+    received = []
+    while len(received) < count:
+        command, args = await client.receive()
+        received.append((command,) + args[:3])
+        if not command:
+            break
+    return received
+
+
+def test_drop_policy_drops_commands_over_the_limit(chat_server):
+    async def test(server, connect):
+        dropped = ("THROTTLED", "PING", "client", "dropped")
+        assert await ping(await connect("alice"), 4) == [("PONG",), ("PONG",), dropped, dropped]
+    chat_server(test, client_rate=1, client_burst=2, rate_policy="drop")
+
+
+def test_disconnect_policy_closes_the_connection(chat_server):
+    async def test(server, connect):
+        assert await ping(await connect("alice"), 4) == [("PONG",), ("THROTTLED", "PING", "client", "disconnected"),
+                                                         ("",)]
+        assert "alice" not in server.sessions
+    chat_server(test, client_rate=1, client_burst=1, rate_policy="disconnect")
+
+
+def test_delay_policy_holds_commands_back(chat_server):
+    delayed = RATE_LIMITED["client", "delayed"].value
+
+    async def test(server, connect):
+        assert await ping(await connect("alice"), 3) == [("PONG",)] * 3
+    chat_server(test, client_rate=50, client_burst=1, rate_policy="delay", max_delay=1)
+    assert RATE_LIMITED["client", "delayed"].value == delayed + 2
+
+
+def test_rooms_have_a_limit_of_their_own(chat_server):
+    async def test(server, connect):
+        client = await connect("alice")
+        client.send("CREATE_ROOM")
+        await client.receive_until("CREATE_ROOM")
+        for text in ("one", "two"):
+            client.send("GROUP_MESSAGE", "Room1 by alice", text)
+        sent = [(command, args) for command, args in await client.sync() if command != "ROOM_ADDED"]
+        assert [command for command, args in sent] == ["GROUP_MESSAGE", "THROTTLED"]
+        assert sent[0][1][1].endswith(": one")
+        assert sent[1][1][:3] == ("GROUP_MESSAGE", "room", "dropped")
+    chat_server(test, client_rate=0, room_rate=1, room_burst=1, rate_policy="drop")
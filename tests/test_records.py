@@ -0,0 +1,47 @@
+import os
+
+from history import MessageStore
+from state import RoomState, StateStore
+
+
+def test_message_store_drops_a_torn_record(tmp_path):
+    store = MessageStore(str(tmp_path))
+    for i in range(3):
+        store.append("room-1", "alice", 1.0 + i, "hello " + str(i))
+    store.close_all()
+    segment = os.path.join(str(tmp_path), "room-1", os.listdir(os.path.join(str(tmp_path), "room-1"))[0])
+    intact = os.path.getsize(segment)
+    with open(segment, 'ab') as file:
+        file.write(MessageStore.RECORD.pack(100, 4, 4.0, 5) + b"ali")
+
+    store = MessageStore(str(tmp_path))
+    assert [message.text for message in store.page("room-1")] == ["hello 0", "hello 1", "hello 2"]
+    assert os.path.getsize(segment) == intact
+    assert store.append("room-1", "bob", 5.0, "back") == 4
+    assert [message.sender for message in store.since("room-1", 2)] == ["alice", "bob"]
+
+
+def test_state_store_replays_the_log_on_the_snapshot(tmp_path):
+    store = StateStore(str(tmp_path))
+    store.load()
+    store.snapshot([RoomState(1, "Room1 by alice", 7, ["alice", "bob"]), RoomState(2, "Room2 by bob", 0, ["bob"])])
+    room = RoomState(3, "Room3 by ü")
+    store.room_added(room)
+    store.member_added(room, "ü")
+    store.room_removed(RoomState(2, "Room2 by bob"))
+    store.member_added(RoomState(1, "Room1 by alice"), "carol")
+    store.close()
+    intact = os.path.getsize(store.log_path)
+    with open(store.log_path, 'ab') as file:
+        file.write(StateStore.RECORD.pack(40, StateStore.MEMBER_ADDED, 1) + b"da")
+
+    store = StateStore(str(tmp_path))
+    rooms = store.load()
+    assert {room_id: (room.name, room.last_message_id, room.members) for room_id, room in rooms.items()} == {
+        1: ("Room1 by alice", 7, ["alice", "bob", "carol"]),
+        3: ("Room3 by ü", 0, ["ü"]),
+    }
+    assert os.path.getsize(store.log_path) == intact
+    store.close(rooms.values())
+    assert os.path.getsize(store.log_path) == 0
+    assert StateStore(str(tmp_path)).read_snapshot().keys() == {1, 3}
@@ -0,0 +1,110 @@
+from datetime import datetime
+
+from server import RemoteSession, RoomRegistry
+from state import RoomState
+
+
+class RoomLog(object):
+    """ Records what a RoomRegistry passes on to its log """
+
+    def __init__(self):
+        self.changes = []
+
+    def room_added(self, room):
+        self.changes.append(("added", room.id))
+
+    def room_removed(self, room):
+        self.changes.append(("removed", room.id))
+
+    def member_added(self, room, name):
+        self.changes.append(("member", room.id, name))
+
+
+def session(name):
+    return RemoteSession(None, name, datetime.now())
+
+
+def test_registry_tracks_members_and_their_rooms():
+    rooms = RoomRegistry()
+    alice, bob = session("alice"), session("bob")
+    first = rooms.create(alice)
+    second = rooms.create(bob)
+    assert (first.id, first.name) == (1, "Room1 by alice")
+    assert rooms.get(first.name) is rooms.by_id[1] is first
+    assert rooms.add_member(first, "bob", bob)
+    assert not rooms.add_member(first, "bob", bob)
+    assert list(first.members) == ["alice", "bob"]
+    assert first.online == 2
+    assert rooms.memberships == {"alice": {first}, "bob": {first, second}}
+    assert rooms.add_member(second, "carol", None)
+    assert second.online == 1
+
+
+def test_registry_numbers_rooms_per_worker():
+    rooms = RoomRegistry(first_id=5, worker=2, step=4)
+    assert [rooms.create(session("alice")).id for i in range(3)] == [6, 10, 14]
+
+
+def test_registry_removes_rooms_nobody_is_online_in():
+    rooms = RoomRegistry()
+    alice, bob = session("alice"), session("bob")
+    shared = rooms.create(alice)
+    rooms.add_member(shared, "bob", bob)
+    own = rooms.create(alice)
+    assert rooms.set_offline("alice") == [own]
+    assert rooms.get(own.name) is None
+    assert shared.members == {"alice": None, "bob": bob}
+    assert shared.online == 1
+
+    # Coming back points the room at the new session.
+    again = session("alice")
+    rooms.set_online(again)
+    assert shared.members["alice"] is again
+    assert shared.online == 2
+
+    rooms.set_offline("alice")
+    assert rooms.set_offline("bob") == [shared]
+    assert list(rooms) == []
+    assert rooms.memberships == {}
+
+
+def test_registry_leaves_removing_rooms_to_their_home():
+    rooms = RoomRegistry(worker=0, step=2, home=lambda room_id: room_id % 2)
+    here = rooms.add(2, "Room2 by alice")
+    there = rooms.add(3, "Room3 by alice")
+    for room in (here, there):
+        rooms.add_member(room, "alice", session("alice"))
+    assert rooms.is_home(here) and not rooms.is_home(there)
+    assert rooms.set_offline("alice") == [here]
+    assert list(rooms) == [there]
+    assert there.online == 0
+
+
+def test_registry_logs_changes_but_not_restored_rooms():
+    rooms = RoomRegistry()
+    rooms.log = log = RoomLog()
+    restored = rooms.restore(RoomState(7, "Room7 by alice", 12, ["alice", "bob"]))
+    assert (restored.members, restored.online, restored.last_message_id) == ({"alice": None, "bob": None}, 0, 12)
+    assert rooms.memberships == {"alice": {restored}, "bob": {restored}}
+    assert log.changes == []
+
+    room = rooms.create(session("carol"))
+    rooms.add_member(room, "dave", None)
+    rooms.remove(room)
+    assert log.changes == [("added", 1), ("member", 1, "carol"), ("member", 1, "dave"), ("removed", 1)]
+
+
+async def room_deltas(server, connect):
+    alice = await connect("alice")
+    bob = await connect("bob")
+    joined = server.sessions["bob"].time.timestamp()
+    bob.send("CREATE_ROOM")
+    await bob.receive_until("CREATE_ROOM")
+    room = server.chat_rooms.get("Room1 by bob")
+    await bob.close()
+    assert await alice.sync() == [("CLIENT_JOINED", ("bob", joined)), ("ROOM_ADDED", (room.id, room.name)),
+                                  ("CLIENT_LEFT", ("bob",)), ("ROOM_REMOVED", (room.id, room.name))]
+
+
+def test_clients_hear_about_rooms_as_deltas(chat_server):
+    chat_server(room_deltas)
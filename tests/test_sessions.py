@@ -0,0 +1,73 @@
+from datetime import datetime
+
+from server import Session
+
+
+class FullStream(object):
+    """ Has room for a few frames and drops the rest, the way the "drop" overflow policy does """
+
+    def __init__(self, room):
+        self.room = room
+        self.frames = []
+        self.dropped = 0
+
+    def write(self, frame):
+        if len(self.frames) < self.room:
+            self.frames.append(frame)
+        else:
+            self.dropped += 1
+
+
+def test_frames_the_stream_dropped_are_not_replayed():
+    stream = FullStream(2)
+    session = Session(stream, ("127.0.0.1", 1), "alice", datetime.now())
+    session.keep_replay(1024)
+    for text in ("one", "two", "three"):
+        session.send("MESSAGE", text, "bob")
+    assert session.sent == 2
+    assert session.replay_since(0) == stream.frames
+    assert session.replay_since(3) is None
+
+
+def test_replay_keeps_the_latest_frames():
+    stream = FullStream(10)
+    session = Session(stream, ("127.0.0.1", 1), "alice", datetime.now())
+    session.keep_replay(2 * len(session.encode("MESSAGE", "one", "bob")))
+    for text in ("one", "two", "six"):
+        session.send("MESSAGE", text, "bob")
+    assert session.replay_since(1) == stream.frames[1:]
+    assert session.replay_since(3) == []
+    assert session.replay_since(0) is None
+
+
+async def resume_after_changes(server, connect):
+    alice = await connect("alice", resumable=True)
+    carol = await connect("carol")
+    await alice.sync()
+    await alice.drop()
+    # To everyone else alice is still online.
+    assert await carol.sync() == []
+
+    # While alice is away a client comes, makes a room, writes to her and goes, and another leaves.
+    bob = await connect("bob")
+    joined = server.sessions["bob"].time.timestamp()
+    bob.send("CREATE_ROOM")
+    await bob.receive_until("CREATE_ROOM")
+    room = server.chat_rooms.get("Room1 by bob")
+    bob.send("MESSAGE", "alice", "hi")
+    await bob.receive_until("MESSAGE")
+    await bob.close()
+    await carol.close()
+
+    again = await connect("alice", resumable=True, token=alice.token, received=alice.received)
+    replayed = await again.sync()
+    assert [command for command, args in replayed] == ["CLIENT_JOINED", "ROOM_ADDED", "MESSAGE", "CLIENT_LEFT",
+                                                       "ROOM_REMOVED", "CLIENT_LEFT"]
+    assert replayed[0][1] == ("bob", joined)
+    assert replayed[1][1] == replayed[4][1] == (room.id, room.name)
+    assert replayed[2][1][0].endswith(": hi") and replayed[2][1][1] == "bob"
+    assert replayed[3][1] == ("bob",) and replayed[5][1] == ("carol",)
+
+
+def test_resume_replays_presence_and_room_changes(chat_server):
+    chat_server(resume_after_changes)
@@ -0,0 +1,93 @@
+import pytest
+
+from utils import *
+
+
+def test_frame_decoder_waits_for_a_whole_header():
+    frame = pack_command("MESSAGE", "bob", "hello")
+    decoder = FrameDecoder()
+    for byte in frame[:FRAME_HEADER.size]:
+        decoder.feed(bytes((byte,)))
+        assert decoder.next_frame() is None
+    decoder.feed(frame[FRAME_HEADER.size:])
+    assert unpack_command(decoder.next_frame()) == ("MESSAGE", ("bob", "hello"))
+    assert decoder.next_frame() is None
+
+
+def test_frame_decoder_splits_frames_read_together():
+    frames = [pack_command("MESSAGE", "bob", str(i)) for i in range(3)]
+    decoder = FrameDecoder(size=16)
+    decoder.feed(b"".join(frames))
+    for i in range(3):
+        assert unpack_command(decoder.next_frame()) == ("MESSAGE", ("bob", str(i)))
+    assert decoder.next_frame() is None
+
+
+def test_frame_decoder_reads_legacy_frames():
+    data = pack("LOGIN") + pack_list(["alice", "bob"])
+    decoder = FrameDecoder()
+    decoder.feed(data[:FrameDecoder.LEGACY_HEADER_SIZE - 1])
+    assert decoder.next_frame() is None
+    decoder.feed(data[FrameDecoder.LEGACY_HEADER_SIZE - 1:])
+    assert unpack_command(decoder.next_frame()) == ("LOGIN", None)
+    assert safe_loads(decoder.next_frame()) == ["alice", "bob"]
+
+
+@pytest.mark.parametrize("padding", [b"\x02", b"\x00\x00\x00\x00"], ids=["v2", "legacy"])
+def test_frame_decoder_rejects_oversized_frames(padding):
+    decoder = FrameDecoder()
+    decoder.feed(FRAME_HEADER.pack(MAX_FRAME_SIZE + 1) + padding)
+    with pytest.raises(ProtocolError):
+        decoder.next_frame()
+    # Nothing was allocated for the frame.
+    assert len(decoder.writable()) < MAX_FRAME_SIZE
+
+
+@pytest.mark.parametrize("codec", list(CODECS.values()), ids=lambda codec: codec.name)
+def test_codecs_round_trip(codec):
+    args = ("alice", None, True, False, -2 ** 40, 1.5, b"\x00\xff", ["a", "b\0c", "ü"], ["x", 1, [2, {"k": "v"}]],
+            [3, -2 ** 40], [1, True], {"flush_delay": 0, "compression": ["zlib"]}, [], "")
+    frame = pack_command("LOGIN", *args, codec=codec)
+    assert unpack_command(frame[FRAME_HEADER.size:]) == ("LOGIN", args)
+
+
+def test_compressed_frames_round_trip():
+    names = ["user" + str(i) for i in range(500)]
+    frame = pack_command("CLIENT_LIST", names, compression=ZLIB_COMPRESSION)
+    assert len(frame) < len(pack_command("CLIENT_LIST", names))
+    assert unpack_command(frame[FRAME_HEADER.size:]) == ("CLIENT_LIST", (names,))
+
+
+def envelope(body, command="LOGIN"):
+    return ENVELOPE_HEADER.pack(PROTOCOL_VERSION, BINARY_CODEC.id, COMMAND_IDS[command]) + body
+
+
+@pytest.mark.parametrize("buf", [
+    envelope(b""),
+    envelope(b"\xff"),
+    envelope(bytes((BinaryCodec.STR,)) + BinaryCodec.LENGTH.pack(1)),
+    envelope(bytes((BinaryCodec.LIST,)) + BinaryCodec.LENGTH.pack(2) + bytes((BinaryCodec.NONE,))),
+    envelope(bytes((BinaryCodec.LIST,)) + BinaryCodec.LENGTH.pack(1) + bytes((BinaryCodec.NONE, BinaryCodec.NONE))),
+    envelope(bytes((BinaryCodec.STR_JOINED,)) + BinaryCodec.LENGTHS.pack(3, 3) + b"a\0b"),
+    envelope(bytes((BinaryCodec.LIST,)) + BinaryCodec.LENGTH.pack(1) + bytes((BinaryCodec.INT_LIST,)) +
+             BinaryCodec.LENGTH.pack(2) + BinaryCodec.INT_VALUE.pack(1)),
+    envelope(bytes((BinaryCodec.LIST,)) + BinaryCodec.LENGTH.pack(1) + bytes((BinaryCodec.INT_LIST,)) +
+             BinaryCodec.LENGTH.pack(2 ** 32 - 1)),
+    envelope(bytes((BinaryCodec.LIST,)) + BinaryCodec.LENGTH.pack(1) + bytes((BinaryCodec.STR,)) +
+             BinaryCodec.LENGTH.pack(2) + b"\xff\xfe"),
+    ENVELOPE_HEADER.pack(PROTOCOL_VERSION, 0x0f, 0),
+    ENVELOPE_HEADER.pack(PROTOCOL_VERSION, BINARY_CODEC.id | 0x30, 0) + b"x",
+    ENVELOPE_HEADER.pack(PROTOCOL_VERSION, BINARY_CODEC.id, 255),
+    b"\x80\x04\x95",
+], ids=["empty", "unknown tag", "short string", "short list", "trailing data", "bad joined list",
+        "short int list", "huge int list",
+        "bad utf-8", "bad codec", "bad compression", "bad command", "bad pickle"])
+def test_malformed_frames_raise_protocol_error(buf):
+    with pytest.raises(ProtocolError):
+        unpack_command(buf)
+
+
+def test_deeply_nested_frames_raise_protocol_error():
+    nested = (bytes((BinaryCodec.LIST,)) + BinaryCodec.LENGTH.pack(1)) * 5000 + bytes((BinaryCodec.NONE,))
+    with pytest.raises(ProtocolError):
+        unpack_command(envelope(bytes((BinaryCodec.LIST,)) + BinaryCodec.LENGTH.pack(1) + nested))
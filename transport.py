@@ -0,0 +1,295 @@
+import random
+import select
+import selectors
+import socket
+import ssl
+import threading
+import time
+
+from utils import *
+
+
+class ClientTransport(object):
+    """
+    The connection of a client to the server, with one thread that does all
+    of its I/O so the caller never waits on the network.
+
+    send_command() may be called from any thread. Frames are queued and the
+    I/O thread writes everything queued with one send, delay seconds after
+    the first frame (at once when delay is 0).
+
+    Commands from the server are decoded on the I/O thread and kept in an
+    inbox. on_events() is called when the inbox stops being empty, and the
+    caller takes them with take_events(), so a burst that arrives while the
+    caller is busy is handed over in one go. on_failed(message) is called
+    when the connection can not be made and on_closed() when it ends.
+    Pings are answered on the I/O thread.
+
+    When the server gave the session a token, a connection that drops is
+    made again after a growing delay, on_reconnecting(delay) is called
+    before each wait. The login is sent again with the token and the number
+    of frames received, so the server sends only the ones that were missed.
+    Frames queued meanwhile are sent once the session is resumed.
+    """
+
+    CONNECT_TIMEOUT = 10
+    # Seconds before the first attempt to reconnect, doubled on every attempt up to the most.
+    RECONNECT_DELAY = 0.5
+    MAX_RECONNECT_DELAY = 30
+
+    def __init__(self, host, port, context, session=None, delay=0, on_events=None, on_failed=None, on_closed=None,
+                 on_reconnecting=None):
+        self.host = host
+        self.port = port
+        self.context = context
+        self.session = session
+        self.delay = delay
+        self.on_events = on_events
+        self.on_failed = on_failed
+        self.on_closed = on_closed
+        self.on_reconnecting = on_reconnecting
+
+        self.sock = None
+        self.decoder = FrameDecoder()
+        self.lock = threading.Lock()
+        self.outbox = []
+        self.first_queued = 0
+        self.unsent = b''
+        self.inbox = []
+        self.notified = False
+        self.closing = False
+        # Whether the server has been asked to end the session, and has ended it.
+        self.ending = False
+        self.ended = False
+        # The login name and options, the session token and the frames received in the session.
+        self.login = None
+        self.token = None
+        self.received = 0
+        self.attempts = 0
+        # Wakes the I/O thread up when a frame is queued.
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="client-io", daemon=True)
+        self.thread.start()
+
+    def log_in(self, name, options):
+        """ Queues the login, it is sent again with the session token every time the connection is made again """
+        self.login = (name, options)
+        self.send_command("LOGIN", name, options)
+
+    def send_command(self, command, *args):
+        frame = pack_command(command, *args)
+        with self.lock:
+            if not self.outbox:
+                self.first_queued = time.monotonic()
+            self.outbox.append(frame)
+        self.wake()
+
+    def close(self):
+        """ Asks the server to end the connection, the thread stops once it has """
+        self.ending = True
+        self.send_command("END")
+
+    def abort(self):
+        """ Stops the I/O thread without waiting for the server """
+        self.closing = True
+        self.wake()
+
+    def wake(self):
+        try:
+            self.wakeup_writer.send(b'\0')
+        except (BlockingIOError, OSError):
+            # A wake up is already pending, or the thread is gone.
+            pass
+
+    def take_events(self, limit=None):
+        """ Returns up to limit of the commands received, as (command, args), and whether more are waiting """
+        with self.lock:
+            if limit is None or len(self.inbox) <= limit:
+                events = self.inbox
+                self.inbox = []
+            else:
+                events = self.inbox[:limit]
+                del self.inbox[:limit]
+            self.notified = bool(self.inbox)
+            return events, self.notified
+
+    def run(self):
+        failed = False
+        try:
+            while not self.closing:
+                if self.connect():
+                    if self.serve():
+                        print('Client shutting down.')
+                        break
+                elif self.token is None:
+                    # Never got in, so the server is not there.
+                    failed = True
+                    break
+                if self.token is None or self.ending:
+                    break
+                delay = min(self.MAX_RECONNECT_DELAY, self.RECONNECT_DELAY * 2 ** self.attempts)
+                # Spread out the clients that lost their connections at the same time.
+                delay *= random.uniform(0.5, 1)
+                self.attempts += 1
+                print(f'Reconnecting in {delay:.1f} seconds.')
+                if self.on_reconnecting is not None:
+                    self.on_reconnecting(delay)
+                if not self.wait(delay):
+                    break
+                self.queue_login()
+        finally:
+            self.closed()
+        if failed:
+            if self.on_failed is not None:
+                self.on_failed(f'Failed to connect to chat server @ port {self.port}')
+        elif self.on_closed is not None:
+            self.on_closed()
+
+    def connect(self):
+        try:
+            sock = socket.create_connection((self.host, self.port), self.CONNECT_TIMEOUT)
+            self.sock = self.context.wrap_socket(sock, server_hostname=self.host, session=self.session)
+        except (OSError, ssl.SSLError) as e:
+            print(e)
+            return False
+        self.sock.setblocking(False)
+        return True
+
+    def serve(self):
+        """ Runs the connection, returns True when the session has ended and False when the connection dropped """
+        selector = selectors.DefaultSelector()
+        selector.register(self.sock, selectors.EVENT_READ)
+        selector.register(self.wakeup_reader, selectors.EVENT_READ)
+        try:
+            while not self.closing:
+                timeout = self.write_timeout()
+                if timeout == 0:
+                    self.write()
+                    timeout = self.write_timeout()
+                events = selectors.EVENT_READ | (selectors.EVENT_WRITE if self.unsent else 0)
+                selector.modify(self.sock, events)
+                for key, mask in selector.select(timeout):
+                    if key.fileobj is self.wakeup_reader:
+                        self.drain_wakeups()
+                    elif mask & selectors.EVENT_WRITE:
+                        self.write()
+                    if key.fileobj is self.sock and mask & selectors.EVENT_READ and not self.read():
+                        return self.ended
+        except (OSError, ssl.SSLError, ProtocolError) as e:
+            print(e)
+        finally:
+            selector.close()
+            self.sock.close()
+            # What was left of the connection is of no use to the next one.
+            self.decoder = FrameDecoder()
+            self.unsent = b''
+        return self.closing
+
+    def wait(self, delay):
+        """ Waits delay seconds before reconnecting, returns False when the transport was closed meanwhile """
+        deadline = time.monotonic() + delay
+        while not self.closing and not self.ending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return True
+            select.select([self.wakeup_reader], [], [], remaining)
+            self.drain_wakeups()
+        return False
+
+    def queue_login(self):
+        """ Puts the login, resuming the session, ahead of the frames queued while disconnected """
+        name, options = self.login
+        frame = pack_command("LOGIN", name, dict(options, token=self.token, received=self.received))
+        with self.lock:
+            self.outbox.insert(0, frame)
+            self.first_queued = time.monotonic()
+
+    def write_timeout(self):
+        """ Seconds until the queued frames are due, None when nothing is queued """
+        if self.unsent:
+            return None
+        with self.lock:
+            if not self.outbox:
+                return None
+            return max(0.0, self.first_queued + self.delay - time.monotonic())
+
+    def drain_wakeups(self):
+        try:
+            while self.wakeup_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def write(self):
+        if not self.unsent:
+            with self.lock:
+                frames = self.outbox
+                self.outbox = []
+            self.unsent = memoryview(b''.join(frames))
+        while self.unsent:
+            try:
+                sent = self.sock.send(self.unsent)
+            except (ssl.SSLWantWriteError, ssl.SSLWantReadError, BlockingIOError):
+                return
+            self.unsent = self.unsent[sent:]
+
+    def read(self):
+        """ Reads and decodes everything available, returns False when the connection has ended """
+        events = []
+        ended = False
+        while True:
+            view = self.decoder.writable()
+            try:
+                count = self.sock.recv_into(view)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError):
+                break
+            finally:
+                view.release()
+            if not count:
+                ended = True
+                break
+            self.decoder.advance(count)
+            # Frames are views of the buffer, so they are decoded before the next read.
+            frame = self.decoder.next_frame()
+            while frame is not None:
+                command, args = unpack_command(frame)
+                if command == "SESSION":
+                    # Frames are counted from the start of the session, it starts again unless it was resumed.
+                    token, resumed = args
+                    self.token = token
+                    if not resumed:
+                        self.received = 0
+                    self.attempts = 0
+                    events.append((command, args))
+                else:
+                    self.received += 1
+                    if command == "PING":
+                        self.send_command("PONG")
+                    elif command == "END":
+                        ended = True
+                        self.ended = True
+                    else:
+                        events.append((command, args))
+                frame = self.decoder.next_frame()
+        if events:
+            # The server sends its session tickets after the handshake, with the first data.
+            self.session = self.sock.session
+            self.deliver(events)
+        return not ended
+
+    def deliver(self, events):
+        with self.lock:
+            self.inbox.extend(events)
+            notify = not self.notified
+            self.notified = True
+        if notify and self.on_events is not None:
+            self.on_events()
+
+    def closed(self):
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
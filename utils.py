@@ -1,70 +1,649 @@
+import asyncio
+import io
+import itertools
 import socket
 import pickle
 import struct
+import zlib
 
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
 
-def send(channel, *args):
+
+def pack(*args):
+    """ Build a version 1 frame holding args, as bytes """
     buffer = pickle.dumps(args)
     value = socket.htonl(len(buffer))
-    size = struct.pack("L", value)
-    channel.send(size)
-    channel.send(buffer)
-
-
-def receive(channel):
-    size = struct.calcsize("L")
-    size = channel.recv(size)
-    try:
-        size = socket.ntohl(struct.unpack("L", size)[0])
-    except struct.error as e:
-        return ''
-    buf = ""
-    while len(buf) < size:
-        buf = channel.recv(size - len(buf))
-    return pickle.loads(buf)[0]
+    return struct.pack("L", value) + buffer
 
 
-def send_clients(channel, clients):
+def pack_list(clients):
+    """ Build a version 1 frame holding a list, as bytes """
     buffer = pickle.dumps(clients)
     value = socket.htonl(len(buffer))
-    size = struct.pack("L", value)
-    channel.send(size)
-    channel.send(buffer)
+    return struct.pack("L", value) + buffer
+
+
+# Version 2 protocol: a command and all of its arguments travel in a single
+# frame, prefixed by its length as a network order 32 bit integer.
+# The frame payload starts with a compact header of
+# (version, flags, command id) followed by the argument tuple, encoded with
+# the codec named by the low bits of the flags. The next two bits name the
+# compression of the encoded arguments, 0 when they are not compressed.
+# Version 1 frames carry one pickled value each, and since a pickle always
+# starts with 0x80 they can never be mistaken for a version 2 header.
+PROTOCOL_VERSION = 2
+COMMANDS = (
+    "LOGIN",
+    "END",
+    "MESSAGE",
+    "CREATE_ROOM",
+    "JOIN_ROOM",
+    "UPDATE_INVITE_WINDOW",
+    "INVITE",
+    "INVITED",
+    "GROUP_MESSAGE",
+    "CLIENT_LIST",
+    "UPDATE_ROOMS_LIST",
+    "CLIENT_JOINED",
+    "CLIENT_LEFT",
+    "ROOM_ADDED",
+    "ROOM_REMOVED",
+    "HISTORY",
+    "THROTTLED",
+    "PING",
+    "PONG",
+    "SESSION",
+)
+COMMAND_IDS = {command: i for i, command in enumerate(COMMANDS)}
+ENVELOPE_HEADER = struct.Struct("!BBB")
+FRAME_HEADER = struct.Struct("!I")
+
+
+FLAG_CODEC_MASK = 0x0f
+FLAG_COMPRESSION_MASK = 0x30
+FLAG_COMPRESSION_SHIFT = 4
+
+
+class ProtocolError(Exception):
+    """ Raised when a frame can not be decoded """
+
+
+class SafeUnpickler(pickle.Unpickler):
+    """
+    Unpickler that refuses to load any class or function, so untrusted
+    frames can only produce plain values such as strings and lists.
+    """
+
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f'{module}.{name} is not allowed')
+
+
+def safe_loads(buf):
+    return SafeUnpickler(io.BytesIO(buf)).load()
+
+
+class PickleCodec(object):
+    """ Pickle encoding, only kept for clients that ask for it """
+    id = 1
+    name = "pickle"
+
+    def encode(self, args):
+        return pickle.dumps(args)
+
+    def decode(self, buf):
+        return safe_loads(buf)
+
+
+class BinaryCodec(object):
+    """
+    Compact msgpack style encoding. Every value is a one byte tag followed by
+    a struct packed length or number, strings are sent as UTF-8. Lists of
+    strings, the most common payload, are sent as one block of NUL separated
+    text (or a table of lengths when an item contains a NUL) and lists of
+    ints, the message ids of a history page, as one block of numbers, so they
+    are encoded and decoded in a single pass. Lists and dicts may be nested
+    MAX_DEPTH deep, so a frame can not exhaust the stack of the decoder.
+    """
+    id = 0
+    name = "binary"
+
+    NONE, FALSE, TRUE, INT, FLOAT, STR, BYTES, LIST, DICT, STR_LIST, STR_JOINED, INT_LIST = range(12)
+    LENGTH = struct.Struct("!I")
+    LENGTHS = struct.Struct("!II")
+    INT_VALUE = struct.Struct("!q")
+    FLOAT_VALUE = struct.Struct("!d")
+    MAX_DEPTH = 32
+
+    def encode(self, args):
+        parts = []
+        self.encode_value(list(args), parts)
+        return b"".join(parts)
+
+    def encode_value(self, value, parts):
+        if isinstance(value, str):
+            data = value.encode()
+            parts.append(bytes((self.STR,)) + self.LENGTH.pack(len(data)))
+            parts.append(data)
+        elif value is None:
+            parts.append(bytes((self.NONE,)))
+        elif value is True or value is False:
+            parts.append(bytes((self.TRUE if value else self.FALSE,)))
+        elif isinstance(value, int):
+            parts.append(bytes((self.INT,)) + self.INT_VALUE.pack(value))
+        elif isinstance(value, float):
+            parts.append(bytes((self.FLOAT,)) + self.FLOAT_VALUE.pack(value))
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            parts.append(bytes((self.BYTES,)) + self.LENGTH.pack(len(value)))
+            parts.append(bytes(value))
+        elif isinstance(value, (list, tuple)):
+            if value and all(type(item) is str for item in value):
+                text = "\0".join(value)
+                if text.count("\0") == len(value) - 1:
+                    # The items are split again on the NUL separators.
+                    data = text.encode()
+                    parts.append(bytes((self.STR_JOINED,)) + self.LENGTHS.pack(len(value), len(data)))
+                else:
+                    # One length per item, in characters, then all of the text.
+                    data = "".join(value).encode()
+                    parts.append(bytes((self.STR_LIST,)) + self.LENGTHS.pack(len(value), len(data)))
+                    parts.append(struct.pack(f'!{len(value)}I', *map(len, value)))
+                parts.append(data)
+            elif value and all(type(item) is int for item in value):
+                parts.append(bytes((self.INT_LIST,)) + self.LENGTH.pack(len(value)))
+                parts.append(struct.pack(f'!{len(value)}q', *value))
+            else:
+                parts.append(bytes((self.LIST,)) + self.LENGTH.pack(len(value)))
+                for item in value:
+                    self.encode_value(item, parts)
+        elif isinstance(value, dict):
+            parts.append(bytes((self.DICT,)) + self.LENGTH.pack(len(value)))
+            for key, item in value.items():
+                self.encode_value(key, parts)
+                self.encode_value(item, parts)
+        else:
+            raise TypeError(f'can not encode {type(value).__name__}')
+
+    def decode(self, buf):
+        # The body is copied once, slicing and decoding bytes is quicker than going through memoryviews.
+        buf = bytes(buf)
+        value, offset = self.decode_value(buf, 0)
+        if offset != len(buf) or not isinstance(value, list):
+            raise ValueError('malformed binary frame')
+        return tuple(value)
+
+    # The tags are tested roughly in order of how often they are sent.
+    def decode_value(self, buf, offset, depth=0):
+        tag = buf[offset]
+        offset += 1
+        if tag == self.STR:
+            size, = self.LENGTH.unpack_from(buf, offset)
+            offset += 4
+            data = buf[offset:offset + size]
+            if len(data) != size:
+                raise ValueError('truncated binary frame')
+            return data.decode(), offset + size
+        elif tag == self.INT:
+            return self.INT_VALUE.unpack_from(buf, offset)[0], offset + 8
+        elif tag == self.STR_JOINED:
+            count, size = self.LENGTHS.unpack_from(buf, offset)
+            offset += 8
+            items = buf[offset:offset + size].decode().split("\0")
+            if offset + size > len(buf) or len(items) != count:
+                raise ValueError('truncated binary frame')
+            return items, offset + size
+        elif tag == self.LIST or tag == self.DICT:
+            if depth >= self.MAX_DEPTH:
+                raise ValueError('binary frame nested too deep')
+            count, = self.LENGTH.unpack_from(buf, offset)
+            offset += 4
+            decode_value = self.decode_value
+            if tag == self.LIST:
+                items = []
+                for i in range(count):
+                    item, offset = decode_value(buf, offset, depth + 1)
+                    items.append(item)
+            else:
+                items = {}
+                for i in range(count):
+                    key, offset = decode_value(buf, offset, depth + 1)
+                    items[key], offset = decode_value(buf, offset, depth + 1)
+            return items, offset
+        elif tag == self.INT_LIST:
+            count, = self.LENGTH.unpack_from(buf, offset)
+            offset += 4
+            if offset + 8 * count > len(buf):
+                raise ValueError('truncated binary frame')
+            return list(struct.unpack_from(f'!{count}q', buf, offset)), offset + 8 * count
+        elif tag == self.STR_LIST:
+            count, size = self.LENGTHS.unpack_from(buf, offset)
+            offset += 8
+            if offset + 4 * count > len(buf):
+                raise ValueError('truncated binary frame')
+            ends = list(itertools.accumulate(struct.unpack_from(f'!{count}I', buf, offset)))
+            offset += 4 * count
+            text = buf[offset:offset + size].decode()
+            if offset + size > len(buf) or (ends and ends[-1] != len(text)):
+                raise ValueError('truncated binary frame')
+            starts = [0] + ends[:-1]
+            return list(map(text.__getitem__, map(slice, starts, ends))), offset + size
+        elif tag == self.BYTES:
+            size, = self.LENGTH.unpack_from(buf, offset)
+            offset += 4
+            data = buf[offset:offset + size]
+            if len(data) != size:
+                raise ValueError('truncated binary frame')
+            return data, offset + size
+        elif tag == self.FLOAT:
+            return self.FLOAT_VALUE.unpack_from(buf, offset)[0], offset + 8
+        elif tag == self.NONE:
+            return None, offset
+        elif tag == self.FALSE:
+            return False, offset
+        elif tag == self.TRUE:
+            return True, offset
+        raise ValueError(f'unknown tag {tag}')
+
+
+# Codecs that can be selected per connection, by id.
+CODECS = {}
+
+
+def register_codec(codec):
+    CODECS[codec.id] = codec
+    return codec
+
+
+BINARY_CODEC = register_codec(BinaryCodec())
+PICKLE_CODEC = register_codec(PickleCodec())
+DEFAULT_CODEC = BINARY_CODEC
+
+
+class ZlibCompression(object):
+    """
+    Deflate. Every frame is compressed on its own, since a broadcast frame
+    is shared by all of its recipients.
+    """
+    id = 1
+    name = "zlib"
+
+    # The fastest level, frames are compressed on the event loop of the server.
+    def __init__(self, level=1):
+        self.level = level
+
+    def compress(self, data):
+        compressor = zlib.compressobj(self.level)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data, max_size):
+        decompressor = zlib.decompressobj()
+        result = decompressor.decompress(data, max_size)
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise ValueError('compressed frame too large or truncated')
+        return result
+
+
+class Lz4Compression(object):
+    """ LZ4 block compression, faster than deflate but not as small, when the lz4 package is installed """
+    id = 2
+    name = "lz4"
+    SIZE = struct.Struct("<I")
+
+    def compress(self, data):
+        return lz4.block.compress(data, store_size=True)
+
+    def decompress(self, data, max_size):
+        if len(data) < self.SIZE.size or self.SIZE.unpack_from(data)[0] > max_size:
+            raise ValueError('compressed frame too large or truncated')
+        return lz4.block.decompress(data)
+
+
+# Compressions that can be negotiated per connection, by id and by name.
+COMPRESSIONS = {}
+COMPRESSION_NAMES = {}
+
+
+def register_compression(compression):
+    COMPRESSIONS[compression.id] = compression
+    COMPRESSION_NAMES[compression.name] = compression
+    return compression
+
 
+ZLIB_COMPRESSION = register_compression(ZlibCompression())
+if lz4 is not None:
+    register_compression(Lz4Compression())
 
-def receive_clients(channel):
-    size = struct.calcsize("L")
-    size = channel.recv(size)
+# What clients ask for, fastest first.
+PREFERRED_COMPRESSIONS = [name for name in ("lz4", "zlib") if name in COMPRESSION_NAMES]
+
+# Encoded arguments shorter than this are sent as they are, compressing them saves little.
+COMPRESS_THRESHOLD = 512
+# The most a compressed frame may grow to, so a small frame can not expand into a huge one.
+MAX_DECOMPRESSED_SIZE = 16 * 1024 * 1024
+# The longest frame a peer may send, the buffer for a frame is made as large as its header says.
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+def choose_compression(names):
+    """ Returns the first compression named that is available, or None """
+    for name in names:
+        if name in COMPRESSION_NAMES:
+            return COMPRESSION_NAMES[name]
+    return None
+
+
+def codec_of(buf):
+    """ Return the codec that a version 2 frame payload was encoded with """
     try:
-        size = socket.ntohl(struct.unpack("L", size)[0])
-    except struct.error as e:
-        return ''
-    buf = ""
-    while len(buf) < size:
-        buf = channel.recv(size - len(buf))
+        return CODECS[buf[1] & FLAG_CODEC_MASK]
+    except (IndexError, KeyError) as e:
+        raise ProtocolError(e)
 
-    data = pickle.loads(buf)
-    return data
 
+def pack_command(command, *args, codec=DEFAULT_CODEC, compression=None):
+    """
+    Build a single frame holding a command and all of its arguments,
+    compressing them when they are long enough and it makes them smaller.
+    """
+    body = codec.encode(args)
+    flags = codec.id
+    if compression is not None and len(body) >= COMPRESS_THRESHOLD:
+        compressed = compression.compress(body)
+        if len(compressed) < len(body):
+            body = compressed
+            flags |= compression.id << FLAG_COMPRESSION_SHIFT
+    buffer = ENVELOPE_HEADER.pack(PROTOCOL_VERSION, flags, COMMAND_IDS[command]) + body
+    return FRAME_HEADER.pack(len(buffer)) + buffer
 
-def send_list(channel, clients):
-    buffer = pickle.dumps(clients)
-    value = socket.htonl(len(buffer))
-    size = struct.pack("L", value)
-    channel.send(size)
-    channel.send(buffer)
+
+def pack_legacy(command, *args):
+    """ Build the multi-frame sequence that version 1 clients expect """
+    frames = [pack(command)]
+    for arg in args:
+        if isinstance(arg, list):
+            frames.append(pack_list(arg))
+        else:
+            frames.append(pack(arg))
+    return b"".join(frames)
 
 
-def receive_list(channel):
-    size = struct.calcsize("L")
-    size = channel.recv(size)
+def unpack_command(buf):
+    """
+    Decode a frame payload into (command, args).
+    A version 1 frame is returned as (value, None).
+    """
     try:
-        size = socket.ntohl(struct.unpack("L", size)[0])
-    except struct.error as e:
-        return ''
-    buf = ""
-    while len(buf) < size:
-        buf = channel.recv(size - len(buf))
-
-    data = pickle.loads(buf)
-    return data
+        if buf[:1] != bytes((PROTOCOL_VERSION,)):
+            return safe_loads(buf)[0], None
+        version, flags, command_id = ENVELOPE_HEADER.unpack_from(buf)
+        codec = CODECS[flags & FLAG_CODEC_MASK]
+        body = buf[ENVELOPE_HEADER.size:]
+        if flags & FLAG_COMPRESSION_MASK:
+            compression = COMPRESSIONS[(flags & FLAG_COMPRESSION_MASK) >> FLAG_COMPRESSION_SHIFT]
+            body = compression.decompress(body, MAX_DECOMPRESSED_SIZE)
+        return COMMANDS[command_id], codec.decode(body)
+    except (IndexError, KeyError, TypeError, ValueError, EOFError, struct.error, pickle.UnpicklingError,
+            zlib.error) as e:
+        raise ProtocolError(e)
+
+
+class FrameDecoder(object):
+    """
+    Receive buffer that splits a byte stream into frame payloads.
+    Data is received straight into the free space at the end of the buffer
+    and any number of frames are parsed from a single read, including
+    headers that arrived in pieces.
+
+    The frames are memoryviews into the buffer and are only valid until the
+    next call to writable or feed.
+
+    Version 1 peers prefix their frames with a native "L", which on the
+    64 bit Linux hosts the program targets is the network order length
+    followed by four zero bytes. No version 2 payload starts with a zero,
+    so those frames are recognised and unwrapped as well.
+
+    A header announcing more than MAX_FRAME_SIZE bytes raises ProtocolError.
+    """
+    LEGACY_HEADER_SIZE = struct.calcsize("L")
+
+    def __init__(self, size=65536):
+        self.buffer = bytearray(size)
+        self.start = 0
+        self.end = 0
+        self.needed = 0
+
+    def writable(self, minimum=4096):
+        """ Returns a view of the free space, making room for at least minimum bytes """
+        minimum = max(minimum, self.needed - (self.end - self.start), 1)
+        if len(self.buffer) - self.end < minimum:
+            pending = self.end - self.start
+            if len(self.buffer) - pending < minimum:
+                # Views of older frames may still exist, so never resize in place.
+                buffer = bytearray(max(2 * len(self.buffer), pending + minimum))
+                buffer[:pending] = self.buffer[self.start:self.end]
+                self.buffer = buffer
+            else:
+                self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, pending
+        return memoryview(self.buffer)[self.end:]
+
+    def advance(self, count):
+        """ Marks count bytes written into the last writable view as received """
+        self.end += count
+
+    def feed(self, data):
+        view = self.writable(len(data))
+        view[:len(data)] = data
+        view.release()
+        self.advance(len(data))
+
+    def pending(self):
+        return self.end - self.start
+
+    def next_frame(self):
+        """ Returns the next complete frame payload, or None """
+        available = self.end - self.start
+        if available <= FRAME_HEADER.size:
+            return None
+        size, = FRAME_HEADER.unpack_from(self.buffer, self.start)
+        if size > MAX_FRAME_SIZE:
+            raise ProtocolError(f'frame of {size} bytes is too large')
+        offset = FRAME_HEADER.size
+        if self.buffer[self.start + offset] == 0:
+            offset = self.LEGACY_HEADER_SIZE
+        if available < offset + size:
+            self.needed = offset + size
+            return None
+        self.needed = 0
+        frame = memoryview(self.buffer)[self.start + offset:self.start + offset + size]
+        self.start += offset + size
+        if self.start == self.end:
+            self.start = self.end = 0
+        return frame
+
+
+class FrameStream(asyncio.BufferedProtocol):
+    """
+    asyncio protocol that receives straight into a FrameDecoder, so TLS
+    records are decrypted into the frame buffer without an extra copy.
+    on_connect is started as a task with the stream once the connection
+    (and its handshake) is made.
+
+    Written frames are queued and flushed together once per loop iteration,
+    or flush_delay seconds after the first one when it is set, or when the
+    transport can take more data again. A flush is written as one buffer, so
+    over TLS the frames go out in as few records as possible. When more than
+    high_water bytes are waiting for the peer, overflow decides whether new
+    frames are dropped ("drop") or the connection is aborted ("disconnect"),
+    and on_overflow(stream) is called. Reading stops while more than
+    read_limit bytes have been received and not taken as frames yet, so a
+    peer that sends faster than it is served is held back by TCP.
+
+    With start_paused nothing is read until start_tls() is called, so a
+    connection can be accepted as plain TCP and upgraded later.
+    """
+
+    # Queued bytes that are flushed straight away instead of at the end of the iteration.
+    FLUSH_SIZE = 65536
+
+    def __init__(self, on_connect=None, size=65536, high_water=None, overflow="disconnect", start_paused=False,
+                 flush_delay=0, read_limit=None, on_overflow=None):
+        self.decoder = FrameDecoder(size)
+        self.on_connect = on_connect
+        self.start_paused = start_paused
+        self.loop = None
+        self.transport = None
+        self.task = None
+        self.waiter = None
+        self.closed = False
+        self.read_limit = read_limit
+        self.reading_paused = False
+
+        self.outbox = []
+        self.outbox_size = 0
+        self.flush_scheduled = False
+        self.flush_handle = None
+        self.flush_delay = flush_delay
+        self.writing_paused = False
+        self.high_water = high_water
+        self.overflow = overflow
+        self.on_overflow = on_overflow
+        self.dropped = 0
+
+    def connection_made(self, transport):
+        self.loop = asyncio.get_running_loop()
+        self.transport = transport
+        if self.start_paused:
+            transport.pause_reading()
+        if self.on_connect is not None:
+            self.task = self.loop.create_task(self.on_connect(self))
+
+    def get_buffer(self, sizehint):
+        return self.decoder.writable(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.decoder.advance(nbytes)
+        if self.read_limit is not None and self.decoder.pending() > self.read_limit and not self.reading_paused:
+            self.reading_paused = True
+            self.transport.pause_reading()
+        self.wake()
+
+    def eof_received(self):
+        self.closed = True
+        self.wake()
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.wake()
+
+    def wake(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def start_tls(self, context, server_side=True, server_hostname=None, timeout=None):
+        """ Does the TLS handshake on the connection, frames are read and written through TLS after it """
+        self.transport = await self.loop.start_tls(self.transport, self, context, server_side=server_side,
+                                                   server_hostname=server_hostname, ssl_handshake_timeout=timeout)
+
+    async def receive_frame(self):
+        """ Read one frame payload, returns b'' when the connection is closed """
+        frame = self.decoder.next_frame()
+        while frame is None:
+            if self.closed:
+                return b''
+            self.resume_reading()
+            self.waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+            frame = self.decoder.next_frame()
+        if self.reading_paused and self.decoder.pending() <= self.read_limit:
+            self.resume_reading()
+        return frame
+
+    def resume_reading(self):
+        if self.reading_paused:
+            self.reading_paused = False
+            if not self.transport.is_closing():
+                self.transport.resume_reading()
+
+    async def receive_command(self):
+        """ Read one command, returns ('', ()) when the connection is closed """
+        buf = await self.receive_frame()
+        if not buf:
+            return '', ()
+        return unpack_command(buf)
+
+    def write(self, data):
+        """ Queue a frame for the peer """
+        if self.transport is None or self.transport.is_closing():
+            return
+        if self.high_water is not None and self.backlog() + len(data) > self.high_water:
+            self.overflowed()
+            return
+        self.outbox.append(data)
+        self.outbox_size += len(data)
+        if self.outbox_size >= self.FLUSH_SIZE:
+            self.flush()
+        elif not self.flush_scheduled and not self.writing_paused:
+            self.flush_scheduled = True
+            if self.flush_delay > 0:
+                self.flush_handle = self.loop.call_later(self.flush_delay, self.flush)
+            else:
+                self.loop.call_soon(self.flush)
+
+    def backlog(self):
+        """ Bytes queued for the peer that the transport has not sent yet """
+        return self.outbox_size + self.transport.get_write_buffer_size()
+
+    def overflowed(self):
+        if self.overflow == "drop":
+            self.dropped += 1
+        else:
+            self.transport.abort()
+        if self.on_overflow is not None:
+            self.on_overflow(self)
+
+    def flush(self, force=False):
+        """ Hands every queued frame to the transport in a single buffer """
+        self.flush_scheduled = False
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.outbox or self.transport.is_closing():
+            return
+        if self.writing_paused and not force:
+            return
+        outbox = self.outbox
+        self.outbox = []
+        self.outbox_size = 0
+        # writelines() would encrypt every frame into a TLS record of its own.
+        self.transport.write(outbox[0] if len(outbox) == 1 else b''.join(outbox))
+
+    def set_batching(self, flush_delay=0, nodelay=True):
+        """
+        Trades latency for throughput on this connection: frames are gathered
+        for flush_delay seconds before they are written, and with nodelay off
+        the kernel may hold back small segments too (Nagle's algorithm).
+        """
+        self.flush_delay = flush_delay
+        sock = self.transport.get_extra_info('socket')
+        if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(nodelay))
+
+    def pause_writing(self):
+        self.writing_paused = True
+
+    def resume_writing(self):
+        self.writing_paused = False
+        self.flush()
+
+    def close(self):
+        self.flush(force=True)
+        self.transport.close()
+
+    def get_extra_info(self, name, default=None):
+        return self.transport.get_extra_info(name, default)